@@ -0,0 +1,916 @@
+import io
+import os
+import re
+import json
+import time
+import shutil
+import sys
+import argparse
+import subprocess
+import zlib
+import numpy as np
+from utils_synthetic_corpus import parse_scale
+from utils_profiling import max_rss_mb
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+default_index_dir = os.path.join(script_dir, 'index')
+default_work_dir = os.path.join(script_dir, 'benchmark_data')
+
+# Libraries that take long to import, reported by the startup benchmark
+HEAVY_MODULES = ["spacy", "sklearn", "scipy", "pandas", "fitz", "faiss", "sentence_transformers", "torch", "onnxruntime"]
+
+# Import time allowed for every main.py mode, in seconds, and the heavy libraries the mode must not import
+STARTUP_BUDGETS = {
+    "help": (0.5, HEAVY_MODULES),
+    "query": (3.0, ["fitz", "faiss", "sentence_transformers", "torch", "onnxruntime"]),
+}
+
+
+def latency_summary(latencies):
+    """
+    Summarize per-call latencies in milliseconds.
+
+    Args:
+    - latencies (list of float): Durations in seconds.
+
+    Returns:
+    - dict: Mean, p50, p95 and p99 latency in milliseconds.
+    """
+    latencies_ms = np.asarray(latencies) * 1000.0
+    return {
+        "mean_ms": float(latencies_ms.mean()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def sample_queries(embeddings, n_queries, noise=0.05, seed=0):
+    """
+    Draw query vectors from the corpus embeddings, perturbed with Gaussian noise and renormalized.
+
+    Args:
+    - embeddings (numpy.ndarray): Normalized corpus embeddings.
+    - n_queries (int): The number of queries.
+    - noise (float): Standard deviation of the noise added to every component.
+    - seed (int): Random seed.
+
+    Returns:
+    - numpy.ndarray: float32 array of normalized query vectors.
+    """
+    from utils_embedding_store import normalize_embeddings
+
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+    queries = np.asarray(embeddings[rows], dtype=np.float32)
+    queries = queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    return normalize_embeddings(queries)
+
+
+def ann_report(embeddings, queries, k=10, backends=None, **params):
+    """
+    Compare FAISS backends with the exact (flat) index on recall and query latency.
+
+    Args:
+    - embeddings (numpy.ndarray): Normalized corpus embeddings.
+    - queries (numpy.ndarray): Normalized query vectors.
+    - k (int): The number of neighbors retrieved per query.
+    - backends (list of str, optional): The backends to compare. Defaults to all FAISS_BACKENDS.
+    - params: Additional parameters passed to build_field_index.
+
+    Returns:
+    - list of dict: One row per backend with build time, index size, recall@k against the flat
+      index and single-query latency percentiles.
+    """
+    import faiss
+    from utils_faiss_index import FAISS_BACKENDS, build_field_index, search_field_index
+
+    backends = backends or FAISS_BACKENDS
+    exact = build_field_index(embeddings, "flat")
+    _, exact_indices = search_field_index(exact, queries, k)
+
+    rows = []
+    for backend in backends:
+        start = time.perf_counter()
+        index = build_field_index(embeddings, backend, **params)
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.perf_counter()
+            _, indices = search_field_index(index, query[None, :], k)
+            latencies.append(time.perf_counter() - start)
+            found.append(indices[0])
+
+        recall = np.mean([len(set(approx[approx >= 0]) & set(truth)) / len(truth)
+                          for approx, truth in zip(found, exact_indices)])
+        row = {
+            "backend": backend,
+            "build_s": build_seconds,
+            "index_bytes": int(faiss.serialize_index(index).size),
+            f"recall@{k}": float(recall),
+        }
+        row.update(latency_summary(latencies))
+        rows.append(row)
+    return rows
+
+
+def quantization_report(embeddings, queries, k=10, precisions=None, backends=None, field=None, **params):
+    """
+    Compare the memory footprint and the top-k results of reduced-precision embeddings and compressed
+    FAISS indexes with the full precision exact search.
+
+    Args:
+    - embeddings (numpy.ndarray): Normalized corpus embeddings, in full precision.
+    - queries (numpy.ndarray): Normalized query vectors.
+    - k (int): The number of neighbors retrieved per query.
+    - precisions (list of str, optional): Storage precisions to compare. Defaults to all EMBEDDING_PRECISIONS.
+    - backends (list of str, optional): FAISS backends to compare. Defaults to flat, fp16, sq8, pq and ivfpq.
+    - field (str, optional): The name of the field, added to every row.
+    - params: Additional parameters passed to build_field_index.
+
+    Returns:
+    - list of dict: One row per storage precision ("store <precision>", searched exactly) and per FAISS
+      backend ("faiss <backend>") with its size in bytes, bytes per document and overlap@k, the mean
+      fraction of the full precision top-k that is found.
+    """
+    import faiss
+    from utils_embedding_store import EMBEDDING_PRECISIONS, Int8Embeddings, quantize_embeddings
+    from utils_faiss_index import build_field_index, search_field_index
+
+    precisions = precisions or EMBEDDING_PRECISIONS
+    backends = backends or ["flat", "fp16", "sq8", "pq", "ivfpq"]
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    _, exact_indices = search_field_index(build_field_index(embeddings, "flat"), queries, k)
+
+    def row(mode, n_bytes, indices):
+        overlap = np.mean([len(set(found[found >= 0]) & set(truth)) / len(truth)
+                           for found, truth in zip(indices, exact_indices)])
+        result = {"field": field} if field else {}
+        result.update({"mode": mode, "bytes": int(n_bytes), "bytes_per_doc": n_bytes / max(len(embeddings), 1),
+                       f"overlap@{k}": float(overlap)})
+        return result
+
+    rows = []
+    for precision in precisions:
+        stored, scale = quantize_embeddings(embeddings, precision)
+        restored = Int8Embeddings(stored, scale) if scale is not None else stored
+        _, indices = search_field_index(build_field_index(restored, "flat"), queries, k)
+        rows.append(row(f"store {precision}", stored.nbytes + (scale.nbytes if scale is not None else 0), indices))
+    for backend in backends:
+        index = build_field_index(embeddings, backend, **params)
+        _, indices = search_field_index(index, queries, k)
+        rows.append(row(f"faiss {backend}", faiss.serialize_index(index).size, indices))
+    return rows
+
+
+def encoder_report(texts, encoders, batch_size=64, reference="torch"):
+    """
+    Measure the CPU throughput of sentence encoder backends and compare their embeddings with a reference backend.
+
+    Args:
+    - texts (list of str): The texts to encode.
+    - encoders (dict): Mapping of backend names to loaded encoders, see load_encoder.
+    - batch_size (int): The number of texts encoded at once.
+    - reference (str): The backend the others are compared with.
+
+    Returns:
+    - list of dict: One row per backend with the encoding time, sentences per second and, when the reference
+      backend is measured too, the cosine similarity with its embeddings (see compare_encoders).
+    """
+    from utils_embedding_store import encode_texts
+    from utils_encoders import compare_encoders
+
+    outputs = {}
+    rows = []
+    for backend, encoder in encoders.items():
+        # One warm-up batch, so one-time initialization is not measured
+        encode_texts(encoder, texts[:batch_size], batch_size)
+        start = time.perf_counter()
+        outputs[backend] = encode_texts(encoder, texts, batch_size)
+        seconds = time.perf_counter() - start
+        rows.append({"backend": backend, "sentences": len(texts), "seconds": seconds,
+                     "sentences_per_s": len(texts) / seconds if seconds > 0 else float("inf")})
+    if reference in outputs:
+        for row in rows:
+            row.update(compare_encoders(outputs[reference], outputs[row["backend"]], row["backend"]))
+    return rows
+
+
+def parse_import_times(stderr):
+    """
+    Parse the output of python -X importtime.
+
+    Args:
+    - stderr (str): The standard error of the interpreter.
+
+    Returns:
+    - tuple: (seconds, modules), the total import time and the names of all imported modules.
+    """
+    total_us = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        # Nested imports are indented and already counted in the cumulative time of their parent
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+    return total_us / 1e6, modules
+
+
+def startup_report(scenarios, repeat=3):
+    """
+    Measure the start-up cost of main.py modes, each run in a fresh interpreter.
+
+    Args:
+    - scenarios (dict): Mapping of scenario names to (main.py arguments, budget in seconds, heavy libraries
+      the scenario must not import).
+    - repeat (int): The number of runs per scenario; the median is reported.
+
+    Returns:
+    - list of dict: One row per scenario with the wall time and import time of the run, the heavy
+      libraries it imported, the ones it should not have imported, and whether it stayed within its budget.
+    """
+    rows = []
+    for name, (arguments, budget, forbidden) in scenarios.items():
+        wall, imports, modules = [], [], set()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, "-X", "importtime", os.path.join(script_dir, "main.py"), *arguments],
+                                       cwd=script_dir, capture_output=True, text=True)
+            wall.append(time.perf_counter() - start)
+            seconds, modules = parse_import_times(completed.stderr)
+            imports.append(seconds)
+        heavy = [module for module in HEAVY_MODULES if module in modules]
+        unexpected = [module for module in forbidden if module in modules]
+        import_s = float(np.median(imports))
+        rows.append({"scenario": name, "wall_s": float(np.median(wall)), "import_s": import_s, "budget_s": float(budget),
+                     "heavy_modules": ",".join(heavy) or "-", "unexpected": ",".join(unexpected) or "-",
+                     "within_budget": import_s <= budget and not unexpected})
+    return rows
+
+
+def git_commit():
+    """
+    Return the short hash of the checked out commit, or None outside of a git repository.
+    """
+    try:
+        completed = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=script_dir, capture_output=True, text=True)
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+
+def run_stage(stage, function, trace_memory=False):
+    """
+    Run one pipeline stage and measure it.
+
+    Args:
+    - stage (str): The name of the stage.
+    - function (callable): Runs the stage and returns (result, number of items processed).
+    - trace_memory (bool): Also measure the peak memory allocated during the stage with tracemalloc
+      (slows allocation-heavy stages down).
+
+    Returns:
+    - tuple: (result, row). The row holds the time, the items per second, the peak allocated memory
+      (None without trace_memory) and the peak resident memory of the process so far.
+    """
+    import tracemalloc
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result, items = function()
+    seconds = time.perf_counter() - start
+    peak_alloc_mb = None
+    if trace_memory:
+        peak_alloc_mb = tracemalloc.get_traced_memory()[1] / (1 << 20)
+        tracemalloc.stop()
+    row = {"stage": stage, "items": items, "seconds": seconds, "items_per_s": items / seconds if seconds > 0 else None,
+           "mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None,
+           "peak_alloc_mb": peak_alloc_mb, "max_rss_mb": max_rss_mb()}
+    return result, row
+
+
+class HashingSentenceEncoder:
+    """
+    Small offline stand-in for the SentenceTransformer, for the pipeline benchmark where the model cannot be loaded.
+
+    Every word is hashed to one dimension with a random sign (the hashing trick), so texts sharing words get
+    similar embeddings. It has the encode and get_sentence_embedding_dimension methods of SentenceTransformer
+    and needs neither PyTorch nor a model download; the embeddings have no semantic meaning.
+
+    Args:
+    - dimension (int): The size of the embeddings.
+    """
+
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, sentences, batch_size=64, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in self.TOKEN_PATTERN.findall(str(text).lower()):
+                # crc32 rather than hash(), which differs between interpreter runs
+                code = zlib.crc32(token.encode("utf-8"))
+                embeddings[row, code % self.dimension] += 1.0 if code & (1 << 31) else -1.0
+        return embeddings[0] if single else embeddings
+
+
+def pipeline_report(corpus_dir, new_dir, index_dir, encoder, queries, workers=None, batch_size=256, trace_memory=False):
+    """
+    Time every stage of the pipeline on a corpus of PDF files, from reading the PDFs to the -q and -f searches.
+
+    Args:
+    - corpus_dir (str): The folder with the corpus PDF files.
+    - new_dir (str): The folder with the PDF files compared with the corpus by the similarity stage.
+    - index_dir (str): The folder the index is written to; it is removed first.
+    - encoder: The sentence encoder (SentenceTransformer, OnnxSentenceEncoder or HashingSentenceEncoder).
+    - queries (list of str): The indications searched by the query stages.
+    - workers (int, optional): The number of processes reading PDF files.
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - trace_memory (bool): Measure the peak allocated memory of every stage, see run_stage.
+
+    Returns:
+    - list of dict: One row per stage:
+        - "read": read_documents, PDF text extraction.
+        - "extract": extract_sections over the texts.
+        - "clean": process_documents, cleaning and lemmatization with spaCy.
+        - "index_build": build_index end to end (without the text cache).
+        - "index_load": load_index.
+        - "query": search_product_by_indication once per query, with latency percentiles.
+        - "queries_batch": search_products_by_indications over all queries at once.
+        - "embeddings": build_embedding_store, encoding both fields of every document.
+        - "similarity": process_new_files_similarity_batch over the new files.
+
+    Every spaCy stage starts from an empty lemma cache, so runs are comparable.
+    """
+    from utils_dataprep import read_documents
+    from utils_info_extract import iter_sections
+    from utils_data_cleaning import process_documents, configure_lemma_cache
+    from utils_index import build_index, load_index
+    from utils_search_engine import search_product_by_indication, search_products_by_indications
+    from utils_embedding_store import EMBEDDING_FIELDS, build_embedding_store
+    from utils_faiss_index import ensure_field_indexes
+    from utils_search_similar import process_new_files_similarity_batch
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    rows = []
+
+    def stage(name, function):
+        result, row = run_stage(name, function, trace_memory)
+        rows.append(row)
+        return result
+
+    def read():
+        texts = read_documents(corpus_dir, workers=workers)
+        return texts, len(texts)
+
+    def extract():
+        sections = list(iter_sections(texts))
+        return sections, len(sections)
+
+    def clean():
+        return None, sum(1 for _ in process_documents(sections, batch_size))
+
+    def build():
+        return None, build_index(corpus_dir, index_dir, workers, batch_size=batch_size, text_cache=False)["n_documents"]
+
+    def single_queries():
+        for query in queries:
+            start = time.perf_counter()
+            search_product_by_indication(query, documents, vectorizer, index["tfidf_matrix"], top_k=10,
+                                         tfidf_postings=index["tfidf_postings"])
+            latencies.append(time.perf_counter() - start)
+        return None, len(queries)
+
+    def batch_queries():
+        results = search_products_by_indications(queries, documents, vectorizer, index["tfidf_matrix"], top_k=10,
+                                                 tfidf_postings=index["tfidf_postings"])
+        return None, sum(1 for _ in results)
+
+    def embed():
+        return build_embedding_store(index_dir, documents, encoder), len(documents)
+
+    def similarity():
+        count = process_new_files_similarity_batch(new_dir, documents, encoder, io.StringIO(), "csv", store, indexes=indexes,
+                                                   workers=workers, tfidf=(vectorizer, index["tfidf_postings"]))
+        return None, count
+
+    texts = stage("read", read)
+    sections = stage("extract", extract)
+    configure_lemma_cache()
+    stage("clean", clean)
+    del texts, sections
+
+    configure_lemma_cache()
+    stage("index_build", build)
+    index = stage("index_load", lambda: (load_index(index_dir), 1))
+    documents, vectorizer = index["documents"], index["vectorizer"]
+
+    configure_lemma_cache()
+    latencies = []
+    stage("query", single_queries)
+    rows[-1].update(latency_summary(latencies))
+    configure_lemma_cache()
+    stage("queries_batch", batch_queries)
+
+    store = stage("embeddings", embed)
+    indexes = ensure_field_indexes(index_dir, store, EMBEDDING_FIELDS)
+    stage("similarity", similarity)
+    return rows
+
+
+def synthetic_tfidf_matrix(n_documents, n_terms=50000, terms_per_document=150, seed=0):
+    """
+    Generate the TF-IDF matrix of a synthetic corpus whose term frequencies follow Zipf's law.
+
+    Args:
+    - n_documents (int): The number of documents.
+    - n_terms (int): The size of the vocabulary.
+    - terms_per_document (int): The number of term occurrences drawn per document.
+    - seed (int): Random seed.
+
+    Returns:
+    - tuple: (tfidf_matrix, idf) as produced by TfidfVectorizer on such a corpus.
+    """
+    import scipy.sparse
+    from sklearn.feature_extraction.text import TfidfTransformer
+
+    rng = np.random.default_rng(seed)
+    probabilities = 1.0 / np.arange(1, n_terms + 1)
+    probabilities /= probabilities.sum()
+    terms = rng.choice(n_terms, size=n_documents * terms_per_document, p=probabilities)
+    documents = np.repeat(np.arange(n_documents), terms_per_document)
+    counts = scipy.sparse.csr_matrix((np.ones(len(terms)), (documents, terms)), shape=(n_documents, n_terms))
+    counts.sum_duplicates()
+    transformer = TfidfTransformer().fit(counts)
+    return transformer.transform(counts).tocsr(), transformer.idf_
+
+
+def sample_term_queries(tfidf_matrix, n_queries, max_terms=3, seed=0):
+    """
+    Draw queries of 1 to max_terms term ids, taken together from the terms of a random document.
+
+    Returns:
+    - list of numpy.ndarray: The term ids of every query.
+    """
+    rng = np.random.default_rng(seed)
+    tfidf_matrix = tfidf_matrix.tocsr()
+    queries = []
+    while len(queries) < n_queries:
+        row = rng.integers(tfidf_matrix.shape[0])
+        terms = tfidf_matrix.indices[tfidf_matrix.indptr[row]:tfidf_matrix.indptr[row + 1]]
+        if len(terms):
+            queries.append(rng.choice(terms, size=min(len(terms), rng.integers(1, max_terms + 1)), replace=False))
+    return queries
+
+
+def search_report(tfidf_matrix, idf, queries, k=10):
+    """
+    Compare the sparse product of search_product_by_indication with the inverted index search.
+
+    Args:
+    - tfidf_matrix (scipy.sparse.csr_matrix): The TF-IDF matrix of the corpus.
+    - idf (numpy.ndarray): The IDF weight of every term.
+    - queries (list of numpy.ndarray): The term ids of every query.
+    - k (int): The number of documents retrieved per query.
+
+    Returns:
+    - list of dict: One row per method with single-query latency percentiles and the fraction of
+      queries ranked exactly like the sparse product.
+
+    Queries are weighted like TfidfVectorizer.transform would (IDF, unit length), so lemmatization is not
+    part of the measurement.
+    """
+    import scipy.sparse
+    from utils_search_engine import term_major, rank_scores
+    from utils_inverted_index import build_inverted_index, search_inverted_index
+
+    tfidf_postings = term_major(tfidf_matrix)
+    inverted_index = build_inverted_index(tfidf_postings)
+    weighted = []
+    for term_ids in queries:
+        term_ids = np.sort(term_ids)
+        weights = idf[term_ids] / np.linalg.norm(idf[term_ids])
+        weighted.append((term_ids, weights))
+
+    def matrix_search(term_ids, weights):
+        query = scipy.sparse.csr_matrix((weights, term_ids, [0, len(term_ids)]), shape=(1, tfidf_postings.shape[0]))
+        scores = (query @ tfidf_postings).tocsr()
+        return rank_scores(scores.indices, scores.data, k)
+
+    def inverted_search(term_ids, weights):
+        return search_inverted_index(inverted_index, term_ids, weights, k)
+
+    rows = []
+    reference = None
+    for method, search in [("sparse product", matrix_search), ("inverted index", inverted_search)]:
+        latencies = []
+        rankings = []
+        for term_ids, weights in weighted:
+            start = time.perf_counter()
+            rankings.append(search(term_ids, weights))
+            latencies.append(time.perf_counter() - start)
+        reference = reference or rankings
+        row = {"method": method, "n_documents": tfidf_matrix.shape[0],
+               "identical": float(np.mean([a == b for a, b in zip(rankings, reference)]))}
+        row.update(latency_summary(latencies))
+        rows.append(row)
+    return rows
+
+
+def sample_text_queries(documents, n_queries, field="wskazania", max_words=3, seed=0):
+    """
+    Draw indication queries of one to max_words consecutive words from the documents of the index.
+
+    Returns:
+    - list of str: The queries; documents without text in the field are skipped.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for row in rng.integers(0, len(documents), size=n_queries * 4):
+        words = documents[int(row)][field].split()
+        if words:
+            start = int(rng.integers(0, len(words)))
+            queries.append(" ".join(words[start:start + int(rng.integers(1, max_words + 1))]))
+        if len(queries) == n_queries:
+            break
+    return queries
+
+
+def concurrency_report(service, requests, kind="search", concurrency=32, max_batch_size=64, max_wait=0.002):
+    """
+    Compare the throughput of answering requests one at a time, from a pool of threads and with the
+    micro-batching asyncio API (AsyncSearchService), with `concurrency` clients sending requests.
+
+    Args:
+    - service (SearchService): The loaded search service.
+    - requests (list): Indication queries for "search", lists of cleaned documents for "similar".
+    - kind (str): "search" or "similar".
+    - concurrency (int): The number of clients sending requests at the same time.
+    - max_batch_size (int): The largest batch of the micro-batching API.
+    - max_wait (float): The time in seconds a request waits for others to share its batch.
+
+    Returns:
+    - list of dict: One row per mode with requests per second, latency percentiles, the mean batch size
+      and the fraction of results identical to the one-at-a-time answers.
+
+    The lemma cache is emptied before every mode, so all of them lemmatize the queries with spaCy.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from utils_async_search import AsyncSearchService
+    from utils_data_cleaning import configure_lemma_cache
+
+    if kind == "search":
+        def call(request):
+            return service.search(request, 10)
+    else:
+        def call(request):
+            return service.similar_batch([(request, 150, 0.0)])[0]
+
+    def timed(request):
+        start = time.perf_counter()
+        result = call(request)
+        return result, time.perf_counter() - start
+
+    async def run_async():
+        api = AsyncSearchService(service, max_batch_size, max_wait, max_concurrency=concurrency)
+        pending = iter(requests)
+        answers = {}
+
+        async def client():
+            for position, request in pending:
+                start = time.perf_counter()
+                if kind == "search":
+                    result = await api.search(request, 10)
+                else:
+                    result = await api.similar_documents(request, 150)
+                answers[position] = (result, time.perf_counter() - start)
+
+        pending = iter(enumerate(requests))
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        stats = api.stats()[kind]
+        await api.close()
+        return [answers[position] for position in range(len(requests))], stats["mean_batch_size"]
+
+    rows = []
+    reference = None
+    for mode in ["one at a time", "threads", "async micro-batch"]:
+        configure_lemma_cache()
+        start = time.perf_counter()
+        batch_size = 1.0
+        if mode == "one at a time":
+            answers = [timed(request) for request in requests]
+        elif mode == "threads":
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                answers = list(executor.map(timed, requests))
+        else:
+            answers, batch_size = asyncio.run(run_async())
+        elapsed = time.perf_counter() - start
+        results = [result for result, _ in answers]
+        reference = reference or results
+        row = {"kind": kind, "mode": mode, "requests": len(requests), "concurrency": 1 if mode == "one at a time" else concurrency,
+               "requests_per_s": len(requests) / elapsed, "mean_batch_size": batch_size,
+               "identical": float(np.mean([a == b for a, b in zip(results, reference)]))}
+        row.update(latency_summary([latency for _, latency in answers]))
+        rows.append(row)
+    configure_lemma_cache()
+    return rows
+
+
+def cache_report(service, queries, n_requests=5000, zipf=1.1, seed=0):
+    """
+    Compare indication searches with and without the result cache on a stream of repeated queries, where
+    a few queries are asked very often and most of them rarely (Zipf distribution over `queries`).
+
+    Args:
+    - service (SearchService): The loaded search service.
+    - queries (list of str): The distinct queries.
+    - n_requests (int): The length of the stream.
+    - zipf (float): The exponent of the Zipf distribution, larger values repeat the frequent queries more.
+    - seed (int): The seed of the stream.
+
+    Returns:
+    - list of dict: One row per mode with requests per second, the hit rate, latency percentiles of all
+      requests and of the cache hits in microseconds, and the fraction of results identical to the uncached ones.
+    """
+    from utils_data_cleaning import configure_lemma_cache
+    from utils_result_cache import ResultCache
+
+    rng = np.random.default_rng(seed)
+    stream = [queries[(int(rank) - 1) % len(queries)] for rank in rng.zipf(zipf, size=n_requests)]
+    cache = service.cache
+    rows = []
+    reference = None
+    for mode, maxsize in [("no cache", 0), ("result cache", cache.maxsize or 10000)]:
+        configure_lemma_cache()
+        service.cache = ResultCache(maxsize, cache.ttl)
+        results, latencies, hits = [], [], []
+        start = time.perf_counter()
+        for query in stream:
+            before = service.cache.hits
+            call_start = time.perf_counter()
+            results.append(service.search(query, 10))
+            latencies.append(time.perf_counter() - call_start)
+            if service.cache.hits > before:
+                hits.append(latencies[-1])
+        elapsed = time.perf_counter() - start
+        reference = reference or results
+        stats = service.cache.stats()
+        row = {"mode": mode, "requests": n_requests, "distinct": len(set(stream)), "requests_per_s": n_requests / elapsed,
+               "hit_rate": stats["hit_rate"], "evictions": stats["evictions"],
+               "identical": float(np.mean([a == b for a, b in zip(results, reference)]))}
+        row.update(latency_summary(latencies))
+        row["hit_p50_us"] = float(np.percentile(hits, 50) * 1e6) if hits else float("nan")
+        row["hit_p99_us"] = float(np.percentile(hits, 99) * 1e6) if hits else float("nan")
+        rows.append(row)
+    service.cache = cache
+    configure_lemma_cache()
+    return rows
+
+
+def print_rows(rows):
+    """
+    Print benchmark rows as an aligned table.
+    """
+    if not rows:
+        return
+    columns = list(rows[0])
+    formatted = [[f"{row[column]:.4f}" if isinstance(row[column], float) else str(row[column]) for column in columns]
+                 for row in rows]
+    widths = [max(len(column), *(len(values[i]) for values in formatted)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for values in formatted:
+        print("  ".join(value.ljust(width) for value, width in zip(values, widths)))
+
+
+def write_rows(rows, output):
+    """
+    Write benchmark rows to a JSON file.
+    """
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+
+
+def run_ann(args):
+    from utils_embedding_store import load_embedding_store
+
+    store = load_embedding_store(args.index_dir)
+    if store is None:
+        print(f"No embeddings found in {args.index_dir}. Run 'main.py index build --embeddings' first.")
+        return []
+    queries = sample_queries(store[args.field], args.queries, args.noise)
+    return ann_report(store[args.field], queries, args.k, args.backends,
+                      nprobe=args.nprobe, ef_search=args.ef_search)
+
+
+def run_quantization(args):
+    from utils_embedding_store import load_embedding_store
+
+    store = load_embedding_store(args.index_dir)
+    if store is None:
+        print(f"No embeddings found in {args.index_dir}. Run 'main.py index build --embeddings' first.")
+        return []
+    if store["precision"] != "float32":
+        print(f"The stored embeddings are {store['precision']}, they are used as the full precision reference.")
+    rows = []
+    for field in args.fields:
+        queries = sample_queries(store[field], args.queries, args.noise)
+        rows += quantization_report(store[field], queries, args.k, args.precisions, args.backends, field,
+                                    nprobe=args.nprobe, pq_m=args.pq_m)
+    return rows
+
+
+def run_encoders(args):
+    from utils_index import load_index, index_exists
+    from utils_encoders import ENCODER_BACKENDS, load_encoder, onnx_dir
+
+    if not index_exists(args.index_dir):
+        print(f"No index found in {args.index_dir}. Run 'main.py index build' first.")
+        return []
+    documents = load_index(args.index_dir)["documents"]
+    texts = [doc[field] for doc in documents for field in ("sklad", "wskazania")][:args.sentences]
+    encoders = {backend: load_encoder(backend, model_dir=onnx_dir(args.index_dir), threads=args.threads)
+                for backend in args.backends or ENCODER_BACKENDS}
+    return encoder_report(texts, encoders, args.batch_size)
+
+
+def run_startup(args):
+    scenarios = {"help": (["--help"], *STARTUP_BUDGETS["help"])}
+    if os.path.isdir(args.index_dir):
+        scenarios["query"] = (["--index-dir", args.index_dir, "-q", args.query], *STARTUP_BUDGETS["query"])
+    else:
+        print(f"No index found in {args.index_dir}, only the help scenario is measured.")
+    return startup_report(scenarios, args.repeat)
+
+
+def run_pipeline(args):
+    from utils_synthetic_corpus import generate_corpus, synthetic_queries
+    from utils_encoders import load_encoder
+
+    corpus_dir = os.path.join(args.work_dir, f"corpus_{args.documents}_{args.seed}")
+    new_dir = os.path.join(args.work_dir, f"new_{args.new_documents}_{args.seed}")
+    index_dir = os.path.join(args.work_dir, f"index_{args.documents}_{args.seed}")
+    start = time.perf_counter()
+    if generate_corpus(corpus_dir, args.documents, args.seed, workers=args.workers):
+        print(f"Generated {args.documents} documents in {corpus_dir} in {time.perf_counter() - start:.1f} s")
+    # New documents continue the numbering of the corpus, so they are not copies of corpus documents
+    generate_corpus(new_dir, args.new_documents, args.seed, start=args.documents, workers=args.workers)
+
+    if args.encoder == "stub":
+        encoder = HashingSentenceEncoder()
+    else:
+        try:
+            encoder = load_encoder("torch")
+        except Exception as e:
+            if args.encoder == "torch":
+                raise
+            print(f"Sentence encoder not available ({e}), using the hashing stub encoder.")
+            encoder = HashingSentenceEncoder()
+
+    rows = pipeline_report(corpus_dir, new_dir, index_dir, encoder, synthetic_queries(args.queries, args.seed),
+                           args.workers, args.batch_size, args.trace_memory)
+    run_info = {"commit": git_commit(), "documents": args.documents, "encoder": type(encoder).__name__}
+    return [{**run_info, **row} for row in rows]
+
+
+def run_search(args):
+    from utils_index import load_index, index_exists
+
+    if not args.synthetic and not index_exists(args.index_dir):
+        print(f"No index found in {args.index_dir}. Run 'main.py index build' first.")
+        return []
+    if args.synthetic:
+        tfidf_matrix, idf = synthetic_tfidf_matrix(args.synthetic)
+    else:
+        index = load_index(args.index_dir)
+        tfidf_matrix, idf = index["tfidf_matrix"], index["vectorizer"].idf_
+    queries = sample_term_queries(tfidf_matrix, args.queries, args.max_terms)
+    return search_report(tfidf_matrix, idf, queries, args.k)
+
+
+def run_concurrency(args):
+    from utils_index import index_exists
+    from utils_shards import is_sharded
+    from utils_server import SearchService
+
+    if not index_exists(args.index_dir) and not is_sharded(args.index_dir):
+        print(f"No index found in {args.index_dir}. Run 'main.py index build' first.")
+        return []
+    # Without the result cache, so repeated queries are searched again by every mode
+    service = SearchService(args.index_dir, with_similarity=args.similar, encoder=args.encoder, cache_size=0)
+    documents = service.index["documents"]
+    queries = sample_text_queries(documents, args.requests)
+    rows = concurrency_report(service, queries, "search", args.concurrency, args.max_batch_size, args.max_wait_ms / 1000.0)
+    if args.similar:
+        rng = np.random.default_rng(0)
+        new_docs = [[documents[int(row)]] for row in rng.integers(0, len(documents), size=args.requests)]
+        rows += concurrency_report(service, new_docs, "similar", args.concurrency, args.max_batch_size, args.max_wait_ms / 1000.0)
+    return rows
+
+
+def run_cache(args):
+    from utils_index import index_exists
+    from utils_shards import is_sharded
+    from utils_server import SearchService
+
+    if not index_exists(args.index_dir) and not is_sharded(args.index_dir):
+        print(f"No index found in {args.index_dir}. Run 'main.py index build' first.")
+        return []
+    service = SearchService(args.index_dir, with_similarity=False, cache_size=args.cache_size)
+    queries = sample_text_queries(service.index["documents"], args.queries)
+    return cache_report(service, queries, args.requests, args.zipf)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmarks of the search components.")
+    parser.add_argument("--index-dir", type=str, default=default_index_dir, help = "Folder where the corpus index is stored")
+    parser.add_argument("--output", type=str, help = "Write the results to this JSON file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ann_parser = subparsers.add_parser("ann", help = "Recall and latency of the FAISS backends against the exact index")
+    ann_parser.add_argument("--field", type=str, default="wskazania", choices=["sklad", "wskazania"])
+    ann_parser.add_argument("--backends", type=str, nargs="+", help = "Backends to compare (default: all)")
+    ann_parser.add_argument("-k", type=int, default=10, help = "Number of neighbors per query")
+    ann_parser.add_argument("--queries", type=int, default=200, help = "Number of queries sampled from the corpus")
+    ann_parser.add_argument("--noise", type=float, default=0.05, help = "Noise added to the sampled queries")
+    ann_parser.add_argument("--nprobe", type=int, default=16, help = "IVF cells visited per query")
+    ann_parser.add_argument("--ef-search", type=int, default=64, help = "HNSW candidate list size")
+    ann_parser.set_defaults(run=run_ann)
+
+    quantization_parser = subparsers.add_parser("quantization", help = "Memory footprint and top-k overlap of reduced-precision embeddings and compressed indexes")
+    quantization_parser.add_argument("--fields", type=str, nargs="+", default=["sklad", "wskazania"], choices=["sklad", "wskazania"])
+    quantization_parser.add_argument("--precisions", type=str, nargs="+", help = "Storage precisions to compare (default: float32 float16 int8)")
+    quantization_parser.add_argument("--backends", type=str, nargs="+", help = "FAISS backends to compare (default: flat fp16 sq8 pq ivfpq)")
+    quantization_parser.add_argument("-k", type=int, default=10, help = "Number of neighbors per query")
+    quantization_parser.add_argument("--queries", type=int, default=200, help = "Number of queries sampled from the corpus")
+    quantization_parser.add_argument("--noise", type=float, default=0.05, help = "Noise added to the sampled queries")
+    quantization_parser.add_argument("--nprobe", type=int, default=16, help = "IVF cells visited per query")
+    quantization_parser.add_argument("--pq-m", type=int, help = "PQ sub-quantizers (default: dimension / 8)")
+    quantization_parser.set_defaults(run=run_quantization)
+
+    encoders_parser = subparsers.add_parser("encoders", help = "Throughput of the sentence encoder backends on CPU and agreement with the PyTorch model")
+    encoders_parser.add_argument("--backends", type=str, nargs="+", help = "Backends to compare (default: torch onnx onnx-int8)")
+    encoders_parser.add_argument("--sentences", type=int, default=1000, help = "Number of 'sklad' and 'wskazania' texts taken from the index")
+    encoders_parser.add_argument("--batch-size", type=int, default=64, help = "Number of texts encoded at once")
+    encoders_parser.add_argument("--threads", type=int, help = "Number of onnxruntime threads (default: onnxruntime's choice)")
+    encoders_parser.set_defaults(run=run_encoders)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help = "Time every stage of the pipeline on a generated corpus of synthetic SmPC PDF files")
+    pipeline_parser.add_argument("--documents", type=parse_scale, default=1000, help = "Corpus size: a number of documents or 1k, 10k, 100k")
+    pipeline_parser.add_argument("--new-documents", type=int, default=50, help = "Number of new files compared with the corpus by the similarity stage")
+    pipeline_parser.add_argument("--queries", type=int, default=200, help = "Number of indication queries")
+    pipeline_parser.add_argument("--seed", type=int, default=0, help = "Seed of the generated corpus")
+    pipeline_parser.add_argument("--work-dir", type=str, default=default_work_dir, help = "Folder for the generated corpora and indexes, reused between runs")
+    pipeline_parser.add_argument("--workers", type=int, default=None, help = "Number of processes generating and reading PDF files")
+    pipeline_parser.add_argument("--batch-size", type=int, default=256, help = "Number of texts processed by spaCy at once")
+    pipeline_parser.add_argument("--encoder", type=str, default="auto", choices=["auto", "torch", "stub"], help = "Sentence encoder: the SentenceTransformer, the offline hashing stub, or the model if it can be loaded (auto)")
+    pipeline_parser.add_argument("--trace-memory", action="store_true", help = "Measure the peak allocated memory of every stage with tracemalloc")
+    pipeline_parser.set_defaults(run=run_pipeline)
+
+    startup_parser = subparsers.add_parser("startup", help = "Start-up and import time of main.py modes, and the heavy libraries they import")
+    startup_parser.add_argument("--query", type=str, default="astma", help = "Indication searched by the query scenario")
+    startup_parser.add_argument("--repeat", type=int, default=3, help = "Runs per scenario, the median is reported")
+    startup_parser.set_defaults(run=run_startup)
+
+    search_parser = subparsers.add_parser("search", help = "Latency of the indication search: sparse product against the inverted index")
+    search_parser.add_argument("-k", type=int, default=10, help = "Number of documents per query")
+    search_parser.add_argument("--queries", type=int, default=500, help = "Number of queries sampled from the corpus")
+    search_parser.add_argument("--max-terms", type=int, default=3, help = "Maximum number of terms per query")
+    search_parser.add_argument("--synthetic", type=int, help = "Benchmark a synthetic corpus with this many documents instead of the index")
+    search_parser.set_defaults(run=run_search)
+
+    concurrency_parser = subparsers.add_parser("concurrency", help = "Throughput under concurrent requests: one at a time, threads and the micro-batching asyncio API")
+    concurrency_parser.add_argument("--requests", type=int, default=1000, help = "Number of requests sampled from the index documents")
+    concurrency_parser.add_argument("--concurrency", type=int, default=32, help = "Number of clients sending requests at the same time")
+    concurrency_parser.add_argument("--max-batch-size", type=int, default=64, help = "Largest batch of the micro-batching API")
+    concurrency_parser.add_argument("--max-wait-ms", type=float, default=2.0, help = "Time a request waits for others to share its batch, in milliseconds")
+    concurrency_parser.add_argument("--similar", action="store_true", help = "Also benchmark similarity requests (loads the sentence encoder)")
+    concurrency_parser.add_argument("--encoder", type=str, default="torch", choices=["torch", "onnx", "onnx-int8"], help = "Sentence encoder backend of --similar")
+    concurrency_parser.set_defaults(run=run_concurrency)
+
+    cache_parser = subparsers.add_parser("cache", help = "Hit rate and latency of the search result cache on a stream of repeated queries")
+    cache_parser.add_argument("--requests", type=int, default=5000, help = "Number of searches in the stream")
+    cache_parser.add_argument("--queries", type=int, default=1000, help = "Number of distinct queries sampled from the index documents")
+    cache_parser.add_argument("--zipf", type=float, default=1.1, help = "Exponent of the Zipf distribution of the queries in the stream")
+    cache_parser.add_argument("--cache-size", type=int, default=10000, help = "Number of results kept in the cache")
+    cache_parser.set_defaults(run=run_cache)
+
+    args = parser.parse_args()
+    rows = args.run(args)
+    print_rows(rows)
+    if args.output:
+        write_rows(rows, args.output)
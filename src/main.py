@@ -1,57 +1,215 @@
 import os
-import fitz
-import spacy
-import re
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from datetime import datetime
-from utils_dataprep import read_documents, load_to_pd
-from utils_info_extract import extract_columns, apply_replacements
-from utils_data_cleaning import process_text_columns, convert_to_dict, capitalize_first_letter,convert_to_dict_new_file
-from utils_search_engine import prepare_tfidf_representation, search_product_by_indication
-from sentence_transformers import SentenceTransformer
-import numpy as np
-import faiss
-from utils_search_similar import process_new_files_similarity_sklad_only, process_new_files_similarity_only_wskazania, process_new_files_similarity
 import argparse
-
-pd.set_option('display.max_colwidth', None)
+import sys
+# Only the option choices are imported up front; the modules of every mode, and the heavy libraries
+# they need (spaCy, scikit-learn, PyMuPDF, sentence-transformers, FAISS), are imported in the branch that uses them.
+from utils_embedding_store import EMBEDDING_PRECISIONS
+from utils_faiss_index import FAISS_BACKENDS
+from utils_hybrid_search import FUSION_METHODS, parse_field_weights
+from utils_encoders import ENCODER_BACKENDS
+from utils_data_cleaning import capitalize_first_letter, configure_lemma_cache
+from utils_profiling import start_profiling
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 input_path = os.path.join(script_dir,'data')
+default_index_dir = os.path.join(script_dir, 'index')
 
 if __name__ == "__main__":
 
-    text_df = load_to_pd(input_path)
-    text_extracted = extract_columns(text_df, 'CHPCL') 
-    text_cleaned= process_text_columns(text_extracted)
-    
     parser = argparse.ArgumentParser(description = "Search for medicinal products or run similarity model.")
     parser.add_argument("-q", "--query", type=str, help = "Search for medicinal products by indication")
     parser.add_argument("-f", "--file", type=str, help = "Provide a INPUT PATH TO A FOLDER in order to list similar products`")
+    parser.add_argument("-Q", "--queries-file", type=str, help = "Search for many indications at once, one query per line of this file")
+    parser.add_argument("--output", type=str, help = "Write the results of --queries-file, or of -f in batch mode, to this file instead of stdout")
+    parser.add_argument("--format", type=str, default="csv", choices=["csv", "jsonl"], help = "Output format of --queries-file and of -f with --output")
+    parser.add_argument("--top-k", type=int, default=None, help = "Maximum number of results per query (default: all for -q, 10 for --queries-file, 150 per field for -f with --output)")
+    parser.add_argument("--scoring", type=str, default="tfidf", choices=["tfidf", "bm25"], help = "Scoring of -q and --queries-file: TF-IDF cosine similarity or BM25 (always uses the inverted index)")
+    parser.add_argument("--inverted-index", action="store_true", help = "Answer TF-IDF queries with the inverted index and early termination (same ranking)")
+    parser.add_argument("--index-dir", type=str, default=default_index_dir, help = "Folder where the corpus index is stored")
+    parser.add_argument("--ann-backend", type=str, default="flat", choices=FAISS_BACKENDS, help = "FAISS index used by -f: exact (flat), compressed exhaustive (fp16, sq8) or approximate (ivf, hnsw, pq, ivfpq)")
+    parser.add_argument("--encoder", type=str, default="torch", choices=ENCODER_BACKENDS, help = "Sentence encoder backend: PyTorch, or the ONNX export of the model in float32 or with int8 weights (see export-onnx)")
+    subparsers = parser.add_subparsers(dest="command")
+    parser.add_argument("--fusion", type=str, default="weighted", choices=FUSION_METHODS, help = "How -f combines the field scores of a document: weighted average or reciprocal rank fusion")
+    parser.add_argument("--profile", action="store_true", help = "Print the time, item count, throughput and memory of every pipeline stage to stderr at the end")
+    parser.add_argument("--profile-trace", type=str, help = "With --profile, also write the stages as a Chrome trace JSON file (chrome://tracing, Perfetto)")
+    parser.add_argument("--profile-stats", type=str, help = "With --profile, also run cProfile and write its statistics to this file")
+    parser.add_argument("--field-weights", type=parse_field_weights, default=None, help = "Weights of the -f fields, e.g. sklad=1,wskazania=1,tfidf=0.5 (default: sklad=1,wskazania=1)")
+    index_parser = subparsers.add_parser("index", help = "Manage the on-disk corpus index")
+    index_parser.add_argument("action", choices=["build", "update"], help = "build: read all PDFs from --input and write the index, update: only process added, changed and removed PDFs")
+    index_parser.add_argument("--input", type=str, default=input_path, help = "Folder with the SmPC PDF files")
+    index_parser.add_argument("--workers", type=int, default=None, help = "Number of processes reading PDF files (default: number of CPUs)")
+    index_parser.add_argument("--chunksize", type=int, default=16, help = "Number of PDF files sent to a worker process at once")
+    index_parser.add_argument("--batch-size", type=int, default=256, help = "Number of texts processed by spaCy at once")
+    index_parser.add_argument("--n-process", type=int, default=1, help = "Number of processes used by spaCy")
+    index_parser.add_argument("--embedding-precision", type=str, default=None, choices=EMBEDDING_PRECISIONS, help = "Storage precision of the embeddings: float32, float16 (half the size) or int8 (a quarter). Default: keep the stored precision, float32 for a new store")
+    index_parser.add_argument("--no-text-cache", action="store_true", help = "Render every PDF again instead of reusing the texts cached in text_cache.sqlite")
+    index_parser.add_argument("--embeddings", action="store_true", help = "Also compute the sentence embeddings used by -f (update refreshes them automatically once they exist)")
+    index_parser.add_argument("--shard", type=str, help = "Build or update only this shard of a sharded index from --input, e.g. one national registry; the other shards are not touched")
+    index_parser.add_argument("--shard-size", type=int, help = "Build a sharded index splitting --input into ranges of this many PDF files")
+    export_parser = subparsers.add_parser("export-onnx", help = "Export the sentence encoder to ONNX for --encoder onnx / onnx-int8")
+    export_parser.add_argument("--no-quantize", action="store_true", help = "Do not write the int8-quantized copy of the graph")
+    serve_parser = subparsers.add_parser("serve", help = "Keep the index and models loaded and answer queries over HTTP")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--no-similarity", action="store_true", help = "Only serve indication queries, without loading the sentence encoder")
+    serve_parser.add_argument("--intake-dir", type=str, help = "Folder whose files POST /similar may name with {\"path\": ...}; without it only uploaded PDF files are accepted")
+    serve_parser.add_argument("--max-upload-mb", type=float, default=50, help = "Answer POST /similar requests with a larger body with 413")
+    serve_parser.add_argument("--cache-size", type=int, default=10000, help = "Number of search results kept in the result cache, 0 disables it")
+    serve_parser.add_argument("--cache-ttl", type=float, help = "Drop cached search results after this many seconds (by default they stay until evicted or the index changes)")
+    serve_parser.add_argument("--reload-interval", type=float, help = "Check this often, in seconds, whether the index was rebuilt or updated and load the new version")
     args = parser.parse_args()
 
-if args.query:
-
-    list_of_docs = convert_to_dict(text_cleaned)
-    tfidf_vectorizer, tfidf_matrix = prepare_tfidf_representation(list_of_docs)
-    wskazania_pattern = args.query.lower() 
-    
-    matching_products = search_product_by_indication(wskazania_pattern, list_of_docs, tfidf_vectorizer, tfidf_matrix)
-    threashold = 0.0
-    filtered_products = [product for product in matching_products if product['score'] > threashold]
-    for product in filtered_products:
-        product_name_capitalized = capitalize_first_letter(product["product_name"])
-        print(f'{product["filename"]},"{product_name_capitalized}",{product["score"]:.3f}')
-        
-elif args.file:
-
-    list_of_docs = convert_to_dict_new_file(text_cleaned)
-    
-    model = SentenceTransformer('sdadas/st-polish-paraphrase-from-distilroberta')
-    process_new_files_similarity(args.file, list_of_docs, text_cleaned, model)
-    #process_new_files_similarity_sklad_only(args.file, list_of_docs, text_cleaned, model)
-    #process_new_files_similarity_only_wskazania(args.file, list_of_docs, text_cleaned, model)
-else:
-    print("Error")
\ No newline at end of file
+    if args.profile or args.profile_trace or args.profile_stats:
+        start_profiling(args.profile_trace, args.profile_stats)
+    configure_lemma_cache(os.path.join(args.index_dir, "lemma_cache.sqlite"))
+
+    if args.command == "index":
+        from utils_index import build_index, update_index, load_index, index_exists
+        from utils_embedding_store import EMBEDDING_FIELDS, embedding_store_exists, build_embedding_store
+        from utils_faiss_index import ensure_field_indexes
+        from utils_encoders import load_encoder, onnx_dir
+        from utils_shards import is_sharded, build_shard, build_range_shards, update_shards, shard_dir
+        if (args.shard or args.shard_size) and index_exists(args.index_dir):
+            parser.error(f"{args.index_dir} holds an unsharded index: build the shards in another --index-dir")
+        build_params = {"workers": args.workers, "chunksize": args.chunksize, "batch_size": args.batch_size,
+                        "n_process": args.n_process, "text_cache": not args.no_text_cache}
+        try:
+            if args.shard:
+                metas = {args.shard: build_shard(args.index_dir, args.shard, args.input, update=args.action == "update", **build_params)}
+            elif args.shard_size:
+                metas = build_range_shards(args.index_dir, args.input, args.shard_size, **build_params)
+            elif is_sharded(args.index_dir):
+                if args.action == "build":
+                    parser.error(f"{args.index_dir} holds a sharded index: build one shard with --shard, or use update to update all of them")
+                metas = update_shards(args.index_dir, **build_params)
+            elif args.action == "update":
+                metas = {None: update_index(args.input, args.index_dir, **build_params)}
+            else:
+                metas = {None: build_index(args.input, args.index_dir, **build_params)}
+        except ValueError as e:
+            parser.exit(1, f"Index not written: {e}\n")
+        model = None
+        for name, meta in metas.items():
+            directory = args.index_dir if name is None else shard_dir(args.index_dir, name)
+            print(f"Index {meta['index_version']} with {meta['n_documents']} documents written to {directory}")
+            if "changes" in meta:
+                print(", ".join(f"{key}: {value}" for key, value in meta["changes"].items()))
+            if "text_cache" in meta:
+                print("Text cache " + ", ".join(f"{key}: {value}" for key, value in meta["text_cache"].items()))
+            if args.embeddings or args.embedding_precision or (args.action == "update" and embedding_store_exists(directory)):
+                index = load_index(directory)
+                model = model or load_encoder(args.encoder, model_dir=onnx_dir(args.index_dir))
+                store = build_embedding_store(directory, index["documents"], model, precision=args.embedding_precision, encoder=args.encoder,
+                                              index_version=index["meta"]["index_version"])
+                ensure_field_indexes(directory, store, EMBEDDING_FIELDS, args.ann_backend)
+                print(f"Embeddings written to {directory}")
+
+    elif args.command == "serve":
+        from utils_server import SearchService, serve
+        from utils_index import index_exists
+        from utils_shards import is_sharded
+        if not index_exists(args.index_dir) and not is_sharded(args.index_dir):
+            print(f"No index found in {args.index_dir}. Run 'main.py index build' first.")
+        else:
+            service = SearchService(args.index_dir, not args.no_similarity, args.ann_backend, args.encoder,
+                                    args.cache_size, args.cache_ttl, args.reload_interval, args.scoring, args.inverted_index)
+            serve(service, args.host, args.port, args.intake_dir, int(args.max_upload_mb * 1024 * 1024))
+
+    elif args.command == "export-onnx":
+        from utils_encoders import export_onnx_encoder, onnx_dir
+        config = export_onnx_encoder(onnx_dir(args.index_dir), quantize=not args.no_quantize)
+        print(f"ONNX encoder of {config['model']} written to {onnx_dir(args.index_dir)}")
+
+    elif args.query or args.file or args.queries_file:
+        from utils_index import build_index, load_index, index_exists
+        from utils_inverted_index import corpus_inverted_index
+        from utils_shards import is_sharded, load_sharded_index
+        sharded = is_sharded(args.index_dir)
+        if not sharded and not index_exists(args.index_dir):
+            print(f"No index found in {args.index_dir}, building it from {input_path} (run 'main.py index build' to do it up front).")
+            build_index(input_path, args.index_dir)
+        if sharded:
+            # Queries are fanned out to the shards, which are weighted with the IDF of all of them
+            index = load_sharded_index(args.index_dir, "tfidf" if args.file else args.scoring)
+            inverted_index = None
+        else:
+            index = load_index(args.index_dir)
+            use_inverted_index = args.inverted_index or args.scoring == "bm25"
+            inverted_index = corpus_inverted_index(index, args.scoring) if use_inverted_index and not args.file else None
+
+        if args.queries_file:
+            from utils_search_engine import search_products_by_indications, write_search_results
+            from utils_inverted_index import search_products_by_indications_inverted
+            from utils_shards import search_products_by_indications_sharded
+
+            with open(args.queries_file, encoding="utf-8") as f:
+                queries = [line.strip() for line in f if line.strip()]
+            if sharded:
+                results = search_products_by_indications_sharded(queries, index, top_k=args.top_k or 10)
+            elif inverted_index is not None:
+                results = search_products_by_indications_inverted(queries, index["list_of_docs"], index["vectorizer"], inverted_index,
+                                                                  args.scoring, top_k=args.top_k or 10)
+            else:
+                results = search_products_by_indications(queries, index["list_of_docs"], index["vectorizer"], index["tfidf_matrix"],
+                                                         top_k=args.top_k or 10, tfidf_postings=index["tfidf_postings"])
+            if args.output:
+                with open(args.output, "w", encoding="utf-8", newline="") as output:
+                    write_search_results(results, output, args.format)
+            else:
+                write_search_results(results, sys.stdout, args.format)
+
+        elif args.query:
+            from utils_search_engine import search_product_by_indication
+            from utils_inverted_index import search_product_by_indication_inverted
+            from utils_shards import search_product_by_indication_sharded
+
+            list_of_docs = index["list_of_docs"]
+            tfidf_vectorizer, tfidf_matrix = index["vectorizer"], index.get("tfidf_matrix")
+            wskazania_pattern = args.query.lower()
+
+            threashold = 0.0
+            if sharded:
+                matching_products = search_product_by_indication_sharded(wskazania_pattern, index, top_k=args.top_k, min_score=threashold)
+            elif inverted_index is not None:
+                matching_products = search_product_by_indication_inverted(wskazania_pattern, list_of_docs, tfidf_vectorizer, inverted_index,
+                                                                          args.scoring, top_k=args.top_k, min_score=threashold)
+            else:
+                matching_products = search_product_by_indication(wskazania_pattern, list_of_docs, tfidf_vectorizer, tfidf_matrix,
+                                                                 top_k=args.top_k, min_score=threashold, tfidf_postings=index["tfidf_postings"])
+            for product in matching_products:
+                product_name_capitalized = capitalize_first_letter(product["product_name"])
+                print(f'{product["filename"]},"{product_name_capitalized}",{product["score"]:.3f}')
+
+        else:
+            from utils_embedding_store import EMBEDDING_FIELDS, ensure_embedding_store
+            from utils_faiss_index import ensure_field_indexes
+            from utils_encoders import load_encoder, onnx_dir
+            from utils_search_similar import process_new_files_similarity_sklad_only, process_new_files_similarity_only_wskazania, process_new_files_similarity, process_new_files_similarity_batch
+            from utils_shards import ensure_sharded_embeddings, sharded_tfidf_postings
+
+            list_of_docs = index["documents"]
+
+            model = load_encoder(args.encoder, model_dir=onnx_dir(args.index_dir))
+            if sharded:
+                embeddings, indexes = ensure_sharded_embeddings(index, model, EMBEDDING_FIELDS, args.ann_backend, args.encoder)
+                use_tfidf = (args.field_weights or {}).get('tfidf', 0) > 0
+                tfidf = (index["vectorizer"], sharded_tfidf_postings(index)) if use_tfidf else None
+            else:
+                embeddings = ensure_embedding_store(args.index_dir, list_of_docs, model, encoder=args.encoder,
+                                                    index_version=index["meta"]["index_version"])
+                indexes = ensure_field_indexes(args.index_dir, embeddings, EMBEDDING_FIELDS, args.ann_backend)
+                tfidf = (index["vectorizer"], index["tfidf_postings"])
+            if args.output:
+                # Batch mode: new files are streamed, deduplicated and written as structured results
+                with open(args.output, "w", encoding="utf-8", newline="") as output:
+                    count = process_new_files_similarity_batch(args.file, list_of_docs, model, output, args.format, embeddings,
+                                                               top_k=args.top_k or 150, indexes=indexes, weights=args.field_weights,
+                                                               fusion=args.fusion, tfidf=tfidf)
+                print(f"Results for {count} files written to {args.output}")
+            else:
+                process_new_files_similarity(args.file, list_of_docs, None, model, embeddings, indexes=indexes,
+                                             weights=args.field_weights, fusion=args.fusion, tfidf=tfidf)
+            #process_new_files_similarity_sklad_only(args.file, list_of_docs, None, model, embeddings, indexes=indexes)
+            #process_new_files_similarity_only_wskazania(args.file, list_of_docs, None, model, embeddings, indexes=indexes)
+    else:
+        print("Error")
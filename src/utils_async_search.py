@@ -0,0 +1,180 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    Coalesces the items submitted concurrently on an event loop into batches handled by one call of a function.
+
+    The first item of a batch waits at most max_wait seconds for other items to arrive; the batch is then
+    processed by `function` in a worker thread, so the event loop stays free while spaCy, scikit-learn or
+    FAISS run. Items arriving while a batch is processed are queued and form the next batch, so batches grow
+    with the load. The queue holds at most max_pending items: further submits wait for room (backpressure).
+
+    Args:
+    - function (callable): Takes a list of items and returns the list of their results, in order.
+    - max_batch_size (int): The largest number of items processed by one call.
+    - max_wait (float): The time in seconds a batch waits for more items once its first item arrived.
+    - max_pending (int): The largest number of queued items.
+    - executor (concurrent.futures.Executor, optional): Runs the function. Defaults to a single thread,
+      so batches of the same batcher never run concurrently.
+    """
+
+    def __init__(self, function, max_batch_size=64, max_wait=0.002, max_pending=1024, executor=None):
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="micro-batch")
+        self.batches = 0
+        self.items = 0
+        self._queue = None
+        self._task = None
+
+    def _start(self):
+        # The queue and the worker belong to the event loop of the first submit
+        self._queue = asyncio.Queue(self.max_pending)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item):
+        """
+        Queue an item and wait for its result. Exceptions raised by the function are raised to every item of the batch.
+        """
+        if self._task is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self.max_wait > 0 and self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            # Requests cancelled while waiting (e.g. a client that went away) are not processed
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.function, [item for item, _ in batch])
+            except asyncio.CancelledError:
+                # close() was called while the batch was processed: its requests are cancelled as the queued ones
+                for _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    def stats(self):
+        """
+        Return the number of "batches" and "items" processed and the "mean_batch_size".
+        """
+        return {"batches": self.batches, "items": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0}
+
+    async def close(self):
+        """
+        Stop the worker. Items still queued or being processed are cancelled.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            while not self._queue.empty():
+                self._queue.get_nowait()[1].cancel()
+            self._task = None
+
+
+class AsyncSearchService:
+    """
+    Asyncio interface of a SearchService for async web services: every call can be awaited without blocking
+    the event loop, and concurrent calls are answered together.
+
+    Indication searches arriving within max_wait of each other are lemmatized in one nlp.pipe pass and scored
+    with one sparse product (see SearchService.search_batch); the cleaned documents of concurrent similarity
+    requests are encoded with one model.encode call per field and searched with one index.search call per
+    FAISS index (see SearchService.similar_batch). PDF reading and cleaning runs in a thread pool.
+
+    Args:
+    - service (SearchService): The loaded index, spaCy and (optionally) sentence encoder.
+    - max_batch_size (int): The largest number of searches, or of similarity requests, answered together.
+    - max_wait (float): The time in seconds a request waits for other requests to share its batch.
+    - max_concurrency (int): The largest number of requests handled at once; more requests wait for their turn.
+    - workers (int): The number of threads reading and cleaning uploaded PDF files.
+    """
+
+    def __init__(self, service, max_batch_size=64, max_wait=0.002, max_concurrency=256, workers=2):
+        self.service = service
+        self.max_concurrency = max_concurrency
+        self.search_batcher = MicroBatcher(service.search_batch, max_batch_size, max_wait, max_concurrency)
+        self.similar_batcher = MicroBatcher(service.similar_batch, max_batch_size, max_wait, max_concurrency)
+        self.read_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-read")
+        self._semaphore = None
+
+    def _slot(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def info(self):
+        """
+        Return the version and size of the loaded index, see SearchService.info.
+        """
+        return self.service.info()
+
+    async def search(self, query, top_k=None, min_score=0.0):
+        """
+        Search products by indication, see SearchService.search.
+        """
+        async with self._slot():
+            return await self.search_batcher.submit((query, top_k, min_score))
+
+    async def similar_documents(self, new_docs, top_k=150, min_score=0.0):
+        """
+        Find the products most similar to already cleaned documents, see SearchService.similar_batch.
+
+        Args:
+        - new_docs (list of dict): The documents, with the keys "filename", "nazwa", "sklad" and "wskazania".
+        - top_k (int): The number of most similar documents retrieved per field.
+        - min_score (float): Only return products scoring above this value.
+
+        Returns:
+        - list of dict: One entry per new document with its 'filename' and the list of 'results'.
+        """
+        async with self._slot():
+            return await self.similar_batcher.submit((new_docs, top_k, min_score))
+
+    async def similar_to_pdf(self, content, top_k=150, min_score=0.0):
+        """
+        Find the products most similar to an uploaded PDF document, see SearchService.similar_to_pdf.
+        """
+        async with self._slot():
+            new_docs = await asyncio.get_running_loop().run_in_executor(self.read_executor, self.service.read_pdf, content)
+            return await self.similar_batcher.submit((new_docs, top_k, min_score))
+
+    def stats(self):
+        """
+        Return the batching statistics of the "search" and "similar" requests, see MicroBatcher.stats.
+        """
+        return {"search": self.search_batcher.stats(), "similar": self.similar_batcher.stats()}
+
+    async def close(self):
+        """
+        Stop the batchers and the PDF reading threads.
+        """
+        await self.search_batcher.close()
+        await self.similar_batcher.close()
+        self.read_executor.shutdown(wait=False)
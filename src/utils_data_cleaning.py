@@ -1,10 +1,79 @@
-import spacy
 import re
-import pandas as pd
+import hashlib
+import itertools
+import operator
 from datetime import datetime
+from importlib import metadata
 import os
+from utils_lemma_cache import LemmaCache
+from utils_profiling import profile_iter, profile_stage
 
-nlp = spacy.load("pl_core_news_lg")
+SPACY_MODEL = "pl_core_news_lg"
+
+# Loaded by get_nlp on first use, so importing this module does not load spaCy
+nlp = None
+
+
+def get_nlp():
+    """
+    Return the spaCy pipeline, loading it on the first call.
+    """
+    global nlp
+    if nlp is None:
+        with profile_stage("spacy_load"):
+            import spacy
+            nlp = spacy.load(SPACY_MODEL)
+    return nlp
+
+# Components not needed for tokens, lemmas and POS tags
+UNUSED_COMPONENTS = ["parser", "ner"]
+
+
+def unused_components():
+    """
+    Return the names of the loaded pipeline components that can be disabled for lemmatization.
+    """
+    return [name for name in UNUSED_COMPONENTS if name in get_nlp().pipe_names]
+
+
+def _package_version(name):
+    """
+    Return the installed version of a package, or None if it is not installed.
+    """
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def spacy_model_id():
+    """
+    Return an identifier of the spaCy model and its version, used to invalidate cached lemmas.
+
+    Versions are read from the package metadata, so cached lemmas are checked without importing spaCy.
+    """
+    return f"{SPACY_MODEL}-{_package_version(SPACY_MODEL)}-spacy-{_package_version('spacy')}"
+
+
+lemma_cache = LemmaCache(model_id=spacy_model_id())
+
+
+def configure_lemma_cache(path=None, maxsize=50000):
+    """
+    Replace the lemma cache used by lemmatize_text and process_text_columns.
+
+    Args:
+    - path (str, optional): The path to an SQLite file persisting the cache between runs.
+      Without it the cache is kept in memory only.
+    - maxsize (int): The maximum number of entries kept in memory.
+
+    Returns:
+    - LemmaCache: The new cache.
+    """
+    global lemma_cache
+    lemma_cache.close()
+    lemma_cache = LemmaCache(maxsize=maxsize, path=path, model_id=spacy_model_id())
+    return lemma_cache
 
 
 def clean_formatting(text):
@@ -62,10 +131,27 @@ def tokenize_text(text):
     Returns:
     - list: A list of tokenized words.
     """
-    doc = nlp(text)
+    doc = get_nlp().make_doc(text)
     tokens = [token.text for token in doc]
     return tokens
 
+def lemmatize_texts(texts, batch_size=256, n_process=1):
+    """
+    Lemmatize many texts like lemmatize_text, in a single nlp.pipe pass.
+
+    Args:
+    - texts (iterable of str): The texts to be lemmatized.
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - n_process (int): The number of processes used by nlp.pipe.
+
+    Returns:
+    - list of str: The lemmatized texts, in input order.
+    """
+    def noun_lemmas(doc):
+        return " ".join(token.lemma_ for token in doc if token.pos_ == "NOUN")
+
+    return list(pipe_with_cache(texts, "lemma\x1f", noun_lemmas, batch_size, n_process))
+
 def lemmatize_text(text):
     """
     Lemmatize the input text using a specified spaCy language model.
@@ -76,40 +162,111 @@ def lemmatize_text(text):
     Returns:
     - str: The lemmatized text.
     """
-    doc = nlp(text)  
-    lemmatized_text = " ".join(token.lemma_ for token in doc if token.pos_ == "NOUN" )  
+    key = "lemma\x1f" + text
+    lemmatized_text = lemma_cache.get(key)
+    if lemmatized_text is None:
+        doc = get_nlp()(text, disable=unused_components())
+        lemmatized_text = " ".join(token.lemma_ for token in doc if token.pos_ == "NOUN" )  
+        lemma_cache.set(key, lemmatized_text)
+        lemma_cache.flush()
     return lemmatized_text
 
 
-def process_text_columns(df):
+def preprocess_texts(texts, specified_words_to_remove, lemmatize=True, batch_size=256, n_process=1):
     """
-    Preprocess text data in specified DataFrame columns.
+    Clean, tokenize, remove stop words, optionally lemmatize nouns and remove duplicated words
+    for a sequence of texts, streaming them through spaCy in batches.
 
     Args:
-    - df (DataFrame): The input DataFrame containing text columns to be processed.
+    - texts (iterable of str): The texts to be processed.
+    - specified_words_to_remove (list): A list of stop words to be removed from the texts.
+    - lemmatize (bool): Keep only the lemmas of nouns (True) or all remaining tokens (False).
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - n_process (int): The number of processes used by nlp.pipe.
 
     Returns:
-    - DataFrame: The DataFrame with processed text columns.
+    - generator of str: The processed texts, in input order.
 
-    The function iterates over specified columns ('nazwa', 'sklad', 'wskazania') in the DataFrame and performs the following preprocessing steps:
-    - For the 'nazwa' column:
-        - Clean the text formatting.
-        - Remove specified stop words.
-        - Remove duplicated words.
-    - For the 'sklad' column:
-        - Clean the text formatting.
-        - Remove specified stop words.
-        - Lemmatize the text.
-        - Remove duplicated words.
-    - For the 'wskazania' column:
-        - Clean the text formatting.
-        - Remove specified stop words.
-        - Lemmatize the text.
-        - Remove duplicated words.
+    Stop words are removed from the tokens and the nouns are then tagged and lemmatized in the filtered
+    text, like the original one-text-at-a-time pipeline, with one nlp.pipe pass over all texts and the
+    parser and NER disabled. When lemmatize is False only the tokenizer is run.
 
-    The stop words and text cleaning operations are customized for each column to ensure appropriate preprocessing based on the nature of the text data in each column.
+    Lemmatized results are looked up in the lemma cache first (keyed on the cleaned text and the stop
+    word list), so only texts not seen before are sent to spaCy.
+    """
+    stop_words = set(specified_words_to_remove)
+    cleaned_texts = profile_iter("clean_formatting", (clean_formatting(text) for text in texts))
+
+    def remove_stop_words_from(doc):
+        return ' '.join(token.text for token in doc if token.text not in stop_words)
+
+    if not lemmatize:
+        for doc in profile_iter("spacy_tokenize", get_nlp().tokenizer.pipe(cleaned_texts, batch_size=batch_size)):
+            yield remove_duplicated_words(remove_stop_words_from(doc))
+        return
+
+    prefix = "filtered:" + hashlib.sha1("\x1f".join(sorted(stop_words)).encode("utf-8")).hexdigest()[:16] + "\x1f"
+
+    def filtered_text(text):
+        return remove_stop_words_from(get_nlp().tokenizer(text))
+
+    def noun_lemmas(doc):
+        return remove_duplicated_words(' '.join(token.lemma_ for token in doc if token.pos_ == "NOUN"))
+
+    yield from pipe_with_cache(cleaned_texts, prefix, noun_lemmas, batch_size, n_process, prepare=filtered_text)
+
+
+def pipe_with_cache(texts, key_prefix, process_doc, batch_size=256, n_process=1, prepare=None):
+    """
+    Stream texts through nlp.pipe, skipping the ones whose result is already in the lemma cache.
+
+    Args:
+    - texts (iterable of str): The texts to be processed.
+    - key_prefix (str): Prefix of the cache keys, identifying how the results were produced.
+    - process_doc (callable): Function turning a spaCy Doc into the cached result string.
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - n_process (int): The number of processes used by nlp.pipe.
+    - prepare (callable, optional): Function turning a text that is not cached into the text sent to spaCy.
+      The cache stays keyed on the original text.
+
+    Returns:
+    - generator of str: The results, in input order.
+
+    Texts are read one batch at a time (batch_size texts per process): the cached results of a batch are
+    looked up as soon as it is read and only its misses are sent to spaCy, so at most one batch of texts
+    and results is held in memory however long the stream is and however many of its texts are cached.
+    With n_process > 1, nlp.pipe starts its worker processes for every batch with misses.
+    """
+    texts = iter(texts)
+    read_size = batch_size * max(n_process, 1)
+    while True:
+        batch = list(itertools.islice(texts, read_size))
+        if not batch:
+            return
+        keys = [key_prefix + text for text in batch]
+        with profile_stage("lemma_cache_lookup", len(batch)):
+            results = [lemma_cache.get(key) for key in keys]
+        misses = [row for row, result in enumerate(results) if result is None]
+        if misses:
+            # spaCy is only loaded when a text is not cached
+            to_parse = (batch[row] if prepare is None else prepare(batch[row]) for row in misses)
+            docs = get_nlp().pipe(to_parse, batch_size=batch_size, n_process=n_process if len(misses) > batch_size else 1,
+                                  disable=unused_components())
+            for row, doc in zip(misses, profile_iter("spacy_lemmatize", docs)):
+                results[row] = process_doc(doc)
+                lemma_cache.set(keys[row], results[row])
+            # Keeps the entries waiting to be written to disk bounded on long streams
+            lemma_cache.flush()
+        yield from results
+
+
+def column_stop_words():
+    """
+    Return the stop words removed from each of the 'nazwa', 'sklad' and 'wskazania' sections.
+
+    Returns:
+    - dict: Mapping of each column to its list of stop words.
     """
-    columns_to_process = ['nazwa', 'sklad', 'wskazania']
     stop_words_nazwa = ['nazwa', 'produktu', 'leczniczego', 'mg', 'ithib', 'charakterystyka', 'roztwór', 'aerozol', 'tabletka', 'kapsułka', 'tabletki', 'inhalacyjny', 'lek', 'wstrzykiwań', 'powlekana',\
                 'powlekany', 'powlekane', 'kapsułki', 'twarde', 'twarda', 'ampułkostrzykawce','ampułkostrzykawka', 'infuzji', 'żel', 'żucia', "proszek", 'sporządzania','mgg', 'koncentrat', "mgml", "ml", "jm", \
                  "summary", "of" , "product", "characteristics", "rozpuszczalnik", "roztworu", "dojelitowe", "przedłużonym", "uwalnianiu", "krople", "nos", "nosa", "dawka", "dawkę", \
@@ -139,32 +296,78 @@ def process_text_columns(df):
                         "alkohol cetostearylowy", "kwas sorbowy", "ampułka", "j.m.", "ml", "aktywności", "wody", "otrzymywaną", "wyniku", "tabletka dojelitowa", "elastyczna", "lecytyna sojowa", \
                         "postać farmaceutyczna", "wymiary", "żelatynowej", "meql", "infuzji", "postaci", "przypadku", "zasobnik", "zasobnika", "ilość", "inhalator", "inhalatora"]
     
+    return {'nazwa': stop_words_nazwa, 'sklad': stop_words_sklad, 'wskazania': stop_words_wskazania}
+
+
+def process_text_columns(df, batch_size=256, n_process=1):
+    """
+    Preprocess text data in specified DataFrame columns.
+
+    Args:
+    - df (DataFrame): The input DataFrame containing text columns to be processed.
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - n_process (int): The number of processes used by spaCy.
+
+    Returns:
+    - DataFrame: The DataFrame with processed text columns.
+
+    The function iterates over specified columns ('nazwa', 'sklad', 'wskazania') in the DataFrame and performs the following preprocessing steps:
+    - For the 'nazwa' column:
+        - Clean the text formatting.
+        - Remove specified stop words.
+        - Remove duplicated words.
+    - For the 'sklad' column:
+        - Clean the text formatting.
+        - Remove specified stop words.
+        - Lemmatize the text.
+        - Remove duplicated words.
+    - For the 'wskazania' column:
+        - Clean the text formatting.
+        - Remove specified stop words.
+        - Lemmatize the text.
+        - Remove duplicated words.
+
+    The stop words and text cleaning operations are customized for each column to ensure appropriate preprocessing based on the nature of the text data in each column.
+    Each column is streamed through preprocess_texts, so spaCy runs once per cell in batches.
+    """
+    columns_to_process = ['nazwa', 'sklad', 'wskazania']
+    stop_words = column_stop_words()
+
     for column in columns_to_process:
-        if column == 'nazwa':
-            df.loc[:, column] = df[column].apply(clean_formatting)
-            df.loc[:, column] = df[column].apply(tokenize_text)
-            df.loc[:, column] = df[column].apply(remove_stop_words, specified_words_to_remove=stop_words_nazwa)
-           
-            df.loc[:, column] = df[column].apply(remove_duplicated_words)
-
-
-        elif column == 'sklad':
-            df.loc[:, column] = df[column].apply(clean_formatting)
-            df.loc[:, column] = df[column].apply(tokenize_text)
-            df.loc[:, column] = df[column].apply(remove_stop_words, specified_words_to_remove=stop_words_sklad)
-            df.loc[:, column] = df[column].apply(lemmatize_text)
-            df.loc[:, column] = df[column].apply(remove_duplicated_words)
-            
-        
-        elif column == 'wskazania':
-            df.loc[:, column] = df[column].apply(clean_formatting)
-            df.loc[:, column] = df[column].apply(tokenize_text)
-            df.loc[:, column] = df[column].apply(remove_stop_words, specified_words_to_remove=stop_words_wskazania)
-            df.loc[:, column] = df[column].apply(lemmatize_text)
-            df.loc[:, column] = df[column].apply(remove_duplicated_words)
+        processed = profile_iter(f"preprocess_{column}", preprocess_texts(df[column], stop_words[column], lemmatize=column != 'nazwa',
+                                                                          batch_size=batch_size, n_process=n_process))
+        df.loc[:, column] = list(processed)
     
     return df
 
+def process_documents(documents, batch_size=256, n_process=1):
+    """
+    Preprocess the 'nazwa', 'sklad' and 'wskazania' sections of a stream of documents, like process_text_columns.
+
+    Args:
+    - documents (iterable of dict): Documents with the keys 'filename', 'nazwa', 'sklad' and 'wskazania',
+      e.g. from iter_sections.
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - n_process (int): The number of processes used by spaCy.
+
+    Returns:
+    - generator of dict: The documents with processed sections, in input order.
+
+    Every section is streamed through its own preprocess_texts generator and the three are consumed in
+    step, so only the documents inside the current spaCy batches are held in memory.
+    """
+    stop_words = column_stop_words()
+    columns = ['nazwa', 'sklad', 'wskazania']
+    documents, *column_streams = itertools.tee(documents, len(columns) + 1)
+    processed = [profile_iter(f"preprocess_{column}", preprocess_texts(map(operator.itemgetter(column), stream), stop_words[column],
+                                                                       lemmatize=column != 'nazwa', batch_size=batch_size,
+                                                                       n_process=n_process))
+                 for column, stream in zip(columns, column_streams)]
+    for doc, nazwa, sklad, wskazania in zip(documents, *processed):
+        yield {'filename': doc['filename'], 'nazwa': nazwa, 'sklad': sklad, 'wskazania': wskazania}
+    # zip stops before the section generators reach their own final flush
+    lemma_cache.flush()
+
 def convert_to_dict(df):
     """
     Convert DataFrame rows into a list of dictionaries representing documents.
@@ -1,54 +1,223 @@
-import fitz
 import re
-import spacy
 import os
-import pandas as pd
+import sys
+import hashlib
+from collections import deque
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor
+from utils_text_cache import text_cache_key
+from utils_profiling import profile_iter, profile_stage
 
-import os
-import fitz
+# Only the first pages hold the sections used by the search; the footer of every page is cut off
+MAX_PAGES = 4
+FOOTER_HEIGHT = 80
+
+
+def extractor_id():
+    """
+    Return an identifier of the PDF library and its version, used to invalidate cached texts.
+
+    The version is read from the package metadata, so a build served from the text cache does not import PyMuPDF.
+    """
+    return f"pymupdf-{metadata.version('pymupdf')}"
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 hash of a file's content.
+
+    Args:
+    - file_path (str): The path to the file.
+    - chunk_size (int): The number of bytes read at once.
+
+    Returns:
+    - str: The hexadecimal digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_document(file_path, max_pages=MAX_PAGES, footer=FOOTER_HEIGHT):
+    """
+    Read text content from the first four pages of a single PDF document.
+
+    Args:
+    - file_path (str): The path to the PDF document.
+    - max_pages (int): The number of pages read from the start of the document.
+    - footer (int): The height of the footer cut from every page, in points.
+
+    Returns:
+    - combined_text (str): The combined text content of the first pages (four by default), without the footer (80pt by default).
+      Pages that cannot be read are skipped; errors opening the document itself are raised.
+    """
+    import fitz
+
+    with fitz.open(file_path) as pdf:
+        combined_text = ""
+        for page_number in range(min(max_pages, pdf.page_count)):
+            try:
+                page = pdf.load_page(page_number)
+                page_text = page.get_text("text", clip=(0, 0, page.rect.width, page.rect.height - footer))
+                combined_text += page_text + " "
+            except Exception as e:
+                pass 
+        combined_text = combined_text.replace("\n", "")
+    return combined_text
+
+
+def _read_document_safe(file_path, max_pages=MAX_PAGES, footer=FOOTER_HEIGHT):
+    """
+    Read a single PDF document, returning the error message instead of raising (used by worker processes).
+    """
+    try:
+        return read_document(file_path, max_pages, footer), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _read_chunk(file_paths, max_pages=MAX_PAGES, footer=FOOTER_HEIGHT):
+    """
+    Read a chunk of PDF documents in a worker process.
+    """
+    return [_read_document_safe(file_path, max_pages, footer) for file_path in file_paths]
 
-def read_documents(input_path):
+
+def pdf_filenames(input_path, filenames=None):
+    """
+    Return the sorted names of the PDF files to read from a folder.
+
+    Args:
+    - input_path (str): The path to the folder containing the PDF documents.
+    - filenames (list, optional): Only keep these files. By default all PDF files in the folder are returned.
+
+    Returns:
+    - list of str: The PDF filenames, sorted to ensure a consistent order.
+    """
+    selected = os.listdir(input_path) if filenames is None else filenames
+    return [filename for filename in sorted(selected) if filename.endswith('.pdf')]
+
+
+def iter_documents(input_path, filenames=None, workers=None, chunksize=16, max_pending=None,
+                   text_cache=None, hashes=None, max_pages=MAX_PAGES, footer=FOOTER_HEIGHT):
+    """
+    Read the first four pages of each PDF document in the folder, yielding documents as they are read.
+
+    Args:
+    - input_path (str): The path to the folder containing the PDF documents.
+    - filenames (list, optional): Only read these files from the folder. By default all PDF files are read.
+    - workers (int, optional): The number of worker processes. Defaults to the number of CPUs; 1 reads
+      the files in the current process.
+    - chunksize (int): The number of files sent to a worker process at once.
+    - max_pending (int, optional): The maximum number of chunks being read or waiting to be consumed.
+      Defaults to twice the number of workers.
+    - text_cache (TextCache, optional): Cache of extracted texts. Cached files are not opened, the texts
+      of the others are added to it.
+    - hashes (dict, optional): The SHA-256 hash of each file, e.g. from the index manifest. Files without
+      a hash are hashed when a text cache is used.
+    - max_pages (int): The number of pages read from the start of every document.
+    - footer (int): The height of the footer cut from every page, in points.
+
+    Returns:
+    - generator of tuple: (filename, combined text) per document, in sorted filename order.
+
+    New chunks are only submitted to the workers as the caller consumes documents, so at most
+    max_pending * chunksize texts are held in memory however many files the folder contains.
+    Files that cannot be read are skipped and reported on stderr.
+    """
+    documents = _iter_documents(input_path, filenames, workers, chunksize, max_pending, text_cache, hashes, max_pages, footer)
+    return profile_iter("read_pdf", documents)
+
+
+def _iter_documents(input_path, filenames, workers, chunksize, max_pending, text_cache, hashes, max_pages, footer):
+    if not os.path.isdir(input_path):
+        print("Invalid input path. Please provide a valid folder path.")
+        return
+    pdf_files = pdf_filenames(input_path, filenames)
+    file_paths = [os.path.join(input_path, filename) for filename in pdf_files]
+    workers = min(workers or os.cpu_count() or 1, max(len(file_paths), 1))
+    hashes = hashes or {}
+
+    def lookup(chunk_files, chunk_paths):
+        # Returns the cache keys and cached texts of a chunk, and the positions of the files to read
+        if text_cache is None:
+            return [None] * len(chunk_files), [None] * len(chunk_files), list(range(len(chunk_files)))
+        with profile_stage("text_cache_lookup", len(chunk_files)):
+            keys = [text_cache_key(hashes.get(filename) or file_hash(file_path), max_pages, footer)
+                    for filename, file_path in zip(chunk_files, chunk_paths)]
+            texts = [text_cache.get(key) for key in keys]
+        return keys, texts, [i for i, text in enumerate(texts) if text is None]
+
+    def complete(chunk_files, keys, texts, missing, results):
+        for i, (combined_text, error) in zip(missing, results):
+            if error is not None:
+                print(f"Could not read {chunk_files[i]}: {error}", file=sys.stderr)
+                continue
+            texts[i] = combined_text
+            if keys[i] is not None:
+                text_cache.set(keys[i], combined_text)
+        if text_cache is not None:
+            text_cache.flush()
+        return [(filename, text) for filename, text in zip(chunk_files, texts) if text is not None]
+
+    chunks = [(pdf_files[i:i + chunksize], file_paths[i:i + chunksize]) for i in range(0, len(file_paths), chunksize)]
+
+    if workers <= 1:
+        for chunk_files, chunk_paths in chunks:
+            keys, texts, missing = lookup(chunk_files, chunk_paths)
+            results = _read_chunk([chunk_paths[i] for i in missing], max_pages, footer)
+            yield from complete(chunk_files, keys, texts, missing, results)
+        return
+
+    max_pending = max_pending or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        next_chunk = 0
+        while pending or next_chunk < len(chunks):
+            while next_chunk < len(chunks) and len(pending) < max_pending:
+                chunk_files, chunk_paths = chunks[next_chunk]
+                keys, texts, missing = lookup(chunk_files, chunk_paths)
+                # Fully cached chunks are not sent to the workers
+                future = executor.submit(_read_chunk, [chunk_paths[i] for i in missing], max_pages, footer) if missing else None
+                pending.append((chunk_files, keys, texts, missing, future))
+                next_chunk += 1
+            chunk_files, keys, texts, missing, future = pending.popleft()
+            results = future.result() if future is not None else []
+            yield from complete(chunk_files, keys, texts, missing, results)
+
+
+def read_documents(input_path, filenames=None, workers=None, chunksize=16):
     """
     Read text content from the first four pages of each PDF document in the specified folder.
 
     Args:
     - input_path (str): The path to the folder containing the PDF documents.
+    - filenames (list, optional): Only read these files from the folder. By default all PDF files are read.
+    - workers (int, optional): The number of worker processes. Defaults to the number of CPUs; 1 reads
+      the files in the current process.
+    - chunksize (int): The number of files sent to a worker process at once.
 
     Returns:
     - documents (list): A list of lists, where each inner list contains the filename
       and "CHCPL" - the combined text content of the first four pages of the corresponding PDF document.
+
+    Documents are returned in sorted filename order regardless of the number of workers. Files that
+    cannot be read are skipped and reported on stderr. See iter_documents to process them one by one.
     """
-    documents = []
-    if os.path.isdir(input_path):
-        for filename in sorted(os.listdir(input_path)):  # Sort to ensure consistent order
-            file_path = os.path.join(input_path, filename)
-            if filename.endswith('.pdf'):
-                try:
-                    with fitz.open(file_path) as pdf:
-                        combined_text = ""
-                        for page_number in range(min(4, pdf.page_count)):
-                            try:
-                                page = pdf.load_page(page_number)
-                                footer = 80  
-                                page_text = page.get_text("text", clip=(0, 0, page.rect.width, page.rect.height - footer))
-                                combined_text += page_text + " "
-                            except Exception as e:
-                                pass 
-                        combined_text = combined_text.replace("\n", "")
-                        documents.append([filename, combined_text])
-                except Exception as e:
-                    pass 
-    else:
-        print("Invalid input path. Please provide a valid folder path.")
-    return documents
+    return [[filename, combined_text] for filename, combined_text in iter_documents(input_path, filenames, workers, chunksize)]
 
 
-def load_to_pd(input_path):
+def load_to_pd(input_path, filenames=None, workers=None, chunksize=16):
     """
     Load text data from PDF documents in the specified folder into a pandas DataFrame.
 
     Args:
     - input_folder (str): The path to the folder containing the PDF documents.
+    - filenames (list, optional): Only load these files from the folder. By default all PDF files are loaded.
+    - workers (int, optional): The number of worker processes used by read_documents.
+    - chunksize (int): The number of files sent to a worker process at once.
 
     Returns:
     - text_df (DataFrame): A pandas DataFrame containing the text data from the PDF documents.
@@ -57,7 +226,9 @@ def load_to_pd(input_path):
       of the first four pages of the PDF.
 
     """
-    text = read_documents(input_path)
+    import pandas as pd
+
+    text = read_documents(input_path, filenames, workers, chunksize)
     text_df = pd.DataFrame(text)
     current_columns = text_df.columns
     new_columns = [f"column{i+1}" for i in range(len(current_columns))]
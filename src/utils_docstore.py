@@ -0,0 +1,176 @@
+import os
+import sys
+import numpy as np
+from array import array
+from collections.abc import Mapping
+
+DOCSTORE_TEXT_FILE = "docstore.bin"
+DOCSTORE_OFFSETS_FILE = "docstore_offsets.npy"
+
+DOCSTORE_FIELDS = ['filename', 'nazwa', 'sklad', 'wskazania']
+
+
+def write_document_store(index_dir, documents):
+    """
+    Write documents to the packed document store one at a time, yielding each document once it is written.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - documents (iterable of dict): The documents, with the keys in DOCSTORE_FIELDS.
+
+    Returns:
+    - generator of dict: The written documents. The store is complete once the generator is exhausted.
+
+    The store consists of two files: docstore.bin holds the UTF-8 encoded fields of all documents back to
+    back, and docstore_offsets.npy holds, for every document, the byte offset at which each of its fields
+    starts followed by the offset at which the document ends.
+    """
+    offsets = array("q")
+    position = 0
+    text_path = os.path.join(index_dir, DOCSTORE_TEXT_FILE)
+    with open(text_path + ".tmp", "wb") as f:
+        for doc in documents:
+            for field in DOCSTORE_FIELDS:
+                encoded = doc[field].encode("utf-8")
+                offsets.append(position)
+                f.write(encoded)
+                position += len(encoded)
+            offsets.append(position)
+            yield doc
+    offsets = np.frombuffer(offsets, dtype=np.int64).reshape(-1, len(DOCSTORE_FIELDS) + 1)
+    offsets_path = os.path.join(index_dir, DOCSTORE_OFFSETS_FILE)
+    with open(offsets_path + ".tmp", "wb") as f:
+        np.save(f, offsets)
+    # Replace the files only once both are complete, readers may still map the previous version
+    os.replace(text_path + ".tmp", text_path)
+    os.replace(offsets_path + ".tmp", offsets_path)
+
+
+def load_document_store(index_dir, created=None):
+    """
+    Open the document store of an index folder without reading it.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - created (datetime, optional): The time the index was written, returned as the documents' "timestamp".
+
+    Returns:
+    - DocumentStore: The memory-mapped documents.
+    """
+    offsets = np.load(os.path.join(index_dir, DOCSTORE_OFFSETS_FILE), mmap_mode="r")
+    text_path = os.path.join(index_dir, DOCSTORE_TEXT_FILE)
+    # np.memmap cannot map an empty file
+    text = np.memmap(text_path, dtype=np.uint8, mode="r") if os.path.getsize(text_path) else np.zeros(0, dtype=np.uint8)
+    return DocumentStore(text, offsets, created)
+
+
+class DocumentStore:
+    """
+    Read-only sequence of documents backed by the packed files written by write_document_store.
+
+    Fields are decoded from the memory-mapped text only when they are accessed, so opening the store
+    costs the same for any number of documents and untouched fields never take memory.
+    Indexing the store returns a DocumentRecord, which can be used wherever the dictionaries of
+    convert_to_dict ('title', 'text', 'filename', 'timestamp') or convert_to_dict_new_file
+    ('filename', 'nazwa', 'sklad', 'wskazania') were used.
+
+    Args:
+    - text (numpy.ndarray): The bytes of docstore.bin.
+    - offsets (numpy.ndarray): The field offsets of every document, as written to docstore_offsets.npy.
+    - created (datetime, optional): The time the index was written.
+    """
+
+    def __init__(self, text, offsets, created=None):
+        self.text = text
+        self.offsets = offsets
+        self.created = created
+        self._filenames = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("document index out of range")
+        return DocumentRecord(self, position)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield DocumentRecord(self, position)
+
+    def field(self, position, field):
+        """
+        Decode one field ('filename', 'nazwa', 'sklad' or 'wskazania') of the document at the given position.
+        """
+        column = DOCSTORE_FIELDS.index(field)
+        start, end = self.offsets[position, column], self.offsets[position, column + 1]
+        return self.text[start:end].tobytes().decode("utf-8")
+
+    def column(self, field):
+        """
+        Decode one field of every document.
+
+        Returns:
+        - list of str: The field of each document, in store order.
+        """
+        if field == 'filename':
+            return list(self.filenames)
+        return [self.field(position, field) for position in range(len(self))]
+
+    def filename(self, position):
+        """
+        Return the filename of the document at the given position.
+        """
+        if self._filenames is not None:
+            return self._filenames[position]
+        return self.field(position, 'filename')
+
+    @property
+    def filenames(self):
+        """
+        The filenames of all documents, decoded once and interned.
+        """
+        if self._filenames is None:
+            self._filenames = [sys.intern(self.field(position, 'filename')) for position in range(len(self))]
+        return self._filenames
+
+
+class DocumentRecord(Mapping):
+    """
+    A document of a DocumentStore, read like a dictionary. Fields are decoded on access.
+
+    Keys: 'filename', 'nazwa', 'sklad', 'wskazania', and the convert_to_dict names 'title' (the 'nazwa' field),
+    'text' ('sklad' and 'wskazania' separated by a space) and 'timestamp' (the time the index was written).
+    """
+
+    __slots__ = ("store", "position")
+
+    KEYS = ('filename', 'nazwa', 'sklad', 'wskazania', 'title', 'text', 'timestamp')
+
+    def __init__(self, store, position):
+        self.store = store
+        self.position = position
+
+    def __getitem__(self, key):
+        if key == 'filename':
+            return self.store.filename(self.position)
+        if key in ('nazwa', 'sklad', 'wskazania'):
+            return self.store.field(self.position, key)
+        if key == 'title':
+            return self.store.field(self.position, 'nazwa')
+        if key == 'text':
+            return self.store.field(self.position, 'sklad') + " " + self.store.field(self.position, 'wskazania')
+        if key == 'timestamp':
+            return self.store.created
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return f"DocumentRecord({self.position}, {self['filename']!r})"
@@ -0,0 +1,301 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from utils_profiling import profile_stage
+
+EMBEDDING_MODEL = 'sdadas/st-polish-paraphrase-from-distilroberta'
+EMBEDDING_FIELDS = ['sklad', 'wskazania']
+EMBEDDING_PRECISIONS = ["float32", "float16", "int8"]
+
+EMBEDDINGS_META_FILE = "embeddings.json"
+
+
+def embeddings_file(field):
+    """
+    Return the name of the file holding the embeddings of a document field.
+    """
+    return f"embeddings_{field}.npy"
+
+
+def scale_file(field):
+    """
+    Return the name of the file holding the int8 quantization scales of a document field.
+    """
+    return f"embeddings_{field}_scale.npy"
+
+
+class Int8Embeddings:
+    """
+    Read-only view of int8 scalar-quantized embeddings that returns float32 rows.
+
+    Every dimension is stored as round(value / scale * 127), with the scale of a dimension being the
+    largest absolute value found in it. Indexing and numpy conversions give the dequantized float32
+    values, so the view can be used wherever the float32 embeddings array was used.
+
+    Args:
+    - codes (numpy.ndarray): int8 array with one row per document (may be memory-mapped).
+    - scale (numpy.ndarray): float32 scale of every dimension.
+    """
+
+    def __init__(self, codes, scale):
+        self.codes = codes
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.shape = codes.shape
+        self.dtype = np.dtype(np.float32)
+        self.ndim = codes.ndim
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        return np.asarray(self.codes[rows], dtype=np.float32) * (self.scale / 127.0)
+
+    def __array__(self, dtype=None, copy=None):
+        embeddings = self[:]
+        return embeddings if dtype is None else embeddings.astype(dtype, copy=False)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scale.nbytes
+
+
+def quantize_embeddings(embeddings, precision="float32"):
+    """
+    Convert float32 embeddings to the storage precision.
+
+    Args:
+    - embeddings (numpy.ndarray): Normalized float32 embeddings.
+    - precision (str): One of EMBEDDING_PRECISIONS: "float32" (4 bytes per dimension), "float16" (2 bytes)
+      or "int8" (1 byte, scalar quantization with one scale per dimension).
+
+    Returns:
+    - tuple: (stored array, scale), where scale is the float32 scale of every dimension for "int8" and None otherwise.
+    """
+    if precision == "float32":
+        return np.ascontiguousarray(embeddings, dtype=np.float32), None
+    if precision == "float16":
+        return np.ascontiguousarray(embeddings, dtype=np.float16), None
+    if precision == "int8":
+        scale = np.abs(embeddings).max(axis=0) if len(embeddings) else np.ones(embeddings.shape[1])
+        scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(embeddings / scale * 127.0), -127, 127).astype(np.int8)
+        return codes, scale
+    raise ValueError(f"Unknown embedding precision '{precision}', expected one of {EMBEDDING_PRECISIONS}")
+
+
+def normalize_embeddings(embeddings):
+    """
+    Scale embeddings to unit length, so that inner product equals cosine similarity.
+
+    Args:
+    - embeddings (numpy.ndarray): A 2D array with one embedding per row.
+
+    Returns:
+    - numpy.ndarray: C-contiguous float32 array of normalized embeddings. Zero rows are left as zeros.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def encode_texts(model, texts, batch_size=64):
+    """
+    Encode texts with the sentence encoder and normalize the embeddings.
+
+    Args:
+    - model (SentenceTransformer): The model used to compute the embeddings.
+    - texts (list of str): The texts to encode.
+    - batch_size (int): The number of texts encoded at once.
+
+    Returns:
+    - numpy.ndarray: float32 array of shape (len(texts), dimension) with unit length rows.
+    """
+    texts = list(texts)
+    with profile_stage("encode", len(texts)):
+        return normalize_embeddings(model.encode(texts, batch_size=batch_size))
+
+
+def document_digest(doc):
+    """
+    Return a digest of the embedded fields of a document, used to detect changed documents.
+    """
+    content = "\x1f".join(doc[field] for field in EMBEDDING_FIELDS)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def embedding_store_exists(index_dir):
+    """
+    Check whether an embedding store has been written to the index folder.
+    """
+    return os.path.isfile(os.path.join(index_dir, EMBEDDINGS_META_FILE))
+
+
+def load_embedding_store(index_dir, mmap=True):
+    """
+    Load the document embeddings stored in the index folder.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - mmap (bool): Memory-map the embedding arrays instead of reading them into memory.
+
+    Returns:
+    - store (dict): A dictionary with the keys "model", "encoder", "filenames", "digests", "precision", "index_version"
+      (the version of the index the documents were read from, None if unknown), "version" and the normalized embeddings of every field in EMBEDDING_FIELDS, or None if no store exists. Embeddings
+      are float32 or float16 arrays, or Int8Embeddings for "int8"; indexing any of them gives float32 values.
+    """
+    if not embedding_store_exists(index_dir):
+        return None
+    with open(os.path.join(index_dir, EMBEDDINGS_META_FILE), encoding="utf-8") as f:
+        store = json.load(f)
+    store.setdefault("precision", "float32")
+    # Stores written before the encoder was recorded were computed with the PyTorch model
+    store.setdefault("encoder", "torch")
+    store.setdefault("index_version", None)
+    # Identifies the stored embeddings, e.g. to check whether a FAISS index was built from them
+    key = ([store["model"]] + store["digests"] + ([store["precision"]] if store["precision"] != "float32" else [])
+           + ([store["encoder"]] if store["encoder"] != "torch" else []))
+    store["version"] = hashlib.sha1("\x1f".join(key).encode("utf-8")).hexdigest()
+    mmap_mode = "r" if mmap else None
+    for field in EMBEDDING_FIELDS:
+        embeddings = np.load(os.path.join(index_dir, embeddings_file(field)), mmap_mode=mmap_mode)
+        if store["precision"] == "int8":
+            embeddings = Int8Embeddings(embeddings, np.load(os.path.join(index_dir, scale_file(field))))
+        store[field] = embeddings
+    return store
+
+
+def build_embedding_store(index_dir, list_of_docs, model, model_name=EMBEDDING_MODEL, batch_size=64, precision=None, encoder="torch",
+                          index_version=None):
+    """
+    Compute and store the embeddings of the 'sklad' and 'wskazania' fields of every document.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - list_of_docs (list of dict): The documents, as returned by convert_to_dict_new_file, or the DocumentStore of the index.
+    - model (SentenceTransformer): The model used to compute the embeddings.
+    - model_name (str): The name of the model, stored to detect embeddings made by another model.
+    - batch_size (int): The number of texts encoded at once.
+    - precision (str, optional): The storage precision, one of EMBEDDING_PRECISIONS. Defaults to the
+      precision of the previous store, or "float32".
+    - encoder (str): The encoder backend of the model (see load_encoder), stored so that queries are never
+      compared with embeddings of another backend.
+    - index_version (str, optional): The version of the index the documents were read from, stored so that
+      ensure_embedding_store can check the store without reading the documents.
+
+    Returns:
+    - store (dict): The stored embeddings, as returned by load_embedding_store.
+
+    Embeddings of documents whose filename and field content did not change since the previous store
+    was written with the same model and encoder backend are reused, so only added and changed documents
+    are encoded. The files are written to a staging folder and moved into place together, so a failed
+    build leaves the previous store as it was.
+    """
+    previous = load_embedding_store(index_dir, mmap=False)
+    if precision is None:
+        precision = previous["precision"] if previous is not None else "float32"
+    if precision not in EMBEDDING_PRECISIONS:
+        raise ValueError(f"Unknown embedding precision '{precision}', expected one of {EMBEDDING_PRECISIONS}")
+    reusable = {}
+    # Embeddings stored at a lower precision are not reused for a higher one
+    if (previous is not None and previous["model"] == model_name and previous["encoder"] == encoder
+            and previous["precision"] in ("float32", precision)):
+        reusable = {(filename, digest): row for row, (filename, digest)
+                    in enumerate(zip(previous["filenames"], previous["digests"]))}
+
+    filenames = [doc['filename'] for doc in list_of_docs]
+    digests = [document_digest(doc) for doc in list_of_docs]
+    rows = [reusable.get(key) for key in zip(filenames, digests)]
+    to_encode = [i for i, row in enumerate(rows) if row is None]
+
+    os.makedirs(index_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=index_dir)
+    try:
+        for field in EMBEDDING_FIELDS:
+            new_embeddings = encode_texts(model, [list_of_docs[i][field] for i in to_encode], batch_size) if to_encode else None
+            if new_embeddings is not None:
+                dimension = new_embeddings.shape[1]
+            elif previous is not None:
+                dimension = previous[field].shape[1]
+            else:
+                dimension = model.get_sentence_embedding_dimension()
+            embeddings = np.zeros((len(list_of_docs), dimension), dtype=np.float32)
+            kept = [i for i, row in enumerate(rows) if row is not None]
+            if kept:
+                embeddings[kept] = previous[field][[rows[i] for i in kept]]
+            if to_encode:
+                embeddings[to_encode] = new_embeddings
+            stored, scale = quantize_embeddings(embeddings, precision)
+            np.save(os.path.join(staging, embeddings_file(field)), stored)
+            if scale is not None:
+                np.save(os.path.join(staging, scale_file(field)), scale)
+
+        with open(os.path.join(staging, EMBEDDINGS_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"model": model_name, "encoder": encoder, "filenames": filenames, "digests": digests,
+                       "precision": precision, "index_version": index_version}, f, ensure_ascii=False)
+        _replace_store_files(staging, index_dir)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return load_embedding_store(index_dir)
+
+
+def _replace_store_files(staging, index_dir):
+    # As _replace_index_files: the metadata is removed first and moved in last, so a partly replaced store
+    # is never loaded. Readers that memory-mapped the previous arrays keep reading them.
+    meta_path = os.path.join(index_dir, EMBEDDINGS_META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    filenames = sorted(os.listdir(staging))
+    for filename in filenames:
+        if filename != EMBEDDINGS_META_FILE:
+            os.replace(os.path.join(staging, filename), os.path.join(index_dir, filename))
+    # The scales of a previous int8 store are not part of a store of another precision
+    for filename in map(scale_file, EMBEDDING_FIELDS):
+        if filename not in filenames and os.path.exists(os.path.join(index_dir, filename)):
+            os.remove(os.path.join(index_dir, filename))
+    os.replace(os.path.join(staging, EMBEDDINGS_META_FILE), meta_path)
+
+
+def embedding_store_is_current(store, list_of_docs, model_name=EMBEDDING_MODEL, precision=None, encoder="torch", index_version=None):
+    """
+    Check whether an embedding store matches the given documents, model, encoder backend and (if given) precision.
+
+    With the index_version of the documents, the store is current if it was built from that version of the index,
+    and no document is read. Otherwise the filename and digest of every document are compared.
+    """
+    if (store is None or store["model"] != model_name or store["encoder"] != encoder
+            or (precision is not None and store["precision"] != precision)):
+        return False
+    if index_version is not None:
+        return store["index_version"] == index_version
+    return (store["filenames"] == [doc['filename'] for doc in list_of_docs]
+            and store["digests"] == [document_digest(doc) for doc in list_of_docs])
+
+
+def ensure_embedding_store(index_dir, list_of_docs, model, model_name=EMBEDDING_MODEL, batch_size=64, precision=None, encoder="torch",
+                           index_version=None):
+    """
+    Load the embedding store, (re)building it first if it is missing or out of date.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - list_of_docs (list of dict): The documents, as returned by convert_to_dict_new_file, or the DocumentStore of the index.
+    - model (SentenceTransformer): The model used to compute missing embeddings.
+    - model_name (str): The name of the model.
+    - batch_size (int): The number of texts encoded at once.
+    - precision (str, optional): The storage precision, see build_embedding_store. By default the
+      precision of an existing store is kept.
+    - encoder (str): The encoder backend of the model. A store written with another backend is rebuilt.
+    - index_version (str, optional): The version of the index list_of_docs was read from. A store built from
+      another version is rebuilt, reusing the embeddings of unchanged documents; without it every document is compared.
+
+    Returns:
+    - store (dict): The embeddings, as returned by load_embedding_store.
+    """
+    store = load_embedding_store(index_dir)
+    if embedding_store_is_current(store, list_of_docs, model_name, precision, encoder, index_version):
+        return store
+    return build_embedding_store(index_dir, list_of_docs, model, model_name, batch_size, precision, encoder, index_version)
@@ -0,0 +1,232 @@
+import os
+import json
+import numpy as np
+from utils_embedding_store import EMBEDDING_MODEL
+
+ENCODER_BACKENDS = ["torch", "onnx", "onnx-int8"]
+
+ONNX_CONFIG_FILE = "encoder.json"
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model_int8.onnx"
+
+# Smallest cosine similarity allowed between the normalized embeddings of a backend and of the
+# PyTorch model for the same text. The exported float32 graph only differs by rounding; dynamic int8
+# quantization of the weights moves embeddings slightly but keeps rankings close.
+ENCODER_TOLERANCE = {"onnx": 0.9999, "onnx-int8": 0.99}
+
+
+def onnx_dir(index_dir):
+    """
+    Return the folder where the exported ONNX encoder of an index is kept.
+    """
+    return os.path.join(index_dir, "onnx")
+
+
+def export_onnx_encoder(output_dir, model_name=EMBEDDING_MODEL, quantize=True, opset=14):
+    """
+    Export the transformer of a SentenceTransformer model to ONNX, with its tokenizer and pooling settings.
+
+    Args:
+    - output_dir (str): The folder the encoder is written to.
+    - model_name (str): The SentenceTransformer model.
+    - quantize (bool): Also write a copy with dynamically int8-quantized weights (needs onnxruntime).
+    - opset (int): The ONNX opset version.
+
+    Returns:
+    - dict: The encoder configuration written to encoder.json.
+
+    Batch size and sequence length are dynamic axes of the graph, so batches can be padded to their
+    own longest text.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+
+    class TokenEmbeddings(torch.nn.Module):
+        # Returns the last hidden state only, pooling is done outside of the graph
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    os.makedirs(output_dir, exist_ok=True)
+    sample = tokenizer(["Przykładowe zdanie."], return_tensors="pt")
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                    "token_embeddings": {0: "batch", 1: "sequence"}}
+    with torch.no_grad():
+        torch.onnx.export(TokenEmbeddings(transformer), (sample["input_ids"], sample["attention_mask"]),
+                          os.path.join(output_dir, ONNX_MODEL_FILE), input_names=["input_ids", "attention_mask"],
+                          output_names=["token_embeddings"], dynamic_axes=dynamic_axes, opset_version=opset)
+    tokenizer.save_pretrained(output_dir)
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(os.path.join(output_dir, ONNX_MODEL_FILE), os.path.join(output_dir, ONNX_QUANTIZED_MODEL_FILE),
+                         weight_type=QuantType.QInt8)
+
+    config = {
+        "model": model_name,
+        "max_seq_length": model.max_seq_length,
+        "pooling": model[1].get_pooling_mode_str(),
+        "dimension": model.get_sentence_embedding_dimension(),
+        "quantized": quantize,
+    }
+    with open(os.path.join(output_dir, ONNX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    return config
+
+
+def pool_token_embeddings(token_embeddings, attention_mask, pooling="mean"):
+    """
+    Pool token embeddings into one embedding per text, as the Pooling module of SentenceTransformer.
+
+    Args:
+    - token_embeddings (numpy.ndarray): Array of shape (batch, sequence, dimension).
+    - attention_mask (numpy.ndarray): Array of shape (batch, sequence), 1 for tokens and 0 for padding.
+    - pooling (str): "mean", "cls" or "max".
+
+    Returns:
+    - numpy.ndarray: float32 array of shape (batch, dimension).
+    """
+    mask = attention_mask[:, :, None].astype(np.float32)
+    if pooling == "mean":
+        return (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+    if pooling == "cls":
+        return token_embeddings[:, 0]
+    if pooling == "max":
+        return np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+    raise ValueError(f"Unsupported pooling '{pooling}', expected 'mean', 'cls' or 'max'")
+
+
+class OnnxSentenceEncoder:
+    """
+    Sentence encoder running an exported ONNX graph with onnxruntime on CPU.
+
+    It has the encode and get_sentence_embedding_dimension methods of SentenceTransformer, so it can be
+    used wherever the model is passed (e.g. encode_texts). Texts are tokenized once, sorted by length and
+    encoded in batches padded only to the longest text of the batch.
+
+    Args:
+    - model_dir (str): The folder written by export_onnx_encoder.
+    - quantized (bool): Use the int8-quantized graph.
+    - threads (int, optional): The number of threads used by onnxruntime. Defaults to its own choice.
+    """
+
+    def __init__(self, model_dir, quantized=False, threads=None):
+        try:
+            import onnxruntime
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("The ONNX encoder needs the onnxruntime and transformers packages "
+                              "(pip install onnxruntime).") from e
+
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILE), encoding="utf-8") as f:
+            self.config = json.load(f)
+        model_file = ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, model_file), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = self.config["max_seq_length"]
+        self.pooling = self.config["pooling"]
+
+    def get_sentence_embedding_dimension(self):
+        return self.config["dimension"]
+
+    def encode(self, sentences, batch_size=64, **kwargs):
+        """
+        Encode texts into (unnormalized) sentence embeddings.
+
+        Args:
+        - sentences (str or list of str): The texts.
+        - batch_size (int): The number of texts run through the graph at once.
+
+        Returns:
+        - numpy.ndarray: float32 array with one embedding per text (a single embedding for a str).
+        """
+        single = isinstance(sentences, str)
+        texts = [str(text).strip() for text in ([sentences] if single else sentences)]
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)
+        input_ids, attention_masks = encoded["input_ids"], encoded["attention_mask"]
+        lengths = np.array([len(ids) for ids in input_ids])
+        embeddings = np.zeros((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        # Texts of similar length share a batch, so little compute goes to padding
+        order = np.argsort(-lengths, kind="stable")
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            batch = pad_batch([input_ids[row] for row in rows], [attention_masks[row] for row in rows],
+                              self.tokenizer.pad_token_id)
+            token_embeddings = self.session.run(None, batch)[0]
+            embeddings[rows] = pool_token_embeddings(token_embeddings, batch["attention_mask"], self.pooling)
+        return embeddings[0] if single else embeddings
+
+
+def pad_batch(input_ids, attention_masks, pad_token_id):
+    """
+    Pad the token ids and attention masks of a batch to the length of its longest text.
+
+    Returns:
+    - dict: int64 arrays "input_ids" and "attention_mask" of shape (batch, longest length).
+    """
+    width = max(len(ids) for ids in input_ids)
+    padded_ids = np.full((len(input_ids), width), pad_token_id, dtype=np.int64)
+    padded_mask = np.zeros((len(input_ids), width), dtype=np.int64)
+    for row, (ids, mask) in enumerate(zip(input_ids, attention_masks)):
+        padded_ids[row, :len(ids)] = ids
+        padded_mask[row, :len(mask)] = mask
+    return {"input_ids": padded_ids, "attention_mask": padded_mask}
+
+
+def load_encoder(backend="torch", model_name=EMBEDDING_MODEL, model_dir=None, threads=None):
+    """
+    Load the sentence encoder of the given backend.
+
+    Args:
+    - backend (str): One of ENCODER_BACKENDS: "torch" (SentenceTransformer), "onnx" (exported float32
+      graph) or "onnx-int8" (exported graph with int8 weights).
+    - model_name (str): The SentenceTransformer model, used by the "torch" backend.
+    - model_dir (str, optional): The folder written by export_onnx_encoder, needed by the ONNX backends.
+    - threads (int, optional): The number of threads used by onnxruntime.
+
+    Returns:
+    - SentenceTransformer or OnnxSentenceEncoder: The encoder.
+    """
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    if backend in ("onnx", "onnx-int8"):
+        if model_dir is None or not os.path.isfile(os.path.join(model_dir, ONNX_CONFIG_FILE)):
+            raise FileNotFoundError(f"No ONNX encoder found in {model_dir}. Run 'main.py export-onnx' first.")
+        return OnnxSentenceEncoder(model_dir, quantized=backend == "onnx-int8", threads=threads)
+    raise ValueError(f"Unknown encoder backend '{backend}', expected one of {ENCODER_BACKENDS}")
+
+
+def compare_encoders(reference_embeddings, embeddings, backend=None):
+    """
+    Compare the normalized embeddings of an encoder backend with reference embeddings of the same texts.
+
+    Args:
+    - reference_embeddings (numpy.ndarray): Normalized embeddings of the reference (PyTorch) model.
+    - embeddings (numpy.ndarray): Normalized embeddings of the compared backend.
+    - backend (str, optional): The compared backend, whose ENCODER_TOLERANCE is checked.
+
+    Returns:
+    - dict: "min_cosine", "mean_cosine", "max_abs_diff" and, when the backend has a tolerance,
+      "within_tolerance".
+    """
+    cosine = (np.asarray(reference_embeddings) * np.asarray(embeddings)).sum(axis=1)
+    result = {
+        "min_cosine": float(cosine.min()) if len(cosine) else 1.0,
+        "mean_cosine": float(cosine.mean()) if len(cosine) else 1.0,
+        "max_abs_diff": float(np.abs(np.asarray(reference_embeddings) - np.asarray(embeddings)).max()) if len(cosine) else 0.0,
+    }
+    if backend in ENCODER_TOLERANCE:
+        result["within_tolerance"] = result["min_cosine"] >= ENCODER_TOLERANCE[backend]
+    return result
@@ -0,0 +1,187 @@
+import os
+import json
+import numpy as np
+from utils_profiling import profile_stage
+
+FAISS_BACKENDS = ["flat", "fp16", "sq8", "ivf", "hnsw", "pq", "ivfpq"]
+
+# The number of embeddings converted to float32 and added to an index at once
+ADD_BATCH_SIZE = 65536
+
+
+def index_file(field, backend):
+    """
+    Return the name of the file holding the FAISS index of a document field.
+    """
+    return f"faiss_{field}_{backend}.index"
+
+
+def _pq_subquantizers(dimension, requested=None):
+    """
+    Return the number of PQ sub-quantizers: the requested number (default dimension / 8),
+    lowered until it divides the dimension.
+    """
+    m = requested or max(1, dimension // 8)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def _training_bits(n_vectors, max_bits=8):
+    """
+    Return the number of bits per PQ code that can be trained with the available vectors.
+    """
+    return int(max(1, min(max_bits, np.floor(np.log2(max(n_vectors, 2))))))
+
+
+def build_field_index(field_embeddings, backend="flat", nlist=None, hnsw_m=32, pq_m=None, nprobe=16, ef_search=64):
+    """
+    Build an inner-product FAISS index over normalized embeddings, so scores are cosine similarities.
+
+    Args:
+    - field_embeddings (numpy.ndarray): Normalized embeddings, one per document. Any array whose rows
+      convert to float32 can be used, e.g. the float16 or int8 embeddings of the embedding store.
+    - backend (str): One of FAISS_BACKENDS:
+        - "flat": exact search (IndexFlatIP).
+        - "fp16": exhaustive search over embeddings stored as float16 (IndexScalarQuantizer), half the memory of flat.
+        - "sq8": exhaustive search over 8-bit scalar-quantized embeddings (IndexScalarQuantizer), a quarter of flat.
+        - "ivf": inverted lists over k-means cells (IndexIVFFlat), searching `nprobe` cells.
+        - "hnsw": HNSW graph (IndexHNSWFlat) with `hnsw_m` links per node, searched with `ef_search`.
+        - "pq": exhaustive search over product-quantized codes (IndexPQ).
+        - "ivfpq": inverted lists over product-quantized codes (IndexIVFPQ).
+    - nlist (int, optional): The number of IVF cells. Defaults to 4 * sqrt(number of documents).
+    - hnsw_m (int): The number of neighbors per HNSW node.
+    - pq_m (int, optional): The number of PQ sub-quantizers. Defaults to dimension / 8.
+    - nprobe (int): The number of IVF cells visited per query.
+    - ef_search (int): The size of the HNSW candidate list per query.
+
+    Returns:
+    - faiss.Index: The trained index containing all embeddings.
+    """
+    import faiss
+
+    n_vectors, dimension = field_embeddings.shape
+    metric = faiss.METRIC_INNER_PRODUCT
+    nlist = max(1, min(nlist or int(4 * np.sqrt(n_vectors)), n_vectors))
+
+    if backend == "flat":
+        index = faiss.IndexFlatIP(dimension)
+    elif backend == "fp16":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, metric)
+    elif backend == "sq8":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+    elif backend == "ivf":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dimension), dimension, nlist, metric)
+    elif backend == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, metric)
+    elif backend == "pq":
+        index = faiss.IndexPQ(dimension, _pq_subquantizers(dimension, pq_m), _training_bits(n_vectors), metric)
+    elif backend == "ivfpq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dimension), dimension, nlist,
+                                 _pq_subquantizers(dimension, pq_m), _training_bits(n_vectors), metric)
+    else:
+        raise ValueError(f"Unknown FAISS backend '{backend}', expected one of {FAISS_BACKENDS}")
+
+    with profile_stage("faiss_build", n_vectors):
+        if not index.is_trained:
+            index.train(np.ascontiguousarray(field_embeddings, dtype=np.float32))
+        # Added in batches, so compressed indexes never need a float32 copy of all embeddings
+        for start in range(0, n_vectors, ADD_BATCH_SIZE):
+            index.add(np.ascontiguousarray(field_embeddings[start:start + ADD_BATCH_SIZE], dtype=np.float32))
+    set_search_parameters(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+
+def set_search_parameters(index, nprobe=16, ef_search=64):
+    """
+    Set the query-time parameters of IVF and HNSW indexes (they are not stored with the index).
+    """
+    if hasattr(index, "nprobe"):
+        index.nprobe = nprobe
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+
+def search_field_index(index, query_embeddings, k):
+    """
+    Search an index built with build_field_index.
+
+    Args:
+    - index (faiss.Index): The index to search.
+    - query_embeddings (numpy.ndarray): Normalized query embeddings, one per row.
+    - k (int): The number of neighbors returned per query.
+
+    Returns:
+    - tuple: (scores, indices), both of shape (number of queries, k). Scores are cosine similarities;
+      approximate indexes may return fewer than k neighbors, the missing ones have index -1.
+    """
+    k = min(k, index.ntotal)
+    with profile_stage("faiss_search", len(query_embeddings)):
+        return index.search(np.ascontiguousarray(query_embeddings, dtype=np.float32), k)
+
+
+def save_field_index(index_dir, field, backend, index, store_version):
+    """
+    Write a FAISS index to the index folder, with the version of the embeddings it was built from.
+    """
+    import faiss
+
+    path = os.path.join(index_dir, index_file(field, backend))
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump({"store_version": store_version}, f)
+
+
+def load_field_index(index_dir, field, backend, store_version=None, nprobe=16, ef_search=64):
+    """
+    Load a FAISS index written by save_field_index.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - field (str): The document field, 'sklad' or 'wskazania'.
+    - backend (str): The backend the index was built with.
+    - store_version (str, optional): Only return the index if it was built from this embeddings version.
+    - nprobe (int): The number of IVF cells visited per query.
+    - ef_search (int): The size of the HNSW candidate list per query.
+
+    Returns:
+    - faiss.Index: The loaded index, or None if it is missing or was built from other embeddings.
+    """
+    path = os.path.join(index_dir, index_file(field, backend))
+    if not os.path.isfile(path) or not os.path.isfile(path + ".json"):
+        return None
+    with open(path + ".json", encoding="utf-8") as f:
+        info = json.load(f)
+    if store_version is not None and info.get("store_version") != store_version:
+        return None
+    import faiss
+
+    index = faiss.read_index(path)
+    set_search_parameters(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+
+def ensure_field_indexes(index_dir, store, fields, backend="flat", **params):
+    """
+    Load the FAISS index of every field, building and saving the ones that are missing or out of date.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - store (dict): The embedding store, as returned by load_embedding_store.
+    - fields (list of str): The document fields to index.
+    - backend (str): One of FAISS_BACKENDS.
+    - params: Additional parameters passed to build_field_index.
+
+    Returns:
+    - dict: Mapping of each field to its FAISS index.
+    """
+    search_params = {key: params[key] for key in ("nprobe", "ef_search") if key in params}
+    indexes = {}
+    for field in fields:
+        index = load_field_index(index_dir, field, backend, store["version"], **search_params)
+        if index is None:
+            index = build_field_index(store[field], backend, **params)
+            save_field_index(index_dir, field, backend, index, store["version"])
+        indexes[field] = index
+    return indexes
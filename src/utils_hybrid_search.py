@@ -0,0 +1,221 @@
+import numpy as np
+from utils_faiss_index import search_field_index
+
+FUSION_METHODS = ["weighted", "rrf"]
+DEFAULT_FIELD_WEIGHTS = {'sklad': 1.0, 'wskazania': 1.0}
+
+# Upper bound of the number of floats gathered at once when scoring candidates
+GATHER_BUDGET = 1 << 24
+
+
+class DenseField:
+    """
+    A field searched with a FAISS index over normalized sentence embeddings.
+
+    Args:
+    - query_embeddings (numpy.ndarray): Normalized embeddings of the queries, one per row.
+    - corpus_embeddings (numpy.ndarray): Normalized embeddings of the documents (may be memory-mapped).
+    - index (faiss.Index): The index built from corpus_embeddings, see build_field_index.
+    """
+
+    def __init__(self, query_embeddings, corpus_embeddings, index):
+        self.query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+        self.corpus_embeddings = corpus_embeddings
+        self.index = index
+
+    def retrieve(self, k):
+        """
+        Return the (scores, indices) of the k nearest documents of every query, indices -1 when missing.
+        """
+        return search_field_index(self.index, self.query_embeddings, k)
+
+    def score(self, candidates):
+        """
+        Return the exact cosine similarity of every query with each of its candidate documents.
+
+        Args:
+        - candidates (numpy.ndarray): Document indices of shape (number of queries, number of candidates),
+          -1 for padding.
+
+        Returns:
+        - numpy.ndarray: float32 scores of the same shape, 0 for padding.
+        """
+        n_queries, n_candidates = candidates.shape
+        dimension = self.query_embeddings.shape[1]
+        scores = np.zeros(candidates.shape, dtype=np.float32)
+        rows = max(1, GATHER_BUDGET // max(1, n_candidates * dimension))
+        for start in range(0, n_queries, rows):
+            block = candidates[start:start + rows]
+            vectors = np.asarray(self.corpus_embeddings[np.maximum(block, 0).ravel()], dtype=np.float32)
+            vectors = vectors.reshape(block.shape + (dimension,))
+            scores[start:start + rows] = np.einsum("qcd,qd->qc", vectors, self.query_embeddings[start:start + rows])
+        scores[candidates < 0] = 0.0
+        return scores
+
+
+class SparseField:
+    """
+    A field searched with TF-IDF cosine similarity.
+
+    Args:
+    - query_vectors (scipy.sparse.csr_matrix): TF-IDF vectors of the queries, e.g. vectorizer.transform(texts).
+    - tfidf_postings (scipy.sparse.csr_matrix): The TF-IDF matrix with one row per term, see term_major.
+    - block_size (int): The number of queries scored against the whole corpus at once.
+    """
+
+    def __init__(self, query_vectors, tfidf_postings, block_size=64):
+        self.query_vectors = query_vectors.tocsr()
+        self.tfidf_postings = tfidf_postings
+        self.block_size = block_size
+
+    def _blocks(self):
+        for start in range(0, self.query_vectors.shape[0], self.block_size):
+            yield start, (self.query_vectors[start:start + self.block_size] @ self.tfidf_postings).toarray()
+
+    def retrieve(self, k):
+        """
+        Return the (scores, indices) of the k best scoring documents of every query, indices -1 when missing.
+        """
+        n_queries, n_docs = self.query_vectors.shape[0], self.tfidf_postings.shape[1]
+        k = min(k, n_docs)
+        scores = np.zeros((n_queries, k), dtype=np.float32)
+        indices = np.full((n_queries, k), -1, dtype=np.int64)
+        if k == 0:
+            return scores, indices
+        for start, block in self._blocks():
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(block, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+            # Documents without any query term are not retrieved
+            top[top_scores <= 0] = -1
+            scores[start:start + len(block)], indices[start:start + len(block)] = top_scores, top
+        return scores, indices
+
+    def score(self, candidates):
+        """
+        Return the TF-IDF cosine similarity of every query with each of its candidate documents, 0 for padding.
+        """
+        scores = np.zeros(candidates.shape, dtype=np.float32)
+        for start, block in self._blocks():
+            rows = candidates[start:start + len(block)]
+            scores[start:start + len(block)] = np.take_along_axis(block, np.maximum(rows, 0), axis=1)
+        scores[candidates < 0] = 0.0
+        return scores
+
+
+def union_candidates(indices):
+    """
+    Merge the documents retrieved for every query from several fields.
+
+    Args:
+    - indices (list of numpy.ndarray): The retrieved document indices of every field, each of shape
+      (number of queries, k), -1 for missing results.
+
+    Returns:
+    - numpy.ndarray: int64 array of shape (number of queries, number of candidates) holding the distinct
+      documents of every query in increasing order, padded with -1.
+    """
+    merged = np.concatenate([np.asarray(field_indices, dtype=np.int64) for field_indices in indices], axis=1)
+    padding = np.iinfo(np.int64).max
+    merged = np.sort(np.where(merged < 0, padding, merged), axis=1)
+    duplicate = np.zeros(merged.shape, dtype=bool)
+    duplicate[:, 1:] = merged[:, 1:] == merged[:, :-1]
+    merged = np.sort(np.where(duplicate, padding, merged), axis=1)
+    width = int((merged != padding).sum(axis=1).max()) if merged.size else 0
+    merged = merged[:, :width]
+    merged[merged == padding] = -1
+    return merged
+
+
+def fuse_scores(field_scores, weights, candidates, fusion="weighted", rrf_k=60):
+    """
+    Combine the scores of several fields into one score per candidate.
+
+    Args:
+    - field_scores (dict): Mapping of each field to its scores, of the shape of candidates.
+    - weights (dict): The weight of every field.
+    - candidates (numpy.ndarray): The candidate documents, -1 for padding.
+    - fusion (str): "weighted" averages the field scores with the weights; "rrf" (reciprocal rank fusion)
+      sums weight / (rrf_k + rank), where rank is the position of the candidate when ordered by the field score.
+    - rrf_k (int): The rank offset of reciprocal rank fusion.
+
+    Returns:
+    - numpy.ndarray: float64 fused scores, -inf for padding.
+    """
+    valid = candidates >= 0
+    fused = np.zeros(candidates.shape, dtype=np.float64)
+    if fusion == "weighted":
+        total = sum(weights[field] for field in field_scores)
+        for field, scores in field_scores.items():
+            fused += weights[field] / total * scores
+    elif fusion == "rrf":
+        positions = np.arange(1, candidates.shape[1] + 1)
+        for field, scores in field_scores.items():
+            order = np.argsort(-np.where(valid, scores, -np.inf), axis=1, kind="stable")
+            ranks = np.empty(candidates.shape, dtype=np.int64)
+            np.put_along_axis(ranks, order, np.broadcast_to(positions, candidates.shape), axis=1)
+            fused += weights[field] / (rrf_k + ranks)
+    else:
+        raise ValueError(f"Unknown fusion '{fusion}', expected one of {FUSION_METHODS}")
+    fused[~valid] = -np.inf
+    return fused
+
+
+def hybrid_search(fields, top_k, weights=None, fusion="weighted", rrf_k=60, candidates_k=None):
+    """
+    Retrieve candidates from several fields, score every candidate in every field and fuse the scores.
+
+    Args:
+    - fields (dict): Mapping of field names to DenseField or SparseField objects over the same queries.
+    - top_k (int): The number of documents returned per query.
+    - weights (dict, optional): The weight of fields, overriding DEFAULT_FIELD_WEIGHTS. Fields with
+      a weight of 0, or without a weight, are neither searched nor scored.
+    - fusion (str): "weighted" or "rrf", see fuse_scores.
+    - rrf_k (int): The rank offset of reciprocal rank fusion.
+    - candidates_k (int, optional): The number of documents retrieved per field. Defaults to top_k.
+
+    Returns:
+    - tuple: (scores, indices, field_scores). scores and indices have shape (number of queries, top_k)
+      and are ordered by decreasing fused score, indices are -1 (and scores -inf) when fewer documents
+      were found. field_scores maps every field to the score of the returned documents in that field.
+
+    The candidates of a query are the union of the documents retrieved from each field. Every candidate
+    gets a score in every field, also in the fields it was not retrieved from, so the fused score
+    always combines the scores of the same document.
+    """
+    weights = {**DEFAULT_FIELD_WEIGHTS, **(weights or {})}
+    active = {field: searcher for field, searcher in fields.items() if weights.get(field, 0) > 0}
+    if not active:
+        raise ValueError("At least one field needs a positive weight.")
+    retrieved = [searcher.retrieve(candidates_k or top_k)[1] for searcher in active.values()]
+    candidates = union_candidates(retrieved)
+    field_scores = {field: searcher.score(candidates) for field, searcher in active.items()}
+    fused = fuse_scores(field_scores, weights, candidates, fusion, rrf_k)
+
+    top_k = min(top_k, candidates.shape[1])
+    order = np.argsort(-fused, axis=1, kind="stable")[:, :top_k]
+    scores = np.take_along_axis(fused, order, axis=1)
+    indices = np.take_along_axis(candidates, order, axis=1)
+    returned = {field: np.take_along_axis(scores_, order, axis=1) for field, scores_ in field_scores.items()}
+    return scores, indices, returned
+
+
+def parse_field_weights(text):
+    """
+    Parse field weights given as "field=weight" pairs separated by commas, e.g. "sklad=1,wskazania=2,tfidf=0.5".
+
+    Args:
+    - text (str): The weights.
+
+    Returns:
+    - dict: Mapping of each field ('sklad', 'wskazania' or 'tfidf') to its weight.
+    """
+    weights = {}
+    for pair in text.split(","):
+        field, _, weight = pair.partition("=")
+        field = field.strip()
+        if field not in ('sklad', 'wskazania', 'tfidf') or not weight:
+            raise ValueError(f"Invalid field weight '{pair}', expected sklad=<w>, wskazania=<w> or tfidf=<w>")
+        weights[field] = float(weight)
+    return weights
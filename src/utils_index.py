@@ -0,0 +1,450 @@
+import os
+import json
+import uuid
+import shutil
+import tempfile
+import heapq
+import numpy as np
+import scipy.sparse
+from array import array
+from collections import Counter
+from datetime import datetime
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+from utils_dataprep import iter_documents, file_hash, extractor_id
+from utils_text_cache import TEXT_CACHE_FILE, TextCache
+from utils_info_extract import iter_sections
+from utils_data_cleaning import process_documents
+from utils_search_engine import term_major
+from utils_inverted_index import bm25_weights
+from utils_docstore import DOCSTORE_FIELDS, write_document_store, load_document_store
+from utils_profiling import profile_iter, profile_stage
+
+INDEX_FORMAT_VERSION = 2
+
+META_FILE = "meta.json"
+VOCABULARY_FILE = "tfidf_vocabulary.json"
+IDF_FILE = "tfidf_idf.npy"
+MATRIX_FILE = "tfidf_matrix.npz"
+POSTINGS_FILE = "tfidf_postings.npz"
+BM25_POSTINGS_FILE = "bm25_postings.npz"
+COUNTS_FILE = "tfidf_counts.npz"
+MANIFEST_FILE = "manifest.json"
+
+
+def index_exists(index_dir):
+    """
+    Check whether a corpus index has been built in the specified folder.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+
+    Returns:
+    - bool: True if the index metadata file is present, False otherwise.
+    """
+    return os.path.isfile(os.path.join(index_dir, META_FILE))
+
+
+def in_name_range(filename, name_range=None):
+    """
+    Check whether a filename falls in a range of filenames.
+
+    Args:
+    - filename (str): The filename.
+    - name_range (list, optional): [start, stop] filenames: start included, stop excluded, None for an open end.
+      By default every filename is in range.
+
+    Returns:
+    - bool: True if start <= filename < stop.
+    """
+    if not name_range:
+        return True
+    start, stop = name_range
+    return (start is None or filename >= start) and (stop is None or filename < stop)
+
+
+def scan_folder(input_path, manifest=None, name_range=None):
+    """
+    Fingerprint every PDF file in the folder, reusing entries of a previous manifest where possible.
+
+    Args:
+    - input_path (str): The path to the folder containing the PDF documents.
+    - manifest (dict, optional): The manifest of the previous build, mapping filenames to fingerprints.
+    - name_range (list, optional): Only fingerprint the files in this range of filenames, see in_name_range.
+
+    Returns:
+    - fingerprints (dict): Mapping of each PDF filename to a dictionary with 'size', 'mtime' and 'sha256'.
+
+    The content hash is only computed for files whose size or modification time differ from the
+    previous manifest, so scanning an unchanged folder does not read the PDF files.
+    """
+    manifest = manifest or {}
+    fingerprints = {}
+    for filename in sorted(os.listdir(input_path)):
+        if not filename.endswith('.pdf') or not in_name_range(filename, name_range):
+            continue
+        stat = os.stat(os.path.join(input_path, filename))
+        previous = manifest.get(filename)
+        if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+            fingerprints[filename] = previous
+        else:
+            fingerprints[filename] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha256": file_hash(os.path.join(input_path, filename)),
+            }
+    return fingerprints
+
+
+def load_manifest(index_dir):
+    """
+    Load the file fingerprints stored with the index.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+
+    Returns:
+    - dict: Mapping of filenames to fingerprints, empty if the index has no manifest.
+    """
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def fit_tfidf_stream(texts):
+    """
+    Fit a TF-IDF representation on texts consumed one at a time.
+
+    Args:
+    - texts (iterable of str): The text of every document, e.g. 'sklad' + " " + 'wskazania'.
+
+    Returns:
+    - tuple: (vectorizer, tfidf_matrix, counts), where the vectorizer and TF-IDF matrix are the same as
+      TfidfVectorizer().fit_transform on the list of texts gives, and counts is the matching (float) term count matrix.
+
+    Only the term counts of the documents are kept, in compact arrays, so the texts themselves can be
+    produced by a generator and discarded.
+    """
+    analyzer = TfidfVectorizer().build_analyzer()
+    vocabulary = {}
+    indptr = array("q", [0])
+    term_ids = array("q")
+    term_counts = array("q")
+    for text in texts:
+        for term, count in Counter(analyzer(text)).items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            term_counts.append(count)
+        indptr.append(len(term_ids))
+    if len(indptr) == 1:
+        raise ValueError("No documents to index: the input folder has no readable PDF file.")
+    if not vocabulary:
+        raise ValueError("No terms to index: the documents have no text in their 'sklad' and 'wskazania' sections.")
+
+    counts = scipy.sparse.csr_matrix((np.frombuffer(term_counts, dtype=np.int64).astype(np.float64),
+                                      np.frombuffer(term_ids, dtype=np.int64),
+                                      np.frombuffer(indptr, dtype=np.int64)),
+                                     shape=(len(indptr) - 1, len(vocabulary)))
+    counts.sort_indices()
+    # Like TfidfVectorizer, number the features alphabetically without reordering the rows afterwards,
+    # so the normalized weights are bit for bit the same
+    column = np.empty(len(vocabulary), dtype=np.int64)
+    column[[vocabulary[term] for term in sorted(vocabulary)]] = np.arange(len(vocabulary))
+    counts.indices = column[counts.indices]
+    counts.has_sorted_indices = False
+    transformer = TfidfTransformer().fit(counts)
+    tfidf_matrix = transformer.transform(counts, copy=True)
+    vectorizer = load_vectorizer({term: int(column[idx]) for term, idx in vocabulary.items()}, transformer.idf_)
+    return vectorizer, tfidf_matrix, counts
+
+
+def save_index(index_dir, documents, input_path=None, manifest=None):
+    """
+    Write the cleaned corpus and its fitted TF-IDF representation to disk.
+
+    Args:
+    - index_dir (str): The path to the index folder. It is created if it does not exist.
+    - documents (iterable of dict): The cleaned documents with the keys 'filename', 'nazwa', 'sklad', 'wskazania',
+      e.g. a generator from process_documents.
+    - input_path (str, optional): The folder the corpus was read from, stored for reference.
+    - manifest (dict, optional): The fingerprints of the PDF files the corpus was built from. Only the
+      files that produced a document are stored, so files that could not be read are read again by update_index.
+
+    Returns:
+    - meta (dict): The metadata written alongside the index.
+
+    Documents are written to the document store as they come and TF-IDF is fitted on their term counts
+    (see fit_tfidf_stream), so the corpus is never held in memory as a whole.
+    Only the vocabulary and IDF weights of the vectorizer are stored, so the index does not depend
+    on pickling scikit-learn objects. Every save gets a new "index_version" identifier.
+    The files of the folder are only replaced once all of them are written: if reading or fitting fails,
+    e.g. with a ValueError when there is no document or no term to index, the previous index is kept.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    # Every file is written to a staging folder first and moved into place once the fit succeeded,
+    # so a failed build or update leaves the previous index as it was
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=index_dir)
+    try:
+        meta = _write_index_files(staging, documents, input_path, manifest)
+        _replace_index_files(staging, index_dir)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return meta
+
+
+def _write_index_files(index_dir, documents, input_path, manifest):
+    indexed = set()
+
+    def track(documents):
+        for doc in documents:
+            indexed.add(doc['filename'])
+            yield doc
+
+    written = profile_iter("write_docstore", write_document_store(index_dir, track(documents)))
+    # Pulls the documents through every previous stage, which the profiler subtracts from the fit
+    with profile_stage("tfidf_fit") as stage:
+        vectorizer, tfidf_matrix, counts = fit_tfidf_stream(doc['sklad'] + " " + doc['wskazania'] for doc in written)
+        stage.items = tfidf_matrix.shape[0]
+
+    with profile_stage("write_tfidf", tfidf_matrix.shape[0]):
+        vocabulary = {term: int(idx) for term, idx in vectorizer.vocabulary_.items()}
+        with open(os.path.join(index_dir, VOCABULARY_FILE), "w", encoding="utf-8") as f:
+            json.dump(vocabulary, f, ensure_ascii=False)
+        np.save(os.path.join(index_dir, IDF_FILE), vectorizer.idf_)
+        tfidf_matrix = tfidf_matrix.tocsr()
+        scipy.sparse.save_npz(os.path.join(index_dir, MATRIX_FILE), tfidf_matrix, compressed=False)
+        scipy.sparse.save_npz(os.path.join(index_dir, POSTINGS_FILE), term_major(tfidf_matrix), compressed=False)
+        scipy.sparse.save_npz(os.path.join(index_dir, BM25_POSTINGS_FILE), bm25_weights(counts), compressed=False)
+        # The raw term counts let a sharded index reweight this index with the IDF of all shards
+        scipy.sparse.save_npz(os.path.join(index_dir, COUNTS_FILE), counts.tocsr(), compressed=False)
+    if manifest is not None:
+        # Files that produced no document (e.g. unreadable PDFs) are left out, so the next update retries them
+        manifest = {filename: entry for filename, entry in manifest.items() if filename in indexed}
+        with open(os.path.join(index_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+
+    meta = {
+        "format_version": INDEX_FORMAT_VERSION,
+        "index_version": uuid.uuid4().hex,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "input_path": input_path,
+        "n_documents": tfidf_matrix.shape[0],
+        "n_terms": len(vocabulary),
+    }
+    with open(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def _replace_index_files(staging, index_dir):
+    # Metadata is removed first and moved in last, so an index whose files are only partly
+    # replaced (e.g. after a crash) is never reported by index_exists
+    meta_path = os.path.join(index_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for filename in sorted(os.listdir(staging)):
+        if filename != META_FILE:
+            os.replace(os.path.join(staging, filename), os.path.join(index_dir, filename))
+    os.replace(os.path.join(staging, META_FILE), meta_path)
+
+
+def iter_cleaned_documents(input_path, filenames=None, workers=None, chunksize=16, batch_size=256, n_process=1,
+                           text_cache=None, hashes=None):
+    """
+    Read, extract and clean PDF documents as a stream: iter_documents -> iter_sections -> process_documents.
+
+    Args:
+    - input_path (str): The path to the folder containing the PDF documents.
+    - filenames (list, optional): Only process these files. By default all PDF files are processed.
+    - workers (int, optional): The number of processes reading the PDF files, see iter_documents.
+    - chunksize (int): The number of files sent to a worker process at once.
+    - batch_size (int): The number of texts processed by spaCy at once.
+    - n_process (int): The number of processes used by spaCy.
+    - text_cache (TextCache, optional): Cache of the texts extracted from the PDF files, see iter_documents.
+    - hashes (dict, optional): The SHA-256 hash of each file, used as cache key.
+
+    Returns:
+    - generator of dict: The cleaned documents with the keys 'filename', 'nazwa', 'sklad' and 'wskazania',
+      in sorted filename order.
+
+    Every stage pulls documents from the previous one only when it needs them, so the number of documents
+    in flight is bounded by the reading chunks and the spaCy batches, not by the size of the corpus.
+    """
+    documents = iter_documents(input_path, filenames, workers, chunksize, text_cache=text_cache, hashes=hashes)
+    return process_documents(iter_sections(documents), batch_size, n_process)
+
+
+def open_text_cache(index_dir):
+    """
+    Open the cache of texts extracted from the PDF files, kept in the index folder across builds.
+    """
+    return TextCache(os.path.join(index_dir, TEXT_CACHE_FILE), extractor_id())
+
+
+def build_index(input_path, index_dir, workers=None, chunksize=16, batch_size=256, n_process=1, text_cache=True, name_range=None):
+    """
+    Read, extract and clean every PDF in the input folder and store the resulting index on disk.
+
+    Args:
+    - input_path (str): The path to the folder containing the PDF documents.
+    - index_dir (str): The path to the index folder.
+    - workers (int, optional): The number of processes reading the PDF files, see iter_documents.
+    - chunksize (int): The number of files sent to a worker process at once.
+    - batch_size (int): The number of texts processed by spaCy at once, see process_documents.
+    - n_process (int): The number of processes used by spaCy.
+    - text_cache (bool): Reuse the texts extracted from unchanged PDF files by previous builds, see open_text_cache.
+    - name_range (list, optional): Only index the files in this range of filenames, see in_name_range.
+
+    Returns:
+    - meta (dict): The metadata of the written index, with an additional "text_cache" entry counting
+      the 'hits' and 'misses' of the text cache when it is used.
+
+    The text cache is keyed on the content hash of the files and the extraction parameters, so
+    rebuilding after a change of the extraction or cleaning rules does not render the PDFs again.
+    """
+    manifest = scan_folder(input_path, name_range=name_range)
+    hashes = {filename: entry["sha256"] for filename, entry in manifest.items()}
+    cache = open_text_cache(index_dir) if text_cache else None
+    try:
+        documents = iter_cleaned_documents(input_path, list(manifest), workers, chunksize, batch_size, n_process, cache, hashes)
+        meta = save_index(index_dir, documents, input_path=input_path, manifest=manifest)
+    finally:
+        if cache is not None:
+            cache.close()
+    if cache is not None:
+        meta["text_cache"] = cache.stats()
+    return meta
+
+
+def update_index(input_path, index_dir, workers=None, chunksize=16, batch_size=256, n_process=1, text_cache=True, name_range=None):
+    """
+    Bring an existing index up to date with the PDF files currently in the input folder.
+
+    Args:
+    - input_path (str): The path to the folder containing the PDF documents.
+    - index_dir (str): The path to the index folder.
+    - workers (int, optional): The number of processes reading the PDF files, see iter_documents.
+    - chunksize (int): The number of files sent to a worker process at once.
+    - batch_size (int): The number of texts processed by spaCy at once, see process_documents.
+    - n_process (int): The number of processes used by spaCy.
+    - text_cache (bool): Reuse the texts extracted from unchanged PDF files by previous builds, see build_index.
+    - name_range (list, optional): Only index the files in this range of filenames, see in_name_range.
+
+    Returns:
+    - meta (dict): The metadata of the written index, with an additional "changes" entry counting
+      the 'added', 'changed', 'removed' and 'unchanged' files.
+
+    Files are compared with the manifest of the previous build by size, modification time and
+    content hash. Only added and changed files are read, extracted and cleaned; documents of removed
+    files are dropped. The TF-IDF representation is then refitted on the already cleaned text,
+    which is cheap compared to the PDF and spaCy stages. Without an existing index (or its manifest)
+    a full build is done.
+    """
+    previous = load_manifest(index_dir)
+    if not index_exists(index_dir) or not previous:
+        return build_index(input_path, index_dir, workers, chunksize, batch_size, n_process, text_cache, name_range)
+
+    current = scan_folder(input_path, previous, name_range)
+
+    added = [filename for filename in current if filename not in previous]
+    changed = [filename for filename in current
+               if filename in previous and current[filename]["sha256"] != previous[filename]["sha256"]]
+    removed = [filename for filename in previous if filename not in current]
+
+    if not (added or changed or removed):
+        # Only modification times may have changed, the stored index stays valid
+        with open(os.path.join(index_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=1)
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        meta["changes"] = {"added": 0, "changed": 0, "removed": 0, "unchanged": len(current)}
+        return meta
+
+    stale = set(changed) | set(removed)
+    stored = load_document_store(index_dir)
+    kept = ({field: doc[field] for field in DOCSTORE_FIELDS} for doc in stored if doc["filename"] not in stale)
+    hashes = {filename: entry["sha256"] for filename, entry in current.items()}
+    cache = open_text_cache(index_dir) if text_cache else None
+    try:
+        new_documents = iter_cleaned_documents(input_path, added + changed, workers, chunksize, batch_size, n_process, cache, hashes)
+        # Both streams are sorted by filename, so the merged index keeps the order of a full build
+        documents = heapq.merge(kept, new_documents, key=lambda doc: doc["filename"])
+        meta = save_index(index_dir, documents, input_path=input_path, manifest=current)
+    finally:
+        if cache is not None:
+            cache.close()
+    meta["changes"] = {
+        "added": len(added),
+        "changed": len(changed),
+        "removed": len(removed),
+        "unchanged": len(current) - len(added) - len(changed),
+    }
+    if cache is not None:
+        meta["text_cache"] = cache.stats()
+    return meta
+
+
+def load_vectorizer(vocabulary, idf):
+    """
+    Recreate a fitted TfidfVectorizer from a stored vocabulary and IDF weights.
+
+    Args:
+    - vocabulary (dict): Mapping of terms to column indices of the TF-IDF matrix.
+    - idf (numpy.ndarray): The IDF weight of every term, in column order.
+
+    Returns:
+    - TfidfVectorizer: A vectorizer that transforms queries exactly like the one fitted at build time.
+    """
+    vectorizer = TfidfVectorizer(vocabulary=vocabulary)
+    vectorizer.idf_ = idf
+    return vectorizer
+
+
+def load_index(index_dir):
+    """
+    Load a corpus index written by save_index.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+
+    Returns:
+    - index (dict): A dictionary with the keys:
+        - "meta": The index metadata.
+        - "documents": The cleaned documents as a DocumentStore. Every document reads like the dictionaries
+          of both convert_to_dict and convert_to_dict_new_file.
+        - "list_of_docs": The same DocumentStore, under the name used by the TF-IDF search.
+        - "vectorizer": The fitted TfidfVectorizer.
+        - "tfidf_matrix": The TF-IDF matrix of the corpus.
+        - "tfidf_postings": The same matrix with one row per term, see term_major.
+        - "bm25_postings": The BM25 weights with one row per term, see bm25_postings, or None
+          for indexes written before they were stored.
+    """
+    with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != INDEX_FORMAT_VERSION:
+        raise ValueError(f"Unsupported index format in {index_dir}. Please rebuild the index.")
+
+    with open(os.path.join(index_dir, VOCABULARY_FILE), encoding="utf-8") as f:
+        vocabulary = json.load(f)
+    idf = np.load(os.path.join(index_dir, IDF_FILE))
+    tfidf_matrix = scipy.sparse.load_npz(os.path.join(index_dir, MATRIX_FILE)).tocsr()
+    postings_path = os.path.join(index_dir, POSTINGS_FILE)
+    if os.path.isfile(postings_path):
+        tfidf_postings = scipy.sparse.load_npz(postings_path).tocsr()
+    else:
+        tfidf_postings = term_major(tfidf_matrix)
+    bm25_path = os.path.join(index_dir, BM25_POSTINGS_FILE)
+    bm25 = scipy.sparse.load_npz(bm25_path).tocsr() if os.path.isfile(bm25_path) else None
+
+    # The documents are memory-mapped, not read: fields are decoded when a result needs them
+    documents = load_document_store(index_dir, datetime.fromisoformat(meta["created"]))
+
+    return {
+        "meta": meta,
+        "documents": documents,
+        "list_of_docs": documents,
+        "vectorizer": load_vectorizer(vocabulary, idf),
+        "tfidf_matrix": tfidf_matrix,
+        "tfidf_postings": tfidf_postings,
+        "bm25_postings": bm25,
+    }
@@ -1,8 +1,78 @@
-import fitz
 import re
-import spacy
 import os
-import pandas as pd
+from utils_profiling import profile_iter, profile_stage
+
+# Replacements are matched in the upper-cased text, so only keys without lower-case letters take effect
+REPLACEMENTS = {
+    "NAZWA WŁASNA": "NAZWA",
+    "LECZNICZNEGO": "LECZNICZEGO ",
+    "LECZNICZEGO": "LECZNICZEGO ",
+    "PODUKTU": "PRODUKTU",
+    "PRODUKU": "PRODUKTU",
+    "PODUKTU": "PRODUKTU",
+    "1.NAZWA ": "1. NAZWA ",
+    "1.NAZWA ": "1. NAZWA ",
+    "1 nazwa" :"1. NAZWA ",
+    "SKLAD": "SKŁAD",
+    "w jamie ustnej skład" : "W JAMIE USTNEJ 2. SKŁAD ",
+    "2. skład" : "2. SKŁAD ",
+    "2 skład" : "2. SKŁAD ",
+    "2.SKŁAD ": "2. SKŁAD ",
+    "2 SKŁAD" :"2. SKŁAD ",
+    "2 skład": "2. SKŁAD ",
+    "4.1 Wskazania": "4.1. Wskazania",
+    "4.1Wskazania": "4.1. Wskazania",
+    "4.1.Wskazania": "4.1. Wskazania",
+    "2.0\\4-": "",
+    "\\":"",
+    "/":"",
+    "jest wskazany": "wskazania"
+}
+
+# Applying REPLACEMENTS one after the other also rewrites text produced by earlier replacements,
+# e.g. "2.SKLAD " -> "2.SKŁAD " -> "2. SKŁAD ". These are all the resulting rewrites, matched in one pass.
+# At the same position, the longer sequences are tried first.
+NORMALIZATION_RULES = [
+    ("1.NAZWA WŁASNA ", "1. NAZWA "),
+    ("1.NAZWA WŁASNA", "1.NAZWA"),
+    ("1.NAZWA ", "1. NAZWA "),
+    ("NAZWA WŁASNA", "NAZWA"),
+    ("LECZNICZNEGO", "LECZNICZEGO  "),
+    ("LECZNICZEGO", "LECZNICZEGO "),
+    ("PODUKTU", "PRODUKTU"),
+    ("PRODUKU", "PRODUKTU"),
+    ("2.SKLAD ", "2. SKŁAD "),
+    ("2.SKŁAD ", "2. SKŁAD "),
+    ("2 SKLAD", "2. SKŁAD "),
+    ("2 SKŁAD", "2. SKŁAD "),
+    ("SKLAD", "SKŁAD"),
+    ("2.0\\4-", ""),
+    ("\\", ""),
+    ("/", ""),
+]
+NORMALIZATION_PATTERN = re.compile("|".join(re.escape(old_value) for old_value, _ in NORMALIZATION_RULES))
+NORMALIZATION_TABLE = dict(NORMALIZATION_RULES)
+
+# Section headers searched in the normalized text. A match of "4.1" or "4.2" also contains a "1", "2" or "2."
+# that the scan does not visit on its own.
+HEADER_PATTERN = re.compile(r"2 skład ilościowy i jakościowy |wskazania|4\.[12]|[23]\.|[12]")
+PRIMARY_HEADERS = ("1", "2.", "3.", "4.1", "4.2")
+
+
+def normalize_text(text):
+    """
+    Apply REPLACEMENTS to a document text and lower-case it.
+
+    Args:
+    - text (str): The raw document text.
+
+    Returns:
+    - str: The lower-cased text, as after applying every replacement in turn to the upper-cased text.
+
+    The text is upper-cased once, rewritten with a single scan of NORMALIZATION_PATTERN and lower-cased once.
+    """
+    return NORMALIZATION_PATTERN.sub(lambda match: NORMALIZATION_TABLE[match.group()], text.upper()).lower()
+
 
 def apply_replacements(df, column):
     """
@@ -11,59 +81,111 @@ def apply_replacements(df, column):
     Args:
     - df (DataFrame): The DataFrame.
     - column (str): The name of the column to apply replacements to.
-    - replacements (dict): A dictionary where keys are old values to be replaced
-      and values are new values.
 
     Returns:
     - df (DataFrame): The DataFrame with replacements applied to the specified column.
     """
-    replacements = {
-        "NAZWA WŁASNA": "NAZWA",
-        "LECZNICZNEGO": "LECZNICZEGO ",
-        "LECZNICZEGO": "LECZNICZEGO ",
-        "PODUKTU": "PRODUKTU",
-        "PRODUKU": "PRODUKTU",
-        "PODUKTU": "PRODUKTU",
-        "1.NAZWA ": "1. NAZWA ",
-        "1.NAZWA ": "1. NAZWA ",
-        "1 nazwa" :"1. NAZWA ",
-        "SKLAD": "SKŁAD",
-        "w jamie ustnej skład" : "W JAMIE USTNEJ 2. SKŁAD ",
-        "2. skład" : "2. SKŁAD ",
-        "2 skład" : "2. SKŁAD ",
-        "2.SKŁAD ": "2. SKŁAD ",
-        "2 SKŁAD" :"2. SKŁAD ",
-        "2 skład": "2. SKŁAD ",
-        "4.1 Wskazania": "4.1. Wskazania",
-        "4.1Wskazania": "4.1. Wskazania",
-        "4.1.Wskazania": "4.1. Wskazania",
-        "2.0\\4-": "",
-        "\\":"",
-        "/":"",
-        "jest wskazany": "wskazania"        
-    }
-    for old_value, new_value in replacements.items():
-        df[column] = df[column].str.upper().str.replace(old_value, new_value).str.lower()
+    with profile_stage("apply_replacements", len(df)):
+        df[column] = df[column].map(normalize_text)
     return df
 
 
+def find_headers(text):
+    """
+    Find the first occurrence of every section header in a normalized text, in one scan.
+
+    Args:
+    - text (str): The normalized document text.
+
+    Returns:
+    - dict: Mapping of each header found ("1", "2", "2.", "2 skład ilościowy i jakościowy ", "3.", "4.1",
+      "4.2", "wskazania") to the position of its first occurrence, as str.find would return it.
+
+    The scan stops as soon as the first occurrence of every header used in the first place
+    ("1", "2.", "3.", "4.1", "4.2") is known.
+    """
+    positions = {}
+    for match in HEADER_PATTERN.finditer(text):
+        header, start = match.group(), match.start()
+        positions.setdefault(header, start)
+        if header[0] == "2":
+            positions.setdefault("2", start)
+        elif header == "4.1":
+            positions.setdefault("1", start + 2)
+        elif header == "4.2":
+            positions.setdefault("2", start + 2)
+            if text.startswith(".", start + 3):
+                positions.setdefault("2.", start + 2)
+        if all(key in positions for key in PRIMARY_HEADERS):
+            break
+    return positions
+
+
+def extract_sections(text):
+    """
+    Split a normalized document text into the product name, composition and indications sections.
+
+    Args:
+    - text (str): The document text, normalized with normalize_text.
+
+    Returns:
+    - tuple: (nazwa, sklad, wskazania), the text between headers 1 and 2, 2 and 3, and 4.1 and 4.2.
+    """
+    positions = find_headers(text)
+    find = lambda header: positions.get(header, -1)
+    #nazwa
+    start_index_nazwa = find("1")
+    end_index_nazwa = find("2.") if find("2.") != -1 else find("2")
+    nazwa = text[start_index_nazwa:end_index_nazwa].strip()
+    #sklad
+    start_index_sklad = find("2.") if find("2.") != -1 else find("2 skład ilościowy i jakościowy ")
+    end_index_sklad = find("3.") if find("3.") != -1 else find("4.1")
+    sklad = text[start_index_sklad:end_index_sklad].strip()
+    #wskazania
+    start_index_wskazania = find("4.1") if find("4.1") != -1 else find("wskazania")
+    end_index_wskazania = find("4.2")
+    wskazania = text[start_index_wskazania:end_index_wskazania].strip()
+    return nazwa, sklad, wskazania
+
+
 def extract_columns(df, column):
-    df = apply_replacements(df, column) 
-    for index, row in df.iterrows():
-        #nazwa
-        start_index_nazwa = row[column].find("1")
-        end_index_nazwa = row[column].find("2.") if row[column].find("2.") != -1 else row[column].find("2")
-        nazwa = row[column][start_index_nazwa:end_index_nazwa].strip()
-        df.at[index, 'nazwa'] = nazwa    
-        #sklad
-        start_index_sklad = row[column].find("2.") if row[column].find("2.") != -1 else row[column].find("2 skład ilościowy i jakościowy ")
-        end_index_sklad = row[column].find("3.") if row[column].find("3.") != -1 else row[column].find("4.1")
-        sklad = row[column][start_index_sklad:end_index_sklad].strip()
-        df.at[index, 'sklad'] = sklad
-        #wskazania
-        start_index_wskazania = row[column].find("4.1") if row[column].find("4.1") != -1 else row[column].find("wskazania") 
-        end_index_wskazania = row[column].find("4.2")
-        wskazania = row[column][start_index_wskazania:end_index_wskazania].strip()
-        df.at[index, 'wskazania'] = wskazania
-        
-    return df[['filename', 'nazwa', 'sklad', 'wskazania']]
+    """
+    Extract the 'nazwa', 'sklad' and 'wskazania' sections of every document.
+
+    Args:
+    - df (DataFrame): The documents, with a 'filename' column.
+    - column (str): The name of the column holding the document text.
+
+    Returns:
+    - DataFrame: Columns 'filename', 'nazwa', 'sklad' and 'wskazania', with the index of df.
+
+    Every text is normalized and split on its own (see extract_sections), so only one document
+    is held in normalized form at a time.
+    """
+    import pandas as pd
+
+    with profile_stage("extract_sections", len(df)):
+        sections = [extract_sections(normalize_text(text)) for text in df[column]]
+    extracted = pd.DataFrame(sections, columns=['nazwa', 'sklad', 'wskazania'], index=df.index)
+    extracted.insert(0, 'filename', df['filename'])
+    return extracted
+
+
+def iter_sections(documents):
+    """
+    Extract the sections of documents one at a time.
+
+    Args:
+    - documents (iterable of tuple): (filename, document text) pairs, e.g. from iter_documents.
+
+    Returns:
+    - generator of dict: One dictionary per document with the keys 'filename', 'nazwa', 'sklad' and 'wskazania',
+      as the rows of extract_columns.
+    """
+    return profile_iter("extract_sections", _iter_sections(documents))
+
+
+def _iter_sections(documents):
+    for filename, text in documents:
+        nazwa, sklad, wskazania = extract_sections(normalize_text(text))
+        yield {'filename': filename, 'nazwa': nazwa, 'sklad': sklad, 'wskazania': wskazania}
@@ -0,0 +1,265 @@
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from utils_data_cleaning import lemmatize_text, lemmatize_texts
+from utils_search_engine import rank_scores
+
+# Scores are rounded to 3 decimals before ranking and ties go to the lowest document id, so pruning
+# keeps every document that could round to the rounded threshold: a score below it by more than
+# half a unit of the last decimal (plus float error) always rounds lower
+ROUNDING_MARGIN = 5e-4 + 1e-9
+
+
+def build_inverted_index(term_postings):
+    """
+    Build an inverted index from a term-major weight matrix.
+
+    Args:
+    - term_postings (scipy.sparse.csr_matrix): Matrix with one row per term and one column per document,
+      e.g. term_major(tfidf_matrix) or bm25_postings(...).
+
+    Returns:
+    - index (dict): A dictionary with the keys:
+        - "indptr": Start of the postings of every term in "doc_ids" and "weights" (length n_terms + 1).
+        - "doc_ids": Document ids of all postings, increasing within a term.
+        - "weights": Weight of the term in the document, for all postings.
+        - "max_weights": The largest weight of every term, used as its score upper bound.
+        - "n_docs": The number of documents.
+    """
+    term_postings = term_postings.tocsr()
+    term_postings.sort_indices()
+    indptr = term_postings.indptr.astype(np.int64)
+    weights = term_postings.data.astype(np.float64)
+    max_weights = np.zeros(term_postings.shape[0])
+    non_empty = np.diff(indptr) > 0
+    if weights.size:
+        max_weights[non_empty] = np.maximum.reduceat(weights, indptr[:-1][non_empty])
+    return {
+        "indptr": indptr,
+        "doc_ids": term_postings.indices.astype(np.int32),
+        "weights": weights,
+        "max_weights": max_weights,
+        "n_docs": term_postings.shape[1],
+    }
+
+
+def bm25_postings(texts, vocabulary, k1=1.2, b=0.75):
+    """
+    Compute Okapi BM25 term weights for a corpus, in term-major layout.
+
+    Args:
+    - texts (list of str): The cleaned text of every document, as used for the TF-IDF matrix.
+    - vocabulary (dict): Mapping of terms to ids, e.g. the vocabulary of the fitted TfidfVectorizer.
+    - k1 (float): Term frequency saturation.
+    - b (float): Document length normalization.
+
+    Returns:
+    - scipy.sparse.csr_matrix: Matrix with one row per term and one column per document, see bm25_weights.
+    """
+    return bm25_weights(CountVectorizer(vocabulary=vocabulary).transform(texts), k1, b)
+
+
+def bm25_weights(counts, k1=1.2, b=0.75, idf=None, average_length=None):
+    """
+    Compute Okapi BM25 term weights from term counts.
+
+    Args:
+    - counts (scipy.sparse.csr_matrix): Term counts with one row per document and one column per term.
+    - k1 (float): Term frequency saturation.
+    - b (float): Document length normalization.
+    - idf (numpy.ndarray, optional): The IDF of every term. Computed from the counts by default; a shard
+      of a larger corpus passes the IDF of the whole corpus.
+    - average_length (float, optional): The average document length, by default the one of the counts.
+
+    Returns:
+    - scipy.sparse.csr_matrix: Matrix with one row per term and one column per document holding
+      idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)).
+    """
+    counts = counts.tocsr().astype(np.float64)
+    n_docs = counts.shape[0]
+    doc_lengths = np.asarray(counts.sum(axis=1)).ravel()
+    if average_length is None:
+        average_length = doc_lengths.mean() if n_docs and doc_lengths.mean() > 0 else 1.0
+    if idf is None:
+        document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = np.log(1.0 + (n_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    rows = np.repeat(np.arange(n_docs), np.diff(counts.indptr))
+    tf = counts.data
+    norm = k1 * (1.0 - b + b * doc_lengths[rows] / average_length)
+    weights = idf[counts.indices] * tf * (k1 + 1.0) / (tf + norm)
+    bm25 = scipy.sparse.csr_matrix((weights, counts.indices, counts.indptr), shape=counts.shape)
+    return bm25.T.tocsr()
+
+
+def search_inverted_index(index, term_ids, query_weights, top_k=10, min_score=0.0):
+    """
+    Retrieve the best scoring documents for a weighted set of query terms.
+
+    Args:
+    - index (dict): Inverted index built with build_inverted_index.
+    - term_ids (numpy.ndarray): Ids of the query terms.
+    - query_weights (numpy.ndarray): Weight of every query term.
+    - top_k (int, optional): The number of documents returned. None returns all matching documents.
+    - min_score (float): Only documents whose rounded score is above this value are returned.
+
+    Returns:
+    - list of tuple: (document id, rounded score) pairs, ordered as by rank_scores.
+
+    The score of a document is the sum of query weight * posting weight over the query terms.
+    Terms are processed by decreasing upper bound (query weight * largest posting weight), as in
+    the MaxScore algorithm: once the remaining terms together cannot lift an unseen document above
+    the current k-th best partial score, their postings are only used to update the documents already
+    found, and candidates that can no longer reach the top-k are dropped. The result is the same as
+    scoring every document.
+    """
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    query_weights = np.asarray(query_weights, dtype=np.float64)
+    upper_bounds = query_weights * index["max_weights"][term_ids]
+    order = np.argsort(-upper_bounds, kind="stable")
+    term_ids, query_weights, upper_bounds = term_ids[order], query_weights[order], upper_bounds[order]
+    # remaining[i]: the largest score a document can get from terms i, i + 1, ...
+    remaining = np.cumsum(upper_bounds[::-1])[::-1]
+
+    indptr, doc_ids, weights = index["indptr"], index["doc_ids"], index["weights"]
+    candidates = np.empty(0, dtype=np.int32)
+    scores = np.empty(0, dtype=np.float64)
+    threshold = -np.inf
+    # The lowest score that can still round to the k-th best rounded score
+    floor = -np.inf
+
+    for position, (term_id, query_weight) in enumerate(zip(term_ids, query_weights)):
+        start, end = indptr[term_id], indptr[term_id + 1]
+        if start == end:
+            continue
+        postings, contributions = doc_ids[start:end], query_weight * weights[start:end]
+
+        if remaining[position] < floor:
+            # No unseen document can reach the top-k any more: only update the candidates
+            # that still can, looking them up in the (sorted) postings of the term
+            reachable = scores + remaining[position] >= floor
+            candidates, scores = candidates[reachable], scores[reachable]
+            locations = np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)
+            found = postings[locations] == candidates
+            scores[found] += contributions[locations[found]]
+        elif not len(candidates):
+            candidates, scores = postings, contributions
+        else:
+            merged = np.concatenate([candidates, postings])
+            candidates, inverse = np.unique(merged, return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate([scores, contributions]))
+
+        if top_k is not None and len(scores) >= top_k:
+            threshold = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+            floor = np.round(threshold, 3) - ROUNDING_MARGIN
+
+    return rank_scores(candidates, scores, top_k, min_score)
+
+
+def vectorizer_vocabulary(vectorizer):
+    """
+    Return the term to id mapping of a vectorizer, fitted or recreated with load_vectorizer.
+    """
+    return getattr(vectorizer, "vocabulary_", None) or vectorizer.vocabulary
+
+
+def corpus_inverted_index(index, scoring="tfidf"):
+    """
+    Build the inverted index of a loaded corpus index.
+
+    Args:
+    - index (dict): The corpus index, as returned by load_index.
+    - scoring (str): "tfidf" uses the stored TF-IDF postings, "bm25" the stored BM25 postings
+      (computed from the documents when the index was written before they were stored).
+
+    Returns:
+    - dict: The inverted index, see build_inverted_index.
+    """
+    if scoring == "tfidf":
+        return build_inverted_index(index["tfidf_postings"])
+    if scoring == "bm25":
+        postings = index.get("bm25_postings")
+        if postings is None:
+            postings = bm25_postings([doc['text'] for doc in index["list_of_docs"]], vectorizer_vocabulary(index["vectorizer"]))
+        return build_inverted_index(postings)
+    raise ValueError(f"Unknown scoring '{scoring}', expected 'tfidf' or 'bm25'")
+
+
+def query_terms(text, vectorizer, scoring="tfidf"):
+    """
+    Turn a lemmatized query into term ids and weights for search_inverted_index.
+
+    Args:
+    - text (str): The lemmatized query.
+    - vectorizer (TfidfVectorizer): The TF-IDF vectorizer fitted on the corpus of products.
+    - scoring (str): "tfidf" weights terms like vectorizer.transform, which makes the ranking identical to
+      search_product_by_indication; "bm25" gives every query term the weight 1.
+
+    Returns:
+    - tuple: (term ids, query weights) as numpy arrays.
+    """
+    if scoring == "tfidf":
+        query_tfidf = vectorizer.transform([text])
+        return query_tfidf.indices, query_tfidf.data
+    vocabulary = vectorizer_vocabulary(vectorizer)
+    term_ids = sorted({vocabulary[term] for term in vectorizer.build_analyzer()(text) if term in vocabulary})
+    return np.asarray(term_ids, dtype=np.int64), np.ones(len(term_ids))
+
+
+def search_product_by_indication_inverted(wskazania_pattern, products, vectorizer, inverted_index, scoring="tfidf", top_k=10, min_score=0.0):
+    """
+    Search for medicinal products by indication using the inverted index.
+
+    Args:
+    - wskazania_pattern (str): The indication pattern to search for.
+    - products (list of dict): The products, as in search_product_by_indication.
+    - vectorizer (TfidfVectorizer): The TF-IDF vectorizer fitted on the corpus of products.
+    - inverted_index (dict): Index built with build_inverted_index from TF-IDF or BM25 postings.
+    - scoring (str): "tfidf" or "bm25", matching the weights of the inverted index.
+    - top_k (int, optional): The maximum number of products returned.
+    - min_score (float): Only products whose rounded score is above this value are returned.
+
+    Returns:
+    - list of dict: Matching products in the format of search_product_by_indication.
+    """
+    if not products:
+        return []
+    term_ids, query_weights = query_terms(lemmatize_text(wskazania_pattern), vectorizer, scoring)
+    ranked = search_inverted_index(inverted_index, term_ids, query_weights, top_k, min_score)
+    return [{'product_name': products[idx]['title'], 'filename': products[idx]['filename'], 'score': score} for idx, score in ranked]
+
+
+def search_products_by_indications_inverted(queries, products, vectorizer, inverted_index, scoring="tfidf", top_k=10, min_score=0.0, batch_size=1000):
+    """
+    Search for medicinal products for many indication queries with the inverted index.
+
+    Args:
+    - queries (iterable of str): The indication patterns to search for.
+    - products (list of dict): The products, as in search_product_by_indication.
+    - vectorizer (TfidfVectorizer): The TF-IDF vectorizer fitted on the corpus of products.
+    - inverted_index (dict): Index built with build_inverted_index.
+    - scoring (str): "tfidf" or "bm25", matching the weights of the inverted index.
+    - top_k (int, optional): The maximum number of products returned per query.
+    - min_score (float): Only products whose rounded score is above this value are returned.
+    - batch_size (int): The number of queries lemmatized together.
+
+    Returns:
+    - generator of tuple: (query, matching products) per query, in input order, as search_products_by_indications.
+    """
+    batch = []
+    for query in queries:
+        batch.append(query)
+        if len(batch) == batch_size:
+            yield from _search_batch_inverted(batch, products, vectorizer, inverted_index, scoring, top_k, min_score)
+            batch = []
+    if batch:
+        yield from _search_batch_inverted(batch, products, vectorizer, inverted_index, scoring, top_k, min_score)
+
+
+def _search_batch_inverted(queries, products, vectorizer, inverted_index, scoring, top_k, min_score):
+    lemmatized_queries = lemmatize_texts([query.lower() for query in queries])
+    for query, lemmatized in zip(queries, lemmatized_queries):
+        term_ids, query_weights = query_terms(lemmatized, vectorizer, scoring)
+        ranked = search_inverted_index(inverted_index, term_ids, query_weights, top_k, min_score)
+        yield query, [{'product_name': products[idx]['title'], 'filename': products[idx]['filename'], 'score': score}
+                      for idx, score in ranked]
@@ -0,0 +1,23 @@
+from utils_sqlite_cache import SQLiteCache
+
+
+class LemmaCache(SQLiteCache):
+    """
+    Bounded cache of spaCy preprocessing results, keyed on the input text.
+
+    Entries are kept in an in-memory LRU of at most `maxsize` items. When `path` is given, entries
+    are also stored in an SQLite file, so they survive between runs. The file remembers the model
+    identifier it was filled with and is emptied when a different model (or model version) is used.
+
+    Args:
+    - maxsize (int): The maximum number of entries kept in memory.
+    - path (str, optional): The path to the SQLite file backing the cache.
+    - model_id (str, optional): Identifier of the spaCy model and version producing the entries.
+    - disk_maxsize (int): The maximum number of entries kept in the SQLite file; the oldest are removed first.
+    """
+
+    VERSION_NAME = "model_id"
+    VALUE_TYPE = "TEXT"
+
+    def __init__(self, maxsize=50000, path=None, model_id=None, disk_maxsize=1000000):
+        super().__init__(maxsize, path, model_id, disk_maxsize)
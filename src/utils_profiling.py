@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Trace events kept at most, so profiling a large ingest run does not fill the memory with events
+MAX_TRACE_EVENTS = 100000
+
+
+def max_rss_mb():
+    """
+    Return the peak resident memory of this process so far in MB, or None where it cannot be read.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+class _Frame:
+    __slots__ = ("name", "start", "children", "items")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.children = 0.0
+        self.items = 0
+
+
+class Profiler:
+    """
+    Records the wall time, item counts and memory of named pipeline stages.
+
+    Stages are timed with the stage context manager or, for streamed stages, by wrapping their iterator with
+    iterate. Stages nest: the self time of a stage excludes the time spent in the stages it calls, so the
+    time of a document stream is attributed to the stage that produced each document (reading, extraction,
+    spaCy, ...) even though every stage pulls from the previous one.
+
+    While disabled (the default), stage returns a shared no-op context and iterate returns the iterator
+    unchanged, so the instrumentation costs nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Remove the recorded statistics and trace events.
+        """
+        with self._lock:
+            self.stats = {}
+            self.events = []
+            self.origin = time.perf_counter()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name):
+        frame = _Frame(name, time.perf_counter())
+        self._stack().append(frame)
+        return frame
+
+    def _exit(self, frame, calls=1):
+        end = time.perf_counter()
+        elapsed = end - frame.start
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        with self._lock:
+            stats = self.stats.setdefault(frame.name, {"calls": 0, "items": 0, "total_s": 0.0, "self_s": 0.0, "max_rss_mb": None})
+            stats["calls"] += calls
+            stats["items"] += frame.items
+            stats["total_s"] += elapsed
+            stats["self_s"] += elapsed - frame.children
+        return end
+
+    def _event(self, name, start, end, **args):
+        with self._lock:
+            if len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append({"name": name, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+                                    "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+            self.stats[name]["max_rss_mb"] = max_rss_mb()
+
+    @contextmanager
+    def _stage(self, name, items):
+        frame = self._enter(name)
+        frame.items = items
+        try:
+            yield frame
+        finally:
+            end = self._exit(frame)
+            self._event(name, frame.start, end, items=frame.items)
+
+    def stage(self, name, items=0):
+        """
+        Time the enclosed block as one call of a stage.
+
+        Args:
+        - name (str): The name of the stage.
+        - items (int): The number of items (documents, texts, queries) the block processes. It can also be set
+          on the returned object inside the block, e.g. `with profiler.stage("encode") as stage: stage.items = n`.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._stage(name, items)
+
+    def iterate(self, name, iterable):
+        """
+        Time a streamed stage: every item taken from the iterable counts as one item of the stage.
+
+        Args:
+        - name (str): The name of the stage.
+        - iterable (iterable): The items produced by the stage.
+
+        Returns:
+        - iterable: The same items.
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        iterator = iter(iterable)
+        first_start = None
+        items = 0
+        try:
+            while True:
+                frame = self._enter(name)
+                first_start = first_start or frame.start
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self._exit(frame, calls=0)
+                    return
+                except BaseException:
+                    self._exit(frame, calls=0)
+                    raise
+                frame.items = 1
+                self._exit(frame, calls=0)
+                items += 1
+                yield item
+        finally:
+            if first_start is not None:
+                with self._lock:
+                    self.stats[name]["calls"] += 1
+                self._event(name, first_start, time.perf_counter(), items=items)
+
+    def summary(self):
+        """
+        Return the recorded statistics, one row per stage ordered by decreasing self time.
+
+        Returns:
+        - list of dict: "stage", "calls", "items", "self_s" (time excluding nested stages), "total_s" (including
+          them), "self_pct" (share of the summed self times), "items_per_s" (items / total_s) and "max_rss_mb"
+          (the peak resident memory of the process when the stage last finished).
+        """
+        with self._lock:
+            stats = {name: dict(values) for name, values in self.stats.items()}
+        total_self = sum(values["self_s"] for values in stats.values()) or 1.0
+        rows = []
+        for name, values in sorted(stats.items(), key=lambda item: -item[1]["self_s"]):
+            rows.append({
+                "stage": name,
+                "calls": values["calls"],
+                "items": values["items"],
+                "self_s": values["self_s"],
+                "total_s": values["total_s"],
+                "self_pct": 100.0 * values["self_s"] / total_self,
+                "items_per_s": values["items"] / values["total_s"] if values["items"] and values["total_s"] > 0 else None,
+                "max_rss_mb": values["max_rss_mb"],
+            })
+        return rows
+
+    def print_summary(self, file=None):
+        """
+        Print the summary as an aligned table (to stderr by default, so it does not mix with CSV results).
+        """
+        file = file or sys.stderr
+        rows = self.summary()
+        if not rows:
+            return
+        columns = list(rows[0])
+        formatted = [["-" if row[column] is None else f"{row[column]:.3f}" if isinstance(row[column], float) else str(row[column])
+                      for column in columns] for row in rows]
+        widths = [max(len(column), *(len(values[i]) for values in formatted)) for i, column in enumerate(columns)]
+        print("  ".join(column.ljust(width) for column, width in zip(columns, widths)), file=file)
+        for values in formatted:
+            print("  ".join(value.ljust(width) for value, width in zip(values, widths)), file=file)
+
+    def write_chrome_trace(self, path):
+        """
+        Write the recorded stages as a Chrome trace (JSON), viewable in chrome://tracing or Perfetto.
+        """
+        with self._lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+
+
+class _NullStage:
+    """
+    The context returned by Profiler.stage while profiling is disabled.
+    """
+
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        # Item counts set inside a disabled stage are dropped
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+profiler = Profiler()
+
+
+def profile_stage(name, items=0):
+    """
+    Time the enclosed block as a stage of the global profiler, see Profiler.stage.
+    """
+    return profiler.stage(name, items)
+
+
+def profile_iter(name, iterable):
+    """
+    Time a streamed stage with the global profiler, see Profiler.iterate.
+    """
+    return profiler.iterate(name, iterable)
+
+
+def start_profiling(trace_path=None, stats_path=None):
+    """
+    Enable the global profiler for the rest of the run and report it when the interpreter exits.
+
+    Args:
+    - trace_path (str, optional): Write the stages as a Chrome trace JSON file to this path.
+    - stats_path (str, optional): Also run cProfile and write its statistics to this path
+      (read them with pstats or snakeviz).
+
+    The summary of the stages is printed to stderr at exit, also when the run fails or is interrupted.
+    """
+    import atexit
+
+    profiler.enable()
+    function_profiler = None
+    if stats_path:
+        import cProfile
+        function_profiler = cProfile.Profile()
+        function_profiler.enable()
+
+    def report():
+        if function_profiler is not None:
+            function_profiler.disable()
+            function_profiler.dump_stats(stats_path)
+            print(f"cProfile statistics written to {stats_path}", file=sys.stderr)
+        profiler.print_summary()
+        if trace_path:
+            profiler.write_chrome_trace(trace_path)
+            print(f"Chrome trace written to {trace_path}", file=sys.stderr)
+
+    atexit.register(report)
@@ -0,0 +1,98 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    """
+    Normalize a query for cache lookups: lowercase, with runs of whitespace collapsed to one space.
+    """
+    return " ".join(query.lower().split())
+
+
+class ResultCache:
+    """
+    Bounded cache of search results, tied to the version of the index that produced them.
+
+    Entries are kept in an in-memory LRU of at most `maxsize` items and, with a `ttl`, expire that many
+    seconds after they were stored. Every lookup passes the version of the index being searched; when it
+    differs from the version of the cached entries, the cache is emptied first, so results of a rebuilt
+    or updated index are never mixed with older ones.
+
+    Args:
+    - maxsize (int): The maximum number of entries. 0 disables the cache.
+    - ttl (float, optional): The lifetime of an entry in seconds. By default entries only leave the cache
+      when they are evicted or the index version changes.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.index_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, index_version):
+        if index_version != self.index_version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.index_version = index_version
+
+    def get(self, key, index_version, count_miss=True):
+        """
+        Return the cached value for the key, or None if it is not cached (or expired, or from another index version).
+
+        The value is shared with other callers and must not be modified. With count_miss=False a miss is not
+        counted, for a second lookup of a request already counted as a miss.
+        """
+        with self._lock:
+            self._check_version(index_version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += count_miss
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, index_version):
+        """
+        Store the value for the key, computed with the given index version.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._check_version(index_version)
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the number of hits and misses, the hit rate, the number of entries held and the number of
+        entries evicted (LRU), expired (TTL) and cache invalidations by a new index version.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries), "evictions": self.evictions, "expirations": self.expirations,
+                "invalidations": self.invalidations}
@@ -1,6 +1,10 @@
+import csv
+import json
+import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
-from utils_data_cleaning import lemmatize_text
+from utils_data_cleaning import lemmatize_text, lemmatize_texts, capitalize_first_letter
+from utils_profiling import profile_stage
 
 
 def prepare_tfidf_representation(documents):
@@ -31,11 +35,26 @@ def prepare_tfidf_representation(documents):
     vectorizer, tfidf_matrix = prepare_tfidf_representation(documents)
     """
     corpus = [doc['text'] for doc in documents]
-    vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(corpus)
+    with profile_stage("tfidf_fit", len(corpus)):
+        vectorizer = TfidfVectorizer()
+        tfidf_matrix = vectorizer.fit_transform(corpus)
     return vectorizer, tfidf_matrix
 
-def search_product_by_indication(wskazania_pattern, products, vectorizer, tfidf_matrix):
+def term_major(tfidf_matrix):
+    """
+    Return the TF-IDF matrix with one row per term (the postings of every term), in CSR format.
+
+    Args:
+    - tfidf_matrix (scipy.sparse.csr_matrix): The TF-IDF matrix with one row per document.
+
+    Returns:
+    - scipy.sparse.csr_matrix: The transposed matrix. Multiplying a query vector with it only reads
+      the postings of the query terms, instead of every document row.
+    """
+    return tfidf_matrix.T.tocsr()
+
+
+def search_product_by_indication(wskazania_pattern, products, vectorizer, tfidf_matrix, top_k=None, min_score=0.0, tfidf_postings=None):
     """
     Search for medicinal products by indication using TF-IDF similarity.
 
@@ -47,6 +66,10 @@ def search_product_by_indication(wskazania_pattern, products, vectorizer, tfidf_
     - vectorizer (TfidfVectorizer): The TF-IDF vectorizer fitted on the corpus of products.
     - tfidf_matrix (scipy.sparse.csr_matrix): The TF-IDF matrix representing the TF-IDF values of each term
                                                in the corpus of products.
+    - top_k (int, optional): The maximum number of products returned. By default all matching products are returned.
+    - min_score (float): Only products whose rounded score is above this value are returned.
+    - tfidf_postings (scipy.sparse.csr_matrix, optional): The matrix returned by term_major(tfidf_matrix).
+                                               It is computed when missing; pass it to avoid that cost per query.
 
     Returns:
     - list of dict: A list of dictionaries representing the matching products sorted by similarity score.
@@ -56,7 +79,9 @@ def search_product_by_indication(wskazania_pattern, products, vectorizer, tfidf_
     This function searches for medicinal products by indication using TF-IDF similarity.
     It first lemmatizes the indication pattern, then transforms it into TF-IDF representation using
     the provided vectorizer. Next, it computes cosine similarity scores between the indication TF-IDF vector
-    and the TF-IDF matrix of products. The scores are rounded and sorted in descending order.
+    and the products: as both have unit length, this is a product with the postings of the query terms,
+    so products sharing no term with the query are never touched. The best top_k scores are selected
+    with a partial sort (see rank_scores), rounded and sorted in descending order.
     Finally, it constructs a list of dictionaries representing the matching products with their filenames
     and similarity scores.
 
@@ -69,12 +94,120 @@ def search_product_by_indication(wskazania_pattern, products, vectorizer, tfidf_
     
     if not products:
         return []
-    lemmatized_wskazania = lemmatize_text(wskazania_pattern)
-    query_tfidf = vectorizer.transform([lemmatized_wskazania])
-    cosine_similarities = cosine_similarity(query_tfidf, tfidf_matrix)
-    scores = list(enumerate(cosine_similarities[0]))
-    rounded_scores = [(index, round(score, 3)) for index, score in scores]
-    sorted_rounded_scores = sorted(rounded_scores, key=lambda x: x[1], reverse=True)
+    if tfidf_postings is None:
+        tfidf_postings = term_major(tfidf_matrix)
+    with profile_stage("query_lemmatize", 1):
+        lemmatized_wskazania = lemmatize_text(wskazania_pattern)
+    with profile_stage("tfidf_search", 1):
+        query_tfidf = vectorizer.transform([lemmatized_wskazania])
+        scores = (query_tfidf @ tfidf_postings).tocsr()
+        sorted_rounded_scores = rank_scores(scores.indices, scores.data, top_k, min_score)
     matching_products = [{'product_name': products[idx]['title'], 'filename': products[idx]['filename'], 'score': score} for idx, score in sorted_rounded_scores]
     return matching_products
 
+
+def rank_scores(doc_indices, scores, top_k=None, min_score=0.0):
+    """
+    Select and order the best scoring documents.
+
+    Args:
+    - doc_indices (numpy.ndarray): Indices of the candidate documents.
+    - scores (numpy.ndarray): The similarity score of every candidate.
+    - top_k (int, optional): The maximum number of documents returned. By default all candidates are returned.
+    - min_score (float): Only documents whose rounded score is above this value are returned.
+
+    Returns:
+    - list of tuple: (document index, score rounded to 3 decimals) pairs, by decreasing score and then
+      by increasing document index, as in search_product_by_indication.
+
+    Only the top_k candidates are sorted; they are selected with a partial sort (argpartition).
+    """
+    doc_indices = np.asarray(doc_indices)
+    rounded = np.round(np.asarray(scores, dtype=np.float64), 3)
+    keep = rounded > min_score
+    doc_indices, rounded = doc_indices[keep], rounded[keep]
+    if top_k is not None and top_k < len(rounded):
+        # Keep every candidate tied with the k-th score, so ties are broken by index like a full sort
+        kth = np.partition(rounded, len(rounded) - top_k)[len(rounded) - top_k]
+        selected = rounded >= kth
+        doc_indices, rounded = doc_indices[selected], rounded[selected]
+    order = np.lexsort((doc_indices, -rounded))[:top_k]
+    return [(int(doc_indices[i]), float(rounded[i])) for i in order]
+
+
+def search_products_by_indications(queries, products, vectorizer, tfidf_matrix, top_k=10, min_score=0.0, batch_size=1000, tfidf_postings=None):
+    """
+    Search for medicinal products for many indication queries at once.
+
+    Args:
+    - queries (iterable of str): The indication patterns to search for.
+    - products (list of dict): The products, as in search_product_by_indication.
+    - vectorizer (TfidfVectorizer): The TF-IDF vectorizer fitted on the corpus of products.
+    - tfidf_matrix (scipy.sparse.csr_matrix): The TF-IDF matrix of the corpus of products.
+    - top_k (int, optional): The maximum number of products returned per query.
+    - min_score (float): Only products scoring above this value are returned.
+    - batch_size (int): The number of queries lemmatized and scored together.
+    - tfidf_postings (scipy.sparse.csr_matrix, optional): The matrix returned by term_major(tfidf_matrix).
+
+    Returns:
+    - generator of tuple: (query, matching products) per query, in input order. The matching products
+      have the same format as the result of search_product_by_indication.
+
+    Every batch of queries is lemmatized in one nlp.pipe pass and scored with one sparse matrix product.
+    As the rows of the TF-IDF matrix and of the transformed queries have unit length, the product
+    gives the cosine similarities, and only documents sharing a term with a query get a score.
+    """
+    if tfidf_postings is None:
+        tfidf_postings = term_major(tfidf_matrix)
+    batch = []
+    for query in queries:
+        batch.append(query)
+        if len(batch) == batch_size:
+            yield from _search_batch(batch, products, vectorizer, tfidf_postings, top_k, min_score)
+            batch = []
+    if batch:
+        yield from _search_batch(batch, products, vectorizer, tfidf_postings, top_k, min_score)
+
+
+def _search_batch(queries, products, vectorizer, tfidf_postings, top_k, min_score):
+    with profile_stage("query_lemmatize", len(queries)):
+        lemmatized_queries = lemmatize_texts([query.lower() for query in queries])
+    with profile_stage("tfidf_search", len(queries)):
+        query_tfidf = vectorizer.transform(lemmatized_queries)
+        scores = (query_tfidf @ tfidf_postings).tocsr()
+    for row, query in enumerate(queries):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        ranked = rank_scores(scores.indices[start:end], scores.data[start:end], top_k, min_score)
+        yield query, [{'product_name': products[idx]['title'], 'filename': products[idx]['filename'], 'score': score}
+                      for idx, score in ranked]
+
+
+def write_search_results(results, output, output_format="csv"):
+    """
+    Write the results of search_products_by_indications as they are produced.
+
+    Args:
+    - results (iterable of tuple): (query, matching products) pairs.
+    - output (file): A text file opened for writing.
+    - output_format (str): "csv" writes one row per query and product (query, rank, filename,
+      product_name, score); "jsonl" writes one JSON object per query. Product names are capitalized
+      as in the -q output of main.py.
+
+    Returns:
+    - int: The number of queries written.
+    """
+    writer = None
+    if output_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(["query", "rank", "filename", "product_name", "score"])
+    count = 0
+    for query, matching_products in results:
+        rows = [{'filename': product['filename'], 'product_name': capitalize_first_letter(product['product_name']),
+                 'score': product['score']} for product in matching_products]
+        if writer is not None:
+            for rank, product in enumerate(rows, start=1):
+                writer.writerow([query, rank, product['filename'], product['product_name'], f"{product['score']:.3f}"])
+        else:
+            output.write(json.dumps({"query": query, "results": rows}, ensure_ascii=False) + "\n")
+        count += 1
+    return count
@@ -1,99 +1,341 @@
-from sentence_transformers import SentenceTransformer
+import csv
+import json
 import numpy as np
-import faiss
+from collections import OrderedDict
 from utils_dataprep import read_documents, load_to_pd
 from utils_info_extract import extract_columns, apply_replacements
 from utils_data_cleaning import process_text_columns, convert_to_dict, capitalize_first_letter,convert_to_dict_new_file
-from sklearn.metrics.pairwise import cosine_similarity
+from utils_embedding_store import encode_texts, document_digest
+from utils_index import iter_cleaned_documents
+from utils_faiss_index import build_field_index, search_field_index
+from utils_hybrid_search import DEFAULT_FIELD_WEIGHTS, DenseField, SparseField, hybrid_search
+from utils_profiling import profile_stage
 
 
+def load_new_documents(input_file, filenames=None):
+    """
+    Load, extract and clean the PDF documents to be compared with the corpus.
+
+    Parameters:
+        input_file (str): The path to the folder with the new files.
+        filenames (list, optional): Only load these files from the folder.
+
+    Returns:
+        list: List of dictionaries with the keys "filename", "nazwa", "sklad" and "wskazania".
+    """
+    new_file_df = load_to_pd(input_file, filenames)
+    if new_file_df.empty:
+        return []
+    new_file_extracted = extract_columns(new_file_df, 'CHPCL')
+    new_file_cleaned = process_text_columns(new_file_extracted)
+    return convert_to_dict_new_file(new_file_cleaned)
+
+
+def corpus_embeddings(field, list_of_docs, model, embeddings=None):
+    """
+    Return the normalized embeddings of a field of the existing documents.
 
+    Parameters:
+        field (str): The document field, 'sklad' or 'wskazania'.
+        list_of_docs (list): List of dictionaries containing information about existing documents.
+        model (SentenceTransformer): SentenceTransformer model, used only when no stored embeddings are given.
+        embeddings (dict, optional): Embedding store loaded with load_embedding_store, aligned with list_of_docs.
+
+    Returns:
+        numpy.ndarray: float32 array with one normalized embedding per document.
+    """
+    if embeddings is not None:
+        return embeddings[field]
+    return encode_texts(model, [doc[field] for doc in list_of_docs])
+
+
+def field_indexes(fields, list_of_docs, model, embeddings=None, indexes=None):
+    """
+    Return the FAISS index of every field, building exact indexes for the ones not given.
+
+    Parameters:
+        fields (list): The document fields, 'sklad' and/or 'wskazania'.
+        list_of_docs (list): List of dictionaries containing information about existing documents.
+        model (SentenceTransformer): SentenceTransformer model, used only when no stored embeddings are given.
+        embeddings (dict, optional): Embedding store loaded with load_embedding_store.
+        indexes (dict, optional): Prebuilt indexes per field (see ensure_field_indexes).
+
+    Returns:
+        dict: Mapping of each field to its FAISS index.
+    """
+    indexes = dict(indexes or {})
+    for field in fields:
+        if field not in indexes:
+            indexes[field] = build_field_index(corpus_embeddings(field, list_of_docs, model, embeddings))
+    return indexes
+
+
+def find_similar_documents(new_file_list_of_docs, list_of_docs, model, embeddings=None, top_k=150, indexes=None,
+                           weights=None, fusion="weighted", tfidf=None):
+    """
+    Find the existing documents most similar to each new document.
+
+    Parameters:
+        new_file_list_of_docs (list): The new documents, as returned by load_new_documents.
+        list_of_docs (list): List of dictionaries containing information about existing documents.
+        model (SentenceTransformer): SentenceTransformer model for computing embeddings.
+        embeddings (dict, optional): Stored embeddings of the existing documents (see load_embedding_store).
+            When missing, the existing documents are encoded.
+        top_k (int): The number of documents retrieved per field and returned per new document.
+        indexes (dict, optional): FAISS indexes per field (see ensure_field_indexes). Exact indexes are
+            built from the embeddings when missing.
+        weights (dict, optional): Weights of the 'sklad', 'wskazania' and 'tfidf' fields, overriding
+            DEFAULT_FIELD_WEIGHTS (both embedding fields with weight 1, no TF-IDF).
+        fusion (str): "weighted" or "rrf", see fuse_scores.
+        tfidf (tuple, optional): (vectorizer, tfidf_postings) of the corpus index, needed for a 'tfidf' weight.
+
+    Returns:
+        list: One (new document, matches) tuple per new document, where matches is a list of
+        (existing document, combined score) tuples by decreasing score.
+
+    Candidates retrieved from every field are merged and scored in all fields, so the combined score
+    of a document is computed from its own field scores (see hybrid_search).
+    """
+    matches = similar_document_indices(new_file_list_of_docs, list_of_docs, model, embeddings, top_k, indexes,
+                                       weights, fusion, tfidf)
+    return [(new_doc, [(list_of_docs[int(idx)], float(score)) for idx, score in zip(*found)])
+            for new_doc, found in zip(new_file_list_of_docs, matches)]
+
+
+def similar_document_indices(new_file_list_of_docs, list_of_docs, model, embeddings=None, top_k=150, indexes=None,
+                             weights=None, fusion="weighted", tfidf=None):
+    """
+    Find the existing documents most similar to each new document, as positions in list_of_docs.
+
+    Parameters:
+        The same as find_similar_documents.
 
-def process_new_files_similarity(input_file, list_of_docs, text_cleaned, model):
+    Returns:
+        list: One (document indices, combined scores) pair of numpy arrays per new document, by decreasing score.
+    """
+    if not new_file_list_of_docs:
+        return []
+
+    weights = {**DEFAULT_FIELD_WEIGHTS, **(weights or {})}
+    dense_fields = [field for field in ['sklad', 'wskazania'] if weights.get(field, 0) > 0]
+    vectors = {field: corpus_embeddings(field, list_of_docs, model, embeddings) for field in dense_fields}
+    indexes = field_indexes(dense_fields, list_of_docs, model, vectors, indexes)
+
+    fields = {}
+    for field in dense_fields:
+        query_embeddings = encode_texts(model, [doc[field] for doc in new_file_list_of_docs])
+        fields[field] = DenseField(query_embeddings, vectors[field], indexes[field])
+    if weights.get('tfidf', 0) > 0:
+        if tfidf is None:
+            raise ValueError("A 'tfidf' weight needs the TF-IDF vectorizer and postings of the index.")
+        vectorizer, tfidf_postings = tfidf
+        with profile_stage("tfidf_transform", len(new_file_list_of_docs)):
+            query_vectors = vectorizer.transform([doc['sklad'] + " " + doc['wskazania'] for doc in new_file_list_of_docs])
+        fields['tfidf'] = SparseField(query_vectors, tfidf_postings)
+
+    with profile_stage("similarity_search", len(new_file_list_of_docs)):
+        scores, indices, _ = hybrid_search(fields, top_k, weights, fusion)
+
+    found = indices >= 0
+    return [(indices[row][found[row]].astype(np.int64), scores[row][found[row]].astype(np.float64))
+            for row in range(len(new_file_list_of_docs))]
+
+
+def process_new_files_similarity(input_file, list_of_docs, text_cleaned, model, embeddings=None, top_k=150, indexes=None,
+                                 weights=None, fusion="weighted", tfidf=None):
     """
     Process new files for similarity search.
 
     Parameters:
         input_file (str): The path to the new file to be processed.
         list_of_docs (list): List of dictionaries containing information about existing documents.
-        text_cleaned (DataFrame): DataFrame containing cleaned text data.
+        text_cleaned (DataFrame, optional): Not used, the documents are read from list_of_docs.
         model (SentenceTransformer): SentenceTransformer model for computing embeddings.
+        embeddings (dict, optional): Stored embeddings of the existing documents (see load_embedding_store).
+            When missing, the existing documents are encoded.
+        top_k (int): The number of documents retrieved per field and printed per new file.
+        indexes (dict, optional): FAISS indexes per field (see ensure_field_indexes). Exact indexes are
+            built from the embeddings when missing.
+        weights (dict, optional): Weights of the 'sklad', 'wskazania' and 'tfidf' fields, see find_similar_documents.
+        fusion (str): "weighted" or "rrf", see fuse_scores.
+        tfidf (tuple, optional): (vectorizer, tfidf_postings) of the corpus index, needed for a 'tfidf' weight.
 
     Returns:
         None: Prints the results of the similarity search.
     """
-    new_file_df = load_to_pd(input_file)
-    new_file_extracted = extract_columns(new_file_df, 'CHPCL')
-    new_file_cleaned = process_text_columns(new_file_extracted)
-    new_file_list_of_docs = convert_to_dict_new_file(new_file_cleaned)
+    new_file_list_of_docs = load_new_documents(input_file)
+    results = find_similar_documents(new_file_list_of_docs, list_of_docs, model, embeddings, top_k, indexes, weights, fusion, tfidf)
 
-    
-    existing_doc_embeddings_sklad = model.encode([doc['sklad'] for doc in list_of_docs])
-    existing_doc_embeddings_wskazania = model.encode([doc['wskazania'] for doc in list_of_docs])
+    for new_doc, matches in results:
+        print(f"Results for file: {new_doc['filename']}")
+        
+        for doc, combined_score in matches:
+            if combined_score > 0.0:
+                print(f"{doc['filename']},\"{capitalize_first_letter(doc['nazwa'])}\",{combined_score:.3f}")
+        print()
 
-    new_doc_embeddings_sklad = model.encode([doc['sklad'] for doc in new_file_list_of_docs])
-    new_doc_embeddings_wskazania = model.encode([doc['wskazania'] for doc in new_file_list_of_docs])
 
-    
-    index_sklad = faiss.IndexFlatL2(existing_doc_embeddings_sklad[0].shape[0])
-    index_wskazania = faiss.IndexFlatL2(existing_doc_embeddings_wskazania[0].shape[0])
+def iter_similar_documents(new_documents, list_of_docs, model, embeddings=None, top_k=150, indexes=None, batch_size=256,
+                           weights=None, fusion="weighted", tfidf=None, max_cached=10000):
+    """
+    Find the existing documents most similar to a stream of new documents, one batch at a time.
 
-    index_sklad.add(np.array(existing_doc_embeddings_sklad))
-    index_wskazania.add(np.array(existing_doc_embeddings_wskazania))
+    Parameters:
+        new_documents (iterable): The new documents, dictionaries with the keys "filename", "nazwa",
+            "sklad" and "wskazania", e.g. from iter_cleaned_documents.
+        list_of_docs (list): List of dictionaries containing information about existing documents.
+        model (SentenceTransformer): SentenceTransformer model for computing embeddings.
+        embeddings (dict, optional): Stored embeddings of the existing documents (see load_embedding_store).
+        top_k (int): The number of documents retrieved per field and returned per new document.
+        indexes (dict, optional): FAISS indexes per field (see ensure_field_indexes).
+        batch_size (int): The number of new documents encoded and searched together.
+        weights (dict, optional): Weights of the 'sklad', 'wskazania' and 'tfidf' fields, see find_similar_documents.
+        fusion (str): "weighted" or "rrf", see fuse_scores.
+        tfidf (tuple, optional): (vectorizer, tfidf_postings) of the corpus index, needed for a 'tfidf' weight.
+        max_cached (int): The number of distinct new documents whose matches are kept for their duplicates.
 
-    for new_doc_sklad, new_embedding_sklad, new_doc_wskazania, new_embedding_wskazania in zip(new_file_list_of_docs, new_doc_embeddings_sklad, new_file_list_of_docs, new_doc_embeddings_wskazania):
-        _, indices_sklad = index_sklad.search(np.array([new_embedding_sklad]), 150)
-        _, indices_wskazania = index_wskazania.search(np.array([new_embedding_wskazania]), 150)
+    Returns:
+        generator: One (new document, matches, duplicate_of) tuple per new document, in input order.
+        matches is as in find_similar_documents. duplicate_of is the filename of an earlier new document
+        with the same cleaned 'sklad' and 'wskazania', or None.
+
+    Every batch is encoded with one call of the model per field and searched with one matrix query per
+    FAISS index. Documents identical to one of the last max_cached distinct documents reuse its matches,
+    kept as document indices and scores, and are neither encoded nor searched; a duplicate of an older
+    document is searched again. Only the content digest and filename of every distinct document are kept
+    for the whole stream, to report duplicate_of.
+    """
+    if embeddings is None:
+        embeddings = {field: corpus_embeddings(field, list_of_docs, model) for field in ['sklad', 'wskazania']}
+    indexes = field_indexes(['sklad', 'wskazania'], list_of_docs, model, embeddings, indexes)
+    first_filenames = {}
+    cached = OrderedDict()
+
+    def search_batch(batch):
+        digests = [document_digest(doc) for doc in batch]
+        found = {digest: cached[digest] for digest in digests if digest in cached}
+        unique = {}
+        for doc, digest in zip(batch, digests):
+            if digest not in found and digest not in unique:
+                unique[digest] = doc
+        found.update(zip(unique, similar_document_indices(list(unique.values()), list_of_docs, model, embeddings, top_k,
+                                                          indexes, weights, fusion, tfidf)))
+        for digest, matches in found.items():
+            cached[digest] = matches
+            cached.move_to_end(digest)
+        while len(cached) > max_cached:
+            cached.popitem(last=False)
+        for doc, digest in zip(batch, digests):
+            filename = first_filenames.setdefault(digest, doc['filename'])
+            matches = [(list_of_docs[int(idx)], float(score)) for idx, score in zip(*found[digest])]
+            yield doc, matches, (filename if filename != doc['filename'] else None)
+
+    batch = []
+    for doc in new_documents:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield from search_batch(batch)
+            batch = []
+    if batch:
+        yield from search_batch(batch)
+
+
+def write_similarity_results(results, output, output_format="csv", min_score=0.0):
+    """
+    Write the results of iter_similar_documents as they are produced.
 
-        top_documents_sklad = [(list_of_docs[idx], cosine_similarity([new_embedding_sklad], [model.encode([list_of_docs[idx]['sklad']])[0]])[0][0]) for idx in indices_sklad[0]]
+    Parameters:
+        results (iterable): (new document, matches, duplicate_of) tuples.
+        output (file): A text file opened for writing.
+        output_format (str): "csv" writes one row per new document and match (new_filename, duplicate_of,
+            rank, filename, product_name, score); "jsonl" writes one JSON object per new document.
+        min_score (float): Only matches scoring above this value are written, as in the -f output.
 
-        top_documents_wskazania = [(list_of_docs[idx], cosine_similarity([new_embedding_wskazania], [model.encode([list_of_docs[idx]['wskazania']])[0]])[0][0]) for idx in indices_wskazania[0]]
+    Returns:
+        int: The number of new documents written.
+    """
+    writer = None
+    if output_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(["new_filename", "duplicate_of", "rank", "filename", "product_name", "score"])
+    count = 0
+    for new_doc, matches, duplicate_of in results:
+        rows = [{'filename': doc['filename'], 'product_name': capitalize_first_letter(doc['nazwa']), 'score': score}
+                for doc, score in matches if score > min_score]
+        if writer is not None:
+            for rank, row in enumerate(rows, start=1):
+                writer.writerow([new_doc['filename'], duplicate_of or "", rank, row['filename'], row['product_name'], f"{row['score']:.3f}"])
+        else:
+            output.write(json.dumps({"filename": new_doc['filename'], "duplicate_of": duplicate_of, "results": rows},
+                                    ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def process_new_files_similarity_batch(input_file, list_of_docs, model, output, output_format="csv", embeddings=None,
+                                       top_k=150, indexes=None, batch_size=256, workers=None, weights=None,
+                                       fusion="weighted", tfidf=None):
+    """
+    Compare a folder of new files with the corpus in batches and write the results to a file.
 
-        print(f"Results for file: {new_doc_sklad['filename']}")
-        
-        for i, ((doc_sklad, score_sklad), (doc_wskazania, score_wskazania)) in enumerate(zip(top_documents_sklad, top_documents_wskazania), start=1):
-            combined_score = (score_sklad + score_wskazania) / 2
-            if combined_score > 0.0:
-                print(f"{doc_sklad['filename']},\"{capitalize_first_letter(doc_sklad['nazwa'])}\",{combined_score:.3f}")
-        print()
+    Parameters:
+        input_file (str): The path to the folder with the new files.
+        list_of_docs (list): List of dictionaries containing information about existing documents.
+        model (SentenceTransformer): SentenceTransformer model for computing embeddings.
+        output (file): A text file opened for writing.
+        output_format (str): "csv" or "jsonl", see write_similarity_results.
+        embeddings (dict, optional): Stored embeddings of the existing documents (see load_embedding_store).
+        top_k (int): The number of documents retrieved per field and returned per new document.
+        indexes (dict, optional): FAISS indexes per field (see ensure_field_indexes).
+        batch_size (int): The number of new documents encoded and searched together.
+        workers (int, optional): The number of processes reading the PDF files, see iter_documents.
+        weights (dict, optional): Weights of the 'sklad', 'wskazania' and 'tfidf' fields, see find_similar_documents.
+        fusion (str): "weighted" or "rrf", see fuse_scores.
+        tfidf (tuple, optional): (vectorizer, tfidf_postings) of the corpus index, needed for a 'tfidf' weight.
+
+    Returns:
+        int: The number of new documents written.
 
-def process_new_files_similarity_sklad_only(input_file, list_of_docs, text_cleaned, model):
+    The files are read, cleaned, encoded and searched as a stream, so only one batch of new documents
+    is held in memory at a time, with the matches of the last distinct documents (see iter_similar_documents).
+    """
+    new_documents = iter_cleaned_documents(input_file, workers=workers, batch_size=batch_size)
+    results = iter_similar_documents(new_documents, list_of_docs, model, embeddings, top_k, indexes, batch_size,
+                                     weights, fusion, tfidf)
+    return write_similarity_results(results, output, output_format)
+
+
+def process_new_files_similarity_sklad_only(input_file, list_of_docs, text_cleaned, model, embeddings=None, top_k=150, indexes=None):
     """
     Process new files for similarity search based on the 'sklad' key.
 
     Parameters:
         input_file (str): The path to the new file to be processed.
         list_of_docs (list): List of dictionaries containing information about existing documents.
-        text_cleaned (DataFrame): DataFrame containing cleaned text data.
+        text_cleaned (DataFrame, optional): Not used, the documents are read from list_of_docs.
         model (SentenceTransformer): SentenceTransformer model for computing embeddings.
+        embeddings (dict, optional): Stored embeddings of the existing documents (see load_embedding_store).
+            When missing, the existing documents are encoded.
+        top_k (int): The number of most similar documents retrieved.
+        indexes (dict, optional): FAISS indexes per field (see ensure_field_indexes). An exact index is
+            built from the embeddings when missing.
 
     Returns:
         None: Prints the results of the similarity search.
     """
     # Load and process the new file
-    new_file_df = load_to_pd(input_file)
-    new_file_extracted = extract_columns(new_file_df, 'CHPCL')
-    new_file_cleaned = process_text_columns(new_file_extracted)
-    new_file_list_of_docs = convert_to_dict_new_file(new_file_cleaned)
-
-    # Compute embeddings for the existing documents and the new file
-    existing_doc_embeddings_sklad = model.encode([doc['sklad'] for doc in list_of_docs])
-    new_doc_embeddings_sklad = model.encode([doc['sklad'] for doc in new_file_list_of_docs])
-
-    # Initialize the FAISS index and add the embeddings
-    index_sklad = faiss.IndexFlatL2(existing_doc_embeddings_sklad[0].shape[0])
-    index_sklad.add(np.array(existing_doc_embeddings_sklad))
+    new_file_list_of_docs = load_new_documents(input_file)
+    if not new_file_list_of_docs:
+        return
 
-    for new_doc_sklad, new_embedding_sklad in zip(new_file_list_of_docs, new_doc_embeddings_sklad):
-        ##_, indices_sklad = index_sklad.search(np.array([new_embedding_sklad]), 5)
-        D, indices_sklad = index_sklad.search(np.array([new_embedding_sklad]), len(existing_doc_embeddings_sklad))
+    # Index the stored embeddings and encode only the new file
+    index_sklad = field_indexes(['sklad'], list_of_docs, model, embeddings, indexes)['sklad']
+    new_doc_embeddings_sklad = encode_texts(model, [doc['sklad'] for doc in new_file_list_of_docs])
 
+    scores_sklad, indices_sklad = search_field_index(index_sklad, new_doc_embeddings_sklad, top_k)
 
-        #top_documents_sklad = [(list_of_docs[idx], cosine_similarity([new_embedding_sklad], [model.encode([list_of_docs[idx]['sklad']])[0]])[0][0]) for idx in indices_sklad[0]]
-        top_documents_sklad = [
-            (list_of_docs[idx], cosine_similarity([new_embedding_sklad], [model.encode([list_of_docs[idx]['sklad']])[0]])[0][0])
-            for idx in indices_sklad[0]
-        ]
+    for row, new_doc_sklad in enumerate(new_file_list_of_docs):
+        top_documents_sklad = [(list_of_docs[idx], score) for idx, score in zip(indices_sklad[row], scores_sklad[row]) if idx >= 0]
 
         print(f"Results for file: {new_doc_sklad['filename']}")
             
@@ -102,44 +344,37 @@ def process_new_files_similarity_sklad_only(input_file, list_of_docs, text_clean
                 print(f"{doc_sklad['filename']},\"{capitalize_first_letter(doc_sklad['nazwa'])}\",{score_sklad:.3f}")
         print()
 
-def process_new_files_similarity_only_wskazania(input_file, list_of_docs, text_cleaned, model):
+def process_new_files_similarity_only_wskazania(input_file, list_of_docs, text_cleaned, model, embeddings=None, top_k=150, indexes=None):
     """
     Process new files for similarity search based on the 'wskazania' key.
 
     Parameters:
         input_file (str): The path to the new file to be processed.
         list_of_docs (list): List of dictionaries containing information about existing documents.
-        text_cleaned (DataFrame): DataFrame containing cleaned text data.
+        text_cleaned (DataFrame, optional): Not used, the documents are read from list_of_docs.
         model (SentenceTransformer): SentenceTransformer model for computing embeddings.
+        embeddings (dict, optional): Stored embeddings of the existing documents (see load_embedding_store).
+            When missing, the existing documents are encoded.
+        top_k (int): The number of most similar documents retrieved.
+        indexes (dict, optional): FAISS indexes per field (see ensure_field_indexes). An exact index is
+            built from the embeddings when missing.
 
     Returns:
         None: Prints the results of the similarity search.
     """
     # Load and process the new file
-    new_file_df = load_to_pd(input_file)
-    new_file_extracted = extract_columns(new_file_df, 'CHPCL')
-    new_file_cleaned = process_text_columns(new_file_extracted)
-    new_file_list_of_docs = convert_to_dict_new_file(new_file_cleaned)
-
-    # Compute embeddings for the existing documents and the new file
-    existing_doc_embeddings_wskazania = model.encode([doc['wskazania'] for doc in list_of_docs])
-    new_doc_embeddings_wskazania = model.encode([doc['wskazania'] for doc in new_file_list_of_docs])
-
-    # Initialize the FAISS index and add the embeddings
-    index_wskazania = faiss.IndexFlatL2(existing_doc_embeddings_wskazania[0].shape[0])
-    index_wskazania.add(np.array(existing_doc_embeddings_wskazania))
-    
-    for new_doc_wskazania, new_embedding_wskazania in zip(new_file_list_of_docs, new_doc_embeddings_wskazania):
-        # Search the entire index
-        D, indices_wskazania = index_wskazania.search(np.array([new_embedding_wskazania]), len(existing_doc_embeddings_wskazania))
-        #_, indices_wskazania = index_wskazania.search(np.array([new_embedding_wskazania]), 5)
-
-        # Compute cosine similarity for the retrieved documents
-        top_documents_wskazania = [
-            (list_of_docs[idx], cosine_similarity([new_embedding_wskazania], [model.encode([list_of_docs[idx]['wskazania']])[0]])[0][0])
-            for idx in indices_wskazania[0]
-        ]
-        #top_documents_wskazania = [(list_of_docs[idx], cosine_similarity([new_embedding_wskazania], [model.encode([list_of_docs[idx]['wskazania']])[0]])[0][0]) for idx in indices_wskazania[0]]
+    new_file_list_of_docs = load_new_documents(input_file)
+    if not new_file_list_of_docs:
+        return
+
+    # Index the stored embeddings and encode only the new file
+    index_wskazania = field_indexes(['wskazania'], list_of_docs, model, embeddings, indexes)['wskazania']
+    new_doc_embeddings_wskazania = encode_texts(model, [doc['wskazania'] for doc in new_file_list_of_docs])
+
+    scores_wskazania, indices_wskazania = search_field_index(index_wskazania, new_doc_embeddings_wskazania, top_k)
+
+    for row, new_doc_wskazania in enumerate(new_file_list_of_docs):
+        top_documents_wskazania = [(list_of_docs[idx], score) for idx, score in zip(indices_wskazania[row], scores_wskazania[row]) if idx >= 0]
 
         print(f"Results for file: {new_doc_wskazania['filename']}")
         
@@ -147,5 +382,3 @@ def process_new_files_similarity_only_wskazania(input_file, list_of_docs, text_c
             if score_wskazania > 0.0:
                 print(f"{doc_wskazania['filename']},\"{capitalize_first_letter(doc_wskazania['nazwa'])}\",{score_wskazania:.3f}")
         print()
-
-
@@ -0,0 +1,460 @@
+import os
+import json
+import tempfile
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from utils_index import META_FILE, load_index
+from utils_data_cleaning import capitalize_first_letter, lemmatize_texts
+from utils_search_engine import rank_scores
+from utils_inverted_index import corpus_inverted_index, query_terms, search_inverted_index
+from utils_shards import SHARDS_FILE, is_sharded, load_sharded_index, search_shards
+from utils_result_cache import ResultCache, normalize_query
+from utils_profiling import profile_stage
+
+MAX_BODY_SIZE = 50 * 1024 * 1024
+
+
+class SearchService:
+    """
+    Keeps the corpus index, spaCy and (optionally) the sentence encoder with its FAISS indexes loaded,
+    and answers indication queries and similarity requests from any thread.
+
+    Indication search results are cached (see ResultCache), keyed on the normalized query, and on its
+    lemmatized form, together with top_k, min_score and the scoring. Queries are scored as the -q mode of
+    main.py with the same --scoring and --inverted-index options. With a reload_interval, the service
+    checks that often whether the index was rebuilt or updated on disk and then loads the new version;
+    the cached results of the previous version are dropped on the next search.
+
+    Args:
+    - index_dir (str): The path to the index folder, holding an index or a sharded index.
+    - with_similarity (bool): Also load the sentence encoder, the embedding store and the FAISS indexes.
+    - ann_backend (str): The FAISS backend used for similarity requests.
+    - encoder (str): The sentence encoder backend, see load_encoder.
+    - cache_size (int): The maximum number of cached search results, 0 disables the cache.
+    - cache_ttl (float, optional): The lifetime of a cached result in seconds, see ResultCache.
+    - reload_interval (float, optional): Check for a new version of the index at most this often, in seconds.
+      By default the index loaded at start is served until the service stops.
+    - scoring (str): "tfidf" or "bm25". BM25 scoring of an unsharded index uses its inverted index.
+    - inverted_index (bool): Score TF-IDF queries of an unsharded index with the inverted index (see
+      search_inverted_index) instead of the sparse matrix product. Sharded indexes are always searched by shard.
+    """
+
+    def __init__(self, index_dir, with_similarity=True, ann_backend="flat", encoder="torch", cache_size=10000,
+                 cache_ttl=None, reload_interval=None, scoring="tfidf", inverted_index=False):
+        if scoring not in ("tfidf", "bm25"):
+            raise ValueError(f"Unknown scoring '{scoring}', expected 'tfidf' or 'bm25'")
+        self.index_dir = index_dir
+        self.scoring = scoring
+        self.use_inverted_index = inverted_index or scoring == "bm25"
+        self.ann_backend = ann_backend
+        self.encoder = encoder
+        self.model = None
+        self.cache = ResultCache(cache_size, cache_ttl)
+        self.reload_interval = reload_interval
+        self._checked = time.monotonic()
+        # spaCy and the PyTorch encoder are not guaranteed to be thread safe, FAISS and scipy searches are
+        self._nlp_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        # The threads searching the shards are kept for the life of the service, across reloads
+        self._shard_executor = None
+        if with_similarity:
+            from utils_encoders import load_encoder, onnx_dir
+            self.model = load_encoder(encoder, model_dir=onnx_dir(index_dir))
+        self._load()
+
+    def _load(self):
+        sharded = is_sharded(self.index_dir)
+        if sharded:
+            index = load_sharded_index(self.index_dir, self.scoring, executor=self._shard_executor)
+            self._shard_executor = index["executor"]
+            inverted_index = None
+        else:
+            index = load_index(self.index_dir)
+            inverted_index = corpus_inverted_index(index, self.scoring) if self.use_inverted_index else None
+        embeddings = indexes = None
+        if self.model is not None:
+            from utils_embedding_store import EMBEDDING_FIELDS, ensure_embedding_store
+            from utils_faiss_index import ensure_field_indexes
+
+            if sharded:
+                from utils_shards import ensure_sharded_embeddings
+                embeddings, indexes = ensure_sharded_embeddings(index, self.model, EMBEDDING_FIELDS, self.ann_backend, self.encoder)
+            else:
+                embeddings = ensure_embedding_store(self.index_dir, index["documents"], self.model, encoder=self.encoder,
+                                                    index_version=index["meta"]["index_version"])
+                indexes = ensure_field_indexes(self.index_dir, embeddings, EMBEDDING_FIELDS, self.ann_backend)
+        # Requests take the loaded state once, so a reload never mixes the documents of two versions
+        self.loaded = {"sharded": sharded, "index": index, "inverted_index": inverted_index, "embeddings": embeddings,
+                       "indexes": indexes}
+        self.sharded, self.index, self.embeddings, self.indexes = sharded, index, embeddings, indexes
+        self.list_of_docs = self.new_file_docs = index["documents"]
+
+    def stored_index_version(self):
+        """
+        Return the version of the index currently written in the index folder, or None if there is none.
+        """
+        path = os.path.join(self.index_dir, SHARDS_FILE if is_sharded(self.index_dir) else META_FILE)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f).get("index_version")
+        except (OSError, ValueError):
+            return None
+
+    def refresh(self):
+        """
+        Load the index again if another version was written to the index folder since it was loaded.
+
+        Returns:
+        - bool: True if a new version was loaded.
+        """
+        with self._reload_lock:
+            version = self.stored_index_version()
+            if version is None or version == self.loaded["index"]["meta"]["index_version"]:
+                return False
+            self._load()
+            return True
+
+    def close(self):
+        """
+        Stop the threads searching the shards of a sharded index.
+        """
+        if self._shard_executor is not None:
+            self._shard_executor.shutdown(wait=False)
+            self._shard_executor = None
+
+    def _maybe_refresh(self):
+        if self.reload_interval is not None and time.monotonic() - self._checked >= self.reload_interval:
+            self._checked = time.monotonic()
+            self.refresh()
+
+    def info(self):
+        """
+        Return the version and size of the loaded index and the statistics of the result cache.
+        """
+        meta = self.loaded["index"]["meta"]
+        return {"index_version": meta["index_version"], "n_documents": meta["n_documents"],
+                "similarity": self.model is not None, "cache": self.cache.stats()}
+
+    def search(self, query, top_k=None, min_score=0.0):
+        """
+        Search products by indication, as the -q mode of main.py.
+
+        Args:
+        - query (str): The indication to search for.
+        - top_k (int, optional): The maximum number of results.
+        - min_score (float): Only return products scoring above this value.
+
+        Returns:
+        - list of dict: Matching products with the keys 'filename', 'product_name' and 'score'. Cached results
+          are shared between requests and must not be modified.
+        """
+        return self.search_batch([(query, top_k, min_score)])[0]
+
+    def search_batch(self, requests):
+        """
+        Answer several indication searches at once, with one spaCy pass and one sparse product for all queries.
+
+        Args:
+        - requests (list of tuple): (query, top_k, min_score) per search, as the arguments of search().
+
+        Returns:
+        - list: The result of search() for every request, in order.
+
+        Queries found in the result cache are answered without spaCy; the others are lemmatized, and the ones
+        whose lemmatized form is cached (e.g. another inflection of a cached query) are not scored.
+        """
+        self._maybe_refresh()
+        loaded = self.loaded
+        index = loaded["index"]
+        version, scoring = index["meta"]["index_version"], self.scoring
+        answers = [self.cache.get(("query", normalize_query(query), top_k, min_score, scoring), version)
+                   for query, top_k, min_score in requests]
+        missing = [row for row, answer in enumerate(answers) if answer is None]
+        if not missing:
+            return answers
+
+        with self._nlp_lock:
+            with profile_stage("query_lemmatize", len(missing)):
+                lemmatized_queries = dict(zip(missing, lemmatize_texts([requests[row][0].lower() for row in missing])))
+        to_score = []
+        for row in missing:
+            _, top_k, min_score = requests[row]
+            answers[row] = self.cache.get(("lemma", lemmatized_queries[row], top_k, min_score, scoring), version, count_miss=False)
+            if answers[row] is None:
+                to_score.append(row)
+        if to_score:
+            for row, ranked in zip(to_score, self._rank(loaded, [lemmatized_queries[row] for row in to_score],
+                                                        [requests[row] for row in to_score])):
+                documents = index["list_of_docs"]
+                answers[row] = [{"filename": documents[idx]["filename"],
+                                 "product_name": capitalize_first_letter(documents[idx]["title"]),
+                                 "score": score}
+                                for idx, score in ranked]
+                _, top_k, min_score = requests[row]
+                self.cache.set(("lemma", lemmatized_queries[row], top_k, min_score, scoring), answers[row], version)
+        for row in missing:
+            query, top_k, min_score = requests[row]
+            self.cache.set(("query", normalize_query(query), top_k, min_score, scoring), answers[row], version)
+        return answers
+
+    def _rank(self, loaded, lemmatized_queries, requests):
+        # (document index, score) pairs of every query, scored with one product (or one shard fan-out) for all of them
+        index = loaded["index"]
+        if loaded["sharded"]:
+            # The shards return the largest top-k and the lowest threshold asked, every request then takes its share
+            top_ks = [top_k for _, top_k, _ in requests]
+            largest_k = None if None in top_ks else max(top_ks)
+            shard_ranked = search_shards(lemmatized_queries, index, largest_k, min(min_score for _, _, min_score in requests))
+            return [[(idx, score) for idx, score in shard_ranked[row] if score > min_score][:top_k]
+                    for row, (_, top_k, min_score) in enumerate(requests)]
+        if loaded["inverted_index"] is not None:
+            with profile_stage("inverted_search", len(lemmatized_queries)):
+                return [search_inverted_index(loaded["inverted_index"], *query_terms(lemmatized, index["vectorizer"], self.scoring),
+                                              top_k, min_score)
+                        for lemmatized, (_, top_k, min_score) in zip(lemmatized_queries, requests)]
+        with profile_stage("tfidf_search", len(lemmatized_queries)):
+            scores = (index["vectorizer"].transform(lemmatized_queries) @ index["tfidf_postings"]).tocsr()
+            return [rank_scores(scores.indices[scores.indptr[row]:scores.indptr[row + 1]],
+                                scores.data[scores.indptr[row]:scores.indptr[row + 1]], top_k, min_score)
+                    for row, (_, top_k, min_score) in enumerate(requests)]
+
+    def read_new_documents(self, input_path, filenames=None):
+        """
+        Read, extract and clean the PDF documents of a folder, see load_new_documents.
+        """
+        from utils_search_similar import load_new_documents
+
+        with self._nlp_lock:
+            return load_new_documents(input_path, filenames)
+
+    def read_pdf(self, content):
+        """
+        Read, extract and clean an uploaded PDF document.
+
+        Args:
+        - content (bytes): The content of the PDF file.
+
+        Returns:
+        - list of dict: The cleaned document (none if no text could be read), see load_new_documents.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "upload.pdf"), "wb") as f:
+                f.write(content)
+            return self.read_new_documents(folder)
+
+    def similar_batch(self, requests):
+        """
+        Find the products most similar to the cleaned documents of several requests at once.
+
+        Args:
+        - requests (list of tuple): (new documents, top_k, min_score) per request, where the new documents
+          are cleaned as by load_new_documents.
+
+        Returns:
+        - list: One list per request with an entry per new document, its 'filename' and the list of 'results'.
+
+        The documents of all requests asking for the same top_k are encoded with one call of the model per
+        field and searched with one query per FAISS index.
+        """
+        if self.model is None:
+            raise RuntimeError("The server was started without similarity search.")
+        from utils_search_similar import find_similar_documents
+
+        self._maybe_refresh()
+        loaded = self.loaded
+        answers = [None] * len(requests)
+        for top_k in dict.fromkeys(top_k for _, top_k, _ in requests):
+            group = [row for row, request in enumerate(requests) if request[1] == top_k]
+            new_docs = [doc for row in group for doc in requests[row][0]]
+            with self._model_lock:
+                results = iter(find_similar_documents(new_docs, loaded["index"]["documents"], self.model, loaded["embeddings"],
+                                                      top_k, loaded["indexes"]))
+            for row in group:
+                min_score = requests[row][2]
+                answers[row] = [{"filename": new_doc["filename"],
+                                 "results": [{"filename": doc["filename"],
+                                              "product_name": capitalize_first_letter(doc["nazwa"]),
+                                              "score": score}
+                                             for doc, score in matches if score > min_score]}
+                                for new_doc, matches in (next(results) for _ in requests[row][0])]
+        return answers
+
+    def similar(self, input_path, filenames=None, top_k=150, min_score=0.0):
+        """
+        Find the products most similar to the PDF documents in a folder, as the -f mode of main.py.
+
+        Args:
+        - input_path (str): The folder with the PDF documents.
+        - filenames (list, optional): Only use these files from the folder.
+        - top_k (int): The number of most similar documents retrieved per field.
+        - min_score (float): Only return products scoring above this value.
+
+        Returns:
+        - list of dict: One entry per new document with its 'filename' and the list of 'results'.
+        """
+        if self.model is None:
+            raise RuntimeError("The server was started without similarity search.")
+        return self.similar_batch([(self.read_new_documents(input_path, filenames), top_k, min_score)])[0]
+
+    def similar_to_pdf(self, content, top_k=150, min_score=0.0):
+        """
+        Find the products most similar to an uploaded PDF document.
+
+        Args:
+        - content (bytes): The content of the PDF file.
+        - top_k (int): The number of most similar documents retrieved per field.
+        - min_score (float): Only return products scoring above this value.
+
+        Returns:
+        - list of dict: The result of similar() for the uploaded document.
+        """
+        if self.model is None:
+            raise RuntimeError("The server was started without similarity search.")
+        return self.similar_batch([(self.read_pdf(content), top_k, min_score)])[0]
+
+
+def resolve_intake_path(intake_dir, path):
+    """
+    Resolve a path sent by a client inside the intake folder.
+
+    Args:
+    - intake_dir (str): The folder whose files and subfolders clients may name.
+    - path (str): The path sent by the client, absolute or relative to the intake folder.
+
+    Returns:
+    - str: The real path, or None if it lies outside the intake folder (also through symbolic links) or does not exist.
+    """
+    root = os.path.realpath(intake_dir)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root or not os.path.exists(resolved):
+        return None
+    return resolved
+
+
+def make_handler(service, intake_dir=None, max_body_size=MAX_BODY_SIZE):
+    """
+    Create an HTTP request handler class answering requests with the given SearchService.
+
+    Args:
+    - service (SearchService): The loaded search service.
+    - intake_dir (str, optional): The folder of the files clients may name in POST /similar. Without it,
+      only uploaded PDF documents are accepted.
+    - max_body_size (int): The largest request body accepted, in bytes. Larger bodies are answered with 413
+      without being read.
+
+    Endpoints:
+    - GET /health: Index version and size, and statistics of the search result cache.
+    - GET /search?q=<indication>&top_k=<n>&min_score=<x>: Products registered for the indication. top_k must be
+      at least 1; invalid parameters are answered with 400.
+    - POST /similar?top_k=<n>: Products similar to a PDF, sent either as the request body
+      (Content-Type: application/pdf) or as JSON {"path": "<file or folder in intake_dir>"}.
+    """
+
+    class SearchRequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _params(self):
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            return url.path, params
+
+        @staticmethod
+        def _top_k(params, default=None):
+            # Answered with 400, as every ValueError
+            if "top_k" not in params:
+                return default
+            try:
+                top_k = int(params["top_k"])
+            except ValueError:
+                top_k = 0
+            if top_k < 1:
+                raise ValueError("'top_k' must be a positive integer.")
+            return top_k
+
+        def do_GET(self):
+            path, params = self._params()
+            try:
+                if path == "/health":
+                    self._send_json(200, service.info())
+                elif path == "/search":
+                    if not params.get("q"):
+                        self._send_json(400, {"error": "Missing query parameter 'q'."})
+                        return
+                    top_k = self._top_k(params)
+                    results = service.search(params["q"], top_k, float(params.get("min_score", 0.0)))
+                    self._send_json(200, {"query": params["q"], "results": results})
+                else:
+                    self._send_json(404, {"error": f"Unknown endpoint {path}"})
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def do_POST(self):
+            path, params = self._params()
+            if path != "/similar":
+                self._send_json(404, {"error": f"Unknown endpoint {path}"})
+                return
+            try:
+                top_k = self._top_k(params, 150)
+                min_score = float(params.get("min_score", 0.0))
+                length = int(self.headers.get("Content-Length", 0))
+                if length < 0:
+                    raise ValueError("Invalid Content-Length.")
+                if length > max_body_size:
+                    # The body is left unread, so the connection cannot be reused
+                    self.close_connection = True
+                    self._send_json(413, {"error": f"The request body exceeds {max_body_size} bytes."})
+                    return
+                content = self.rfile.read(length)
+                if self.headers.get("Content-Type", "").startswith("application/pdf"):
+                    results = service.similar_to_pdf(content, top_k, min_score)
+                else:
+                    if intake_dir is None:
+                        self._send_json(400, {"error": "Send the PDF document as the request body (Content-Type: application/pdf)."})
+                        return
+                    path = json.loads(content or b"{}").get("path")
+                    input_path = resolve_intake_path(intake_dir, path) if isinstance(path, str) and path else None
+                    if input_path is None:
+                        self._send_json(400, {"error": "Send a PDF body or JSON with the 'path' of a file or folder in the intake folder."})
+                        return
+                    if os.path.isfile(input_path):
+                        results = service.similar(os.path.dirname(input_path), [os.path.basename(input_path)], top_k, min_score)
+                    else:
+                        results = service.similar(input_path, top_k=top_k, min_score=min_score)
+                self._send_json(200, {"results": results})
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return SearchRequestHandler
+
+
+def serve(service, host="127.0.0.1", port=8000, intake_dir=None, max_body_size=MAX_BODY_SIZE):
+    """
+    Answer HTTP requests with the given SearchService until interrupted. Each request runs in its own thread.
+    See make_handler for intake_dir and max_body_size.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(service, intake_dir, max_body_size))
+    print(f"Serving index {service.info()['index_version']} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,659 @@
+import os
+import re
+import json
+import uuid
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from utils_index import (INDEX_FORMAT_VERSION, META_FILE, VOCABULARY_FILE, COUNTS_FILE, index_exists, build_index,
+                         update_index, load_vectorizer)
+from utils_docstore import load_document_store
+from utils_search_engine import rank_scores
+from utils_inverted_index import bm25_weights
+from utils_data_cleaning import lemmatize_texts
+from utils_profiling import profile_stage
+
+SHARDS_FORMAT_VERSION = 1
+
+SHARDS_FILE = "shards.json"
+SHARDS_DIR = "shards"
+GLOBAL_DIR = "global"
+GLOBAL_TERMS_FILE = "terms.json"
+GLOBAL_IDF_FILE = "idf.npy"
+
+SHARD_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def is_sharded(index_dir):
+    """
+    Check whether the index folder holds a sharded index.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+
+    Returns:
+    - bool: True if the shard registry is present, False otherwise.
+    """
+    return os.path.isfile(os.path.join(index_dir, SHARDS_FILE))
+
+
+def shard_dir(index_dir, name):
+    """
+    Return the folder of a shard. Every shard is a complete index, see save_index.
+    """
+    return os.path.join(index_dir, SHARDS_DIR, name)
+
+
+def load_shard_registry(index_dir):
+    """
+    Load the registry of the shards of a sharded index.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+
+    Returns:
+    - registry (dict): A dictionary with the keys "format_version", "index_version", "created" and "shards",
+      the list of shards in document order. Every shard has a "name", the "input_path" it is built from,
+      the filename "range" it covers (or None for the whole folder), its own "index_version" and "n_documents".
+      An empty registry is returned when the folder holds no sharded index.
+    """
+    if not is_sharded(index_dir):
+        return {"format_version": SHARDS_FORMAT_VERSION, "index_version": None, "created": None, "shards": []}
+    with open(os.path.join(index_dir, SHARDS_FILE), encoding="utf-8") as f:
+        registry = json.load(f)
+    if registry.get("format_version") != SHARDS_FORMAT_VERSION:
+        raise ValueError(f"Unsupported shard registry in {index_dir}. Please rebuild the shards.")
+    return registry
+
+
+def save_shard_registry(index_dir, registry):
+    """
+    Write the shard registry with a new "index_version", through a temporary file so readers never see a partial registry.
+    """
+    registry = {**registry, "format_version": SHARDS_FORMAT_VERSION, "index_version": uuid.uuid4().hex,
+                "created": datetime.now().isoformat(timespec="seconds")}
+    os.makedirs(index_dir, exist_ok=True)
+    path = os.path.join(index_dir, SHARDS_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(registry, f, indent=2, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    return registry
+
+
+def _check_shardable(index_dir, name):
+    if not SHARD_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid shard name '{name}': use letters, digits, '_', '-' and '.'")
+    if index_exists(index_dir):
+        raise ValueError(f"{index_dir} holds an unsharded index; build the shards in another --index-dir.")
+
+
+def build_shard(index_dir, name, input_path, name_range=None, update=False, **build_params):
+    """
+    Build (or update) one shard of a sharded index and register it, leaving the other shards untouched.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - name (str): The name of the shard, e.g. the registry it holds.
+    - input_path (str): The folder with the PDF files of the shard.
+    - name_range (list, optional): Only index the files of input_path in this range of filenames, see in_name_range.
+    - update (bool): Only process the added, changed and removed files (see update_index) instead of a full build.
+    - build_params: Additional parameters of build_index and update_index (workers, chunksize, batch_size,
+      n_process, text_cache).
+
+    Returns:
+    - meta (dict): The metadata of the shard index, as returned by build_index or update_index.
+
+    A shard that is not registered yet is appended, so its documents come after the ones of the existing shards.
+    The registry gets a new "index_version" whenever the documents of the shard changed.
+    """
+    _check_shardable(index_dir, name)
+    directory = shard_dir(index_dir, name)
+    if update:
+        meta = update_index(input_path, directory, name_range=name_range, **build_params)
+    else:
+        meta = build_index(input_path, directory, name_range=name_range, **build_params)
+
+    registry = load_shard_registry(index_dir)
+    entry = {"name": name, "input_path": input_path, "range": name_range,
+             "index_version": meta["index_version"], "n_documents": meta["n_documents"]}
+    shards = registry["shards"]
+    position = next((i for i, shard in enumerate(shards) if shard["name"] == name), None)
+    if position is None:
+        shards.append(entry)
+    elif shards[position] != entry:
+        shards[position] = entry
+    else:
+        return meta
+    save_shard_registry(index_dir, registry)
+    return meta
+
+
+def plan_range_shards(input_path, shard_size):
+    """
+    Split the PDF files of a folder into consecutive ranges of filenames of shard_size files each.
+
+    Args:
+    - input_path (str): The folder with the PDF files.
+    - shard_size (int): The number of files per shard.
+
+    Returns:
+    - list of tuple: (name, range) per shard, named after the folder and numbered, e.g. "data-0000". The ranges
+      cover every possible filename, so files added later always fall in exactly one shard: the first range
+      has no start and the last one no stop.
+    """
+    if shard_size < 1:
+        raise ValueError("The shard size must be at least 1.")
+    filenames = sorted(filename for filename in os.listdir(input_path) if filename.endswith('.pdf'))
+    starts = filenames[::shard_size] or [None]
+    bounds = [None] + starts[1:] + [None]
+    prefix = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(os.path.normpath(input_path))).lstrip("_.-") or "range"
+    return [(f"{prefix}-{i:04d}", [bounds[i], bounds[i + 1]]) for i in range(len(starts))]
+
+
+def build_range_shards(index_dir, input_path, shard_size, **build_params):
+    """
+    Build a sharded index of a folder split by document range, see plan_range_shards.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - input_path (str): The folder with the PDF files.
+    - shard_size (int): The number of files per shard.
+    - build_params: Additional parameters of build_index.
+
+    Returns:
+    - dict: The metadata of every built shard, by shard name.
+
+    Range shards previously built from the same folder are replaced; shards of other folders are kept.
+    The global TF-IDF weights of all shards are stored once every shard is built, see save_global_weights.
+    """
+    registry = load_shard_registry(index_dir)
+    stale = [shard for shard in registry["shards"] if shard["input_path"] == input_path and shard["range"] is not None]
+    if stale:
+        registry["shards"] = [shard for shard in registry["shards"] if shard not in stale]
+        save_shard_registry(index_dir, registry)
+        for shard in stale:
+            shutil.rmtree(shard_dir(index_dir, shard["name"]), ignore_errors=True)
+    metas = {name: build_shard(index_dir, name, input_path, name_range, **build_params)
+             for name, name_range in plan_range_shards(input_path, shard_size)}
+    save_global_weights(index_dir)
+    return metas
+
+
+def update_shards(index_dir, **build_params):
+    """
+    Update every shard from the folder and filename range it was built from, see build_shard, and store
+    the global TF-IDF weights of the updated shards, see save_global_weights.
+
+    Returns:
+    - dict: The metadata of every shard, by shard name.
+    """
+    metas = {shard["name"]: build_shard(index_dir, shard["name"], shard["input_path"], shard["range"], update=True, **build_params)
+             for shard in load_shard_registry(index_dir)["shards"]}
+    if metas:
+        save_global_weights(index_dir)
+    return metas
+
+
+def global_idf(document_frequencies, n_documents):
+    """
+    Compute the IDF weights of TfidfVectorizer (smooth_idf=True) from summed document frequencies.
+
+    Args:
+    - document_frequencies (numpy.ndarray): The number of documents containing every term, over all shards.
+    - n_documents (int): The number of documents of all shards.
+
+    Returns:
+    - numpy.ndarray: ln((1 + n) / (1 + df)) + 1 for every term, as the vectorizer of an unsharded index.
+    """
+    return np.log((n_documents + 1) / (document_frequencies.astype(np.float64) + 1)) + 1
+
+
+def shard_weights(counts, idf, bm25_stats=None):
+    """
+    Weight the term counts of a shard with the statistics of the whole sharded corpus.
+
+    Args:
+    - counts (scipy.sparse.csr_matrix): The term counts of the shard, one row per document, columns in shard term order.
+    - idf (numpy.ndarray): The global IDF of every shard term.
+    - bm25_stats (tuple, optional): (global BM25 idf of every shard term, global average document length).
+      When given, BM25 weights are returned instead of TF-IDF.
+
+    Returns:
+    - scipy.sparse.csr_matrix: The term-major (one row per term) TF-IDF or BM25 weights of the shard, the
+      same as the rows of an unsharded index over all shards.
+    """
+    from sklearn.preprocessing import normalize
+
+    if bm25_stats is not None:
+        return bm25_weights(counts, idf=bm25_stats[0], average_length=bm25_stats[1])
+    tfidf = counts.multiply(idf[np.newaxis, :]).tocsr()
+    return normalize(tfidf, norm="l2", copy=False).T.tocsr()
+
+
+def _global_weights_dir(index_dir, registry, scoring):
+    # One folder per registry version and scoring: a folder is never rewritten once moved into place
+    return os.path.join(index_dir, GLOBAL_DIR, f"{registry['index_version']}-{scoring}")
+
+
+def compute_global_weights(index_dir, registry, scoring="tfidf"):
+    """
+    Reweight the term counts of every shard with the statistics of all shards together.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - registry (dict): The shard registry, see load_shard_registry.
+    - scoring (str): "tfidf" or "bm25", the weights of the postings.
+
+    Returns:
+    - terms (list of str): The vocabulary of all shards, in alphabetical order as the vectorizer of an unsharded index.
+    - idf (numpy.ndarray): The TF-IDF weight of every term, computed over all shards.
+    - weights (list of tuple): (columns, postings) per shard: the global id of every shard term and the term-major weights.
+    """
+    shards, n_documents, doc_lengths = [], 0, 0.0
+    for entry in registry["shards"]:
+        directory = shard_dir(index_dir, entry["name"])
+        with open(os.path.join(directory, VOCABULARY_FILE), encoding="utf-8") as f:
+            vocabulary = json.load(f)
+        terms = [None] * len(vocabulary)
+        for term, idx in vocabulary.items():
+            terms[idx] = term
+        counts_path = os.path.join(directory, COUNTS_FILE)
+        if not os.path.isfile(counts_path):
+            raise ValueError(f"Shard {entry['name']} has no term counts. Please rebuild it.")
+        counts = scipy.sparse.load_npz(counts_path).tocsr()
+        counts.sort_indices()
+        shards.append((terms, counts))
+        n_documents += counts.shape[0]
+        doc_lengths += counts.sum()
+
+    all_terms = sorted({term for terms, _ in shards for term in terms})
+    vocabulary = {term: idx for idx, term in enumerate(all_terms)}
+    document_frequencies = np.zeros(len(vocabulary), dtype=np.int64)
+    columns = []
+    for terms, counts in shards:
+        columns.append(np.array([vocabulary[term] for term in terms], dtype=np.int64))
+        np.add.at(document_frequencies, columns[-1], np.bincount(counts.indices, minlength=len(terms)))
+    idf = global_idf(document_frequencies, n_documents)
+    bm25_stats = None
+    if scoring == "bm25":
+        bm25_idf = np.log(1.0 + (n_documents - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        average_length = doc_lengths / n_documents if n_documents and doc_lengths > 0 else 1.0
+    weights = []
+    for shard_columns, (_, counts) in zip(columns, shards):
+        if scoring == "bm25":
+            bm25_stats = (bm25_idf[shard_columns], average_length)
+        weights.append((shard_columns, shard_weights(counts, idf[shard_columns], bm25_stats)))
+    return all_terms, idf, weights
+
+
+def save_global_weights(index_dir, scoring="tfidf", registry=None):
+    """
+    Compute the global weights of the shards (see compute_global_weights) and store them next to the shard registry,
+    so that load_sharded_index reads them instead of reweighting every shard.
+
+    The weights are stored in a folder named after the registry "index_version", written through a staging folder,
+    and the weights of previous versions are removed.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - scoring (str): "tfidf" or "bm25", the weights of the postings.
+    - registry (dict, optional): The shard registry. Defaults to the one stored in index_dir.
+
+    Returns:
+    - tuple: The terms, idf and weights, as returned by compute_global_weights.
+    """
+    registry = registry or load_shard_registry(index_dir)
+    terms, idf, weights = compute_global_weights(index_dir, registry, scoring)
+    parent = os.path.join(index_dir, GLOBAL_DIR)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=parent)
+    try:
+        with open(os.path.join(staging, GLOBAL_TERMS_FILE), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        np.save(os.path.join(staging, GLOBAL_IDF_FILE), idf)
+        for entry, (columns, postings) in zip(registry["shards"], weights):
+            np.save(os.path.join(staging, f"{entry['name']}.columns.npy"), columns)
+            scipy.sparse.save_npz(os.path.join(staging, f"{entry['name']}.postings.npz"), postings, compressed=False)
+        target = _global_weights_dir(index_dir, registry, scoring)
+        if not os.path.isdir(target):
+            os.replace(staging, target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    for name in os.listdir(parent):
+        if not name.startswith(".") and not name.startswith(f"{registry['index_version']}-"):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+    return terms, idf, weights
+
+
+def load_global_weights(index_dir, registry, scoring="tfidf"):
+    """
+    Read the global weights stored by save_global_weights for the current registry version, or None if there are none.
+    """
+    directory = _global_weights_dir(index_dir, registry, scoring)
+    if not os.path.isdir(directory):
+        return None
+    with open(os.path.join(directory, GLOBAL_TERMS_FILE), encoding="utf-8") as f:
+        terms = json.load(f)
+    idf = np.load(os.path.join(directory, GLOBAL_IDF_FILE))
+    weights = [(np.load(os.path.join(directory, f"{entry['name']}.columns.npy")),
+                scipy.sparse.load_npz(os.path.join(directory, f"{entry['name']}.postings.npz")).tocsr())
+               for entry in registry["shards"]]
+    return terms, idf, weights
+
+
+def load_sharded_index(index_dir, scoring="tfidf", workers=None, executor=None):
+    """
+    Load a sharded index, with the vocabulary and IDF weights of all shards together.
+
+    Args:
+    - index_dir (str): The path to the index folder.
+    - scoring (str): "tfidf" or "bm25", the weights the shard postings are computed with.
+    - workers (int, optional): The number of threads searching the shards. Defaults to one per shard,
+      at most the number of CPUs.
+    - executor (concurrent.futures.Executor, optional): The executor the shards are searched with, e.g. the one
+      of a previously loaded version of the index. A new ThreadPoolExecutor of `workers` threads by default.
+
+    Returns:
+    - index (dict): A dictionary with the keys:
+        - "meta": The shard registry, with "n_documents" of all shards.
+        - "documents" and "list_of_docs": All documents as one ShardedDocuments sequence, numbered shard after shard.
+        - "vectorizer": A TfidfVectorizer with the vocabulary of all shards and the IDF computed over all of them.
+        - "scoring": The scoring of the postings.
+        - "shards": One dict per shard with its "name", "dir", "index_version", "offset" (the global number of its
+          first document), "documents", "columns" (the global id of every shard term) and "postings" (term-major weights).
+        - "executor": The executor the shards are searched with.
+
+    Every shard stores its own term counts, so the global document frequencies are the sum of the shard ones
+    and each shard is reweighted with the global IDF: scores are exactly those of an unsharded index over the
+    same documents, and rebuilding one shard never requires rewriting the others. The reweighted postings are
+    stored per registry version (see save_global_weights), so they are only computed once after the shards change.
+    """
+    registry = load_shard_registry(index_dir)
+    if not registry["shards"]:
+        raise ValueError(f"No shards registered in {index_dir}.")
+    if scoring not in ("tfidf", "bm25"):
+        raise ValueError(f"Unknown scoring '{scoring}', expected 'tfidf' or 'bm25'")
+
+    shards, offset = [], 0
+    for entry in registry["shards"]:
+        directory = shard_dir(index_dir, entry["name"])
+        with open(os.path.join(directory, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format in shard {entry['name']}. Please rebuild it.")
+        # Only the memory-mapped documents are read, not the TF-IDF matrices of the shard
+        documents = load_document_store(directory, datetime.fromisoformat(meta["created"]))
+        shards.append({"name": entry["name"], "dir": directory, "index_version": entry["index_version"], "offset": offset,
+                       "documents": documents})
+        offset += len(documents)
+
+    global_weights = load_global_weights(index_dir, registry, scoring)
+    if global_weights is None:
+        try:
+            global_weights = save_global_weights(index_dir, scoring, registry)
+        except OSError:
+            # A read-only index folder: the weights are computed on every load
+            global_weights = compute_global_weights(index_dir, registry, scoring)
+    terms, idf, weights = global_weights
+    for shard, (columns, postings) in zip(shards, weights):
+        shard["columns"], shard["postings"] = columns, postings
+
+    if executor is None:
+        workers = workers or min(len(shards), os.cpu_count() or 1)
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard")
+    documents = ShardedDocuments(shards)
+    return {
+        "meta": {**registry, "n_documents": offset},
+        "documents": documents,
+        "list_of_docs": documents,
+        "vectorizer": load_vectorizer({term: idx for idx, term in enumerate(terms)}, idf),
+        "scoring": scoring,
+        "shards": shards,
+        "executor": executor,
+    }
+
+
+class ShardedDocuments:
+    """
+    Read-only sequence of the documents of all shards, numbered shard after shard.
+
+    Args:
+    - shards (list of dict): The shards of load_sharded_index, with their "offset" and "documents".
+    """
+
+    def __init__(self, shards):
+        self.stores = [shard["documents"] for shard in shards]
+        self.offsets = np.array([shard["offset"] for shard in shards], dtype=np.int64)
+        self.length = int(self.offsets[-1] + len(self.stores[-1])) if shards else 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.length))]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError("document index out of range")
+        shard = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return self.stores[shard][int(idx - self.offsets[shard])]
+
+    def __iter__(self):
+        for store in self.stores:
+            yield from store
+
+
+def _search_shard(shard, query_vectors, top_k, min_score):
+    # The query columns of the shard terms, in shard order, times the shard postings
+    with profile_stage("shard_search", query_vectors.shape[0]):
+        scores = (query_vectors[:, shard["columns"]] @ shard["postings"]).tocsr()
+        ranked = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            ranked.append(rank_scores(scores.indices[start:end] + shard["offset"], scores.data[start:end], top_k, min_score))
+        return ranked
+
+
+def merge_ranked(ranked_lists, top_k=None, min_score=0.0):
+    """
+    Merge the ranked (global document index, rounded score) lists of several shards into one top-k list.
+
+    Returns:
+    - list of tuple: (document index, score) pairs ordered as by rank_scores, by decreasing score and then
+      by increasing global document index, as a search of the unsharded index.
+    """
+    pairs = [pair for ranked in ranked_lists for pair in ranked]
+    if not pairs:
+        return []
+    doc_indices, scores = zip(*pairs)
+    return rank_scores(np.array(doc_indices, dtype=np.int64), np.array(scores), top_k, min_score)
+
+
+def search_shards(lemmatized_queries, index, top_k=10, min_score=0.0):
+    """
+    Search every shard for lemmatized queries in parallel and merge the top-k of each query.
+
+    Args:
+    - lemmatized_queries (list of str): The lemmatized queries.
+    - index (dict): The sharded index, as returned by load_sharded_index.
+    - top_k (int, optional): The maximum number of documents returned per query. None returns all matching documents.
+    - min_score (float): Only documents whose rounded score is above this value are returned.
+
+    Returns:
+    - list of list of tuple: The (global document index, score) pairs of every query.
+
+    Queries are transformed once with the global vectorizer: TF-IDF scoring uses the query TF-IDF vectors
+    like search_product_by_indication, BM25 gives every query term the weight 1 like query_terms. Each
+    shard keeps its own top-k, and the merged top-k is the top-k of all shards.
+    """
+    query_vectors = index["vectorizer"].transform(lemmatized_queries).tocsc()
+    if index["scoring"] == "bm25":
+        query_vectors.data[:] = 1.0
+    futures = [index["executor"].submit(_search_shard, shard, query_vectors, top_k, min_score) for shard in index["shards"]]
+    shard_results = [future.result() for future in futures]
+    with profile_stage("shard_merge", len(lemmatized_queries)):
+        return [merge_ranked([ranked[row] for ranked in shard_results], top_k, min_score)
+                for row in range(len(lemmatized_queries))]
+
+
+def search_products_by_indications_sharded(queries, index, top_k=10, min_score=0.0, batch_size=1000):
+    """
+    Search for medicinal products for many indication queries in a sharded index.
+
+    Args:
+    - queries (iterable of str): The indication patterns to search for.
+    - index (dict): The sharded index, as returned by load_sharded_index.
+    - top_k (int, optional): The maximum number of products returned per query.
+    - min_score (float): Only products whose rounded score is above this value are returned.
+    - batch_size (int): The number of queries lemmatized and searched together.
+
+    Returns:
+    - generator of tuple: (query, matching products) per query, in input order, as search_products_by_indications.
+    """
+    products = index["list_of_docs"]
+    batch = []
+
+    def search_batch(batch):
+        with profile_stage("query_lemmatize", len(batch)):
+            lemmatized_queries = lemmatize_texts([query.lower() for query in batch])
+        for query, ranked in zip(batch, search_shards(lemmatized_queries, index, top_k, min_score)):
+            yield query, [{'product_name': products[idx]['title'], 'filename': products[idx]['filename'], 'score': score}
+                          for idx, score in ranked]
+
+    for query in queries:
+        batch.append(query)
+        if len(batch) == batch_size:
+            yield from search_batch(batch)
+            batch = []
+    if batch:
+        yield from search_batch(batch)
+
+
+def search_product_by_indication_sharded(wskazania_pattern, index, top_k=None, min_score=0.0):
+    """
+    Search for medicinal products by indication in a sharded index.
+
+    Returns:
+    - list of dict: Matching products in the format of search_product_by_indication.
+    """
+    return next(search_products_by_indications_sharded([wskazania_pattern], index, top_k, min_score))[1]
+
+
+class ShardedEmbeddings:
+    """
+    Read-only view of the embeddings of a field over all shards, indexed by global document number.
+
+    Args:
+    - arrays (list): The embeddings of every shard (float32, float16 or Int8Embeddings).
+    - offsets (list of int): The global number of the first document of every shard.
+    """
+
+    def __init__(self, arrays, offsets):
+        self.arrays = arrays
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shape = (int(self.offsets[-1] + len(arrays[-1])), arrays[0].shape[1])
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = np.arange(self.shape[0])[rows] if isinstance(rows, slice) else np.asarray(rows, dtype=np.int64)
+        single = rows.ndim == 0
+        rows = rows.reshape(-1)
+        result = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        shards = np.searchsorted(self.offsets, rows, side="right") - 1
+        for shard in np.unique(shards):
+            selected = shards == shard
+            result[selected] = np.asarray(self.arrays[shard][rows[selected] - self.offsets[shard]], dtype=np.float32)
+        return result[0] if single else result
+
+    def __array__(self, dtype=None, copy=None):
+        embeddings = self[:]
+        return embeddings if dtype is None else embeddings.astype(dtype, copy=False)
+
+
+class ShardedFaissIndex:
+    """
+    Searches the FAISS indexes of all shards in parallel and merges their neighbors, like one index.
+
+    It has the ntotal attribute and the search method of a FAISS index, so it can be used wherever the
+    index of a field is passed (search_field_index, DenseField).
+
+    Args:
+    - indexes (list of faiss.Index): The index of the field in every shard.
+    - offsets (list of int): The global number of the first document of every shard.
+    - executor (concurrent.futures.Executor): The pool the shards are searched with.
+    """
+
+    def __init__(self, indexes, offsets, executor):
+        self.indexes = indexes
+        self.offsets = offsets
+        self.executor = executor
+        self.ntotal = sum(index.ntotal for index in indexes)
+
+    def search(self, query_embeddings, k):
+        def search_one(index):
+            return index.search(query_embeddings, min(k, index.ntotal))
+
+        results = list(self.executor.map(search_one, self.indexes))
+        scores = np.concatenate([shard_scores for shard_scores, _ in results], axis=1)
+        indices = np.concatenate([np.where(shard_indices >= 0, shard_indices + offset, -1)
+                                  for (_, shard_indices), offset in zip(results, self.offsets)], axis=1)
+        scores = np.where(indices >= 0, scores, -np.inf)
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def ensure_sharded_embeddings(index, model, fields, backend="flat", encoder="torch"):
+    """
+    Load the embeddings and FAISS indexes of every shard, building the ones that are missing or out of date.
+
+    Args:
+    - index (dict): The sharded index, as returned by load_sharded_index.
+    - model (SentenceTransformer): The model used to compute missing embeddings.
+    - fields (list of str): The document fields, see EMBEDDING_FIELDS.
+    - backend (str): One of FAISS_BACKENDS.
+    - encoder (str): The encoder backend of the model, see ensure_embedding_store.
+
+    Returns:
+    - tuple: (embeddings, indexes), mappings of every field to its ShardedEmbeddings and ShardedFaissIndex.
+      They are used like the embedding store and field indexes of an unsharded index.
+
+    Each shard keeps its own embedding store and FAISS indexes in its folder, so they are only rebuilt
+    for the shards whose documents changed.
+    """
+    from utils_embedding_store import ensure_embedding_store
+    from utils_faiss_index import ensure_field_indexes
+
+    offsets = [shard["offset"] for shard in index["shards"]]
+    stores, shard_indexes = [], []
+    for shard in index["shards"]:
+        store = ensure_embedding_store(shard["dir"], shard["documents"], model, encoder=encoder, index_version=shard["index_version"])
+        stores.append(store)
+        shard_indexes.append(ensure_field_indexes(shard["dir"], store, fields, backend))
+    embeddings = {field: ShardedEmbeddings([store[field] for store in stores], offsets) for field in fields}
+    indexes = {field: ShardedFaissIndex([indexes[field] for indexes in shard_indexes], offsets, index["executor"])
+               for field in fields}
+    return embeddings, indexes
+
+
+def sharded_tfidf_postings(index):
+    """
+    Return the term-major TF-IDF weights of all shards as one matrix (global terms x global documents),
+    for the 'tfidf' field of the -f similarity search.
+    """
+    n_terms, n_docs = len(index["vectorizer"].vocabulary), len(index["documents"])
+    rows, columns, data = [], [], []
+    for shard in index["shards"]:
+        postings = shard["postings"].tocoo()
+        rows.append(shard["columns"][postings.row])
+        columns.append(postings.col.astype(np.int64) + shard["offset"])
+        data.append(postings.data)
+    return scipy.sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                                   shape=(n_terms, n_docs))
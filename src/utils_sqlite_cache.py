@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class SQLiteCache:
+    """
+    Bounded cache with an in-memory LRU and an optional SQLite file, so entries survive between runs.
+
+    Entries are kept in an in-memory LRU of at most `maxsize` items. When `path` is given, entries are also
+    stored in an SQLite file, written in batches by flush(). The file remembers the version identifier it was
+    filled with and is emptied when entries are produced by another version.
+
+    Subclasses set VERSION_NAME, the name under which the version is stored in the file, and VALUE_TYPE, the
+    SQL type of the stored values, and override _encode and _decode to convert values to and from the file.
+
+    Args:
+    - maxsize (int): The maximum number of entries kept in memory. 0 keeps none.
+    - path (str, optional): The path to the SQLite file backing the cache.
+    - version (str, optional): Identifier of whatever produces the entries, e.g. a model and its version.
+    - disk_maxsize (int): The maximum number of entries kept in the SQLite file; the oldest are removed first.
+    - mmap_size (int, optional): The number of bytes of the file SQLite may memory-map.
+    """
+
+    VERSION_NAME = "version"
+    VALUE_TYPE = "TEXT"
+
+    def __init__(self, maxsize=50000, path=None, version=None, disk_maxsize=1000000, mmap_size=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.version = version or ""
+        self.disk_maxsize = disk_maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._connection = None
+        if path:
+            self._open(path, mmap_size)
+
+    def _open(self, path, mmap_size):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        if mmap_size:
+            self._connection.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        self._connection.execute(f"CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value {self.VALUE_TYPE})")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        row = self._connection.execute("SELECT value FROM meta WHERE name = ?", (self.VERSION_NAME,)).fetchone()
+        if row is None or row[0] != self.version:
+            # Entries produced by another version are no longer valid
+            self._connection.execute("DELETE FROM entries")
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (self.VERSION_NAME, self.version))
+        self._connection.commit()
+
+    def _encode(self, value):
+        return value
+
+    def _decode(self, stored):
+        return stored
+
+    def get(self, key):
+        """
+        Return the cached value for the key, or None if it is not cached.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            stored = self._pending.get(key)
+            if stored is None and self._connection is not None:
+                row = self._connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                stored = row[0] if row else None
+            if stored is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        value = self._decode(stored)
+        with self._lock:
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        """
+        Store the value for the key. Entries are written to disk by flush().
+        """
+        stored = self._encode(value) if self._connection is not None else None
+        with self._lock:
+            self._remember(key, value)
+            if self._connection is not None:
+                self._pending[key] = stored
+
+    def _remember(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def flush(self):
+        """
+        Write pending entries to the SQLite file and trim it to `disk_maxsize` entries.
+        """
+        with self._lock:
+            if self._connection is None or not self._pending:
+                return
+            self._connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?)", self._pending.items())
+            self._pending.clear()
+            self._connection.execute(
+                "DELETE FROM entries WHERE rowid IN "
+                "(SELECT rowid FROM entries ORDER BY rowid DESC LIMIT -1 OFFSET ?)", (self.disk_maxsize,))
+            self._connection.commit()
+
+    def clear(self):
+        """
+        Remove all entries from memory and disk.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM entries")
+                self._connection.commit()
+
+    def close(self):
+        """
+        Flush pending entries and close the SQLite file.
+        """
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def stats(self):
+        """
+        Return the number of hits and misses, and of entries held in memory when the in-memory LRU is used.
+        """
+        stats = {"hits": self.hits, "misses": self.misses}
+        if self.maxsize > 0:
+            stats["size"] = len(self._entries)
+        return stats
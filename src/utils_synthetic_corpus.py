@@ -0,0 +1,272 @@
+import os
+import json
+import random
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+
+SYNTHETIC_CORPUS_FILE = "synthetic_corpus.json"
+
+# Bumped whenever the generated documents change, so corpora of older generators are not reused
+GENERATOR_VERSION = 1
+
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000}
+
+SUBSTANCES = [
+    ("paracetamol", "paracetamolum"), ("ibuprofen", "ibuprofenum"), ("metformina", "metformini hydrochloridum"),
+    ("amlodypina", "amlodipini besilas"), ("salbutamol", "salbutamoli sulfas"), ("budezonid", "budesonidum"),
+    ("ramipryl", "ramiprilum"), ("atorwastatyna", "atorvastatinum calcicum"), ("rosuwastatyna", "rosuvastatinum calcicum"),
+    ("bisoprolol", "bisoprololi fumaras"), ("metoprolol", "metoprololi succinas"), ("losartan", "losartanum kalicum"),
+    ("walsartan", "valsartanum"), ("peryndopryl", "perindoprilum tosilatum"), ("indapamid", "indapamidum"),
+    ("furosemid", "furosemidum"), ("spironolakton", "spironolactonum"), ("klopidogrel", "clopidogrelum"),
+    ("apiksaban", "apixabanum"), ("rywaroksaban", "rivaroxabanum"), ("warfaryna", "warfarinum natricum"),
+    ("omeprazol", "omeprazolum"), ("pantoprazol", "pantoprazolum natricum"), ("lewotyroksyna", "levothyroxinum natricum"),
+    ("sertralina", "sertralini hydrochloridum"), ("escitalopram", "escitalopramum"), ("wenlafaksyna", "venlafaxinum"),
+    ("kwetiapina", "quetiapini fumaras"), ("olanzapina", "olanzapinum"), ("lewetyracetam", "levetiracetamum"),
+    ("lamotrygina", "lamotriginum"), ("pregabalina", "pregabalinum"), ("gabapentyna", "gabapentinum"),
+    ("tramadol", "tramadoli hydrochloridum"), ("ketoprofen", "ketoprofenum"), ("diklofenak", "diclofenacum natricum"),
+    ("amoksycylina", "amoxicillinum"), ("klarytromycyna", "clarithromycinum"), ("azytromycyna", "azithromycinum"),
+    ("cyprofloksacyna", "ciprofloxacinum"), ("flukonazol", "fluconazolum"), ("acyklowir", "aciclovirum"),
+    ("montelukast", "montelukastum natricum"), ("cetyryzyna", "cetirizini dihydrochloridum"), ("desloratadyna", "desloratadinum"),
+    ("tamsulosyna", "tamsulosini hydrochloridum"), ("finasteryd", "finasteridum"), ("sildenafil", "sildenafilum"),
+    ("allopurynol", "allopurinolum"), ("metotreksat", "methotrexatum"),
+]
+
+INDICATIONS = [
+    "nadciśnienia tętniczego samoistnego", "stabilnej choroby wieńcowej", "przewlekłej niewydolności serca",
+    "migotania przedsionków niezwiązanego z wadą zastawkową", "zakrzepicy żył głębokich", "zatorowości płucnej",
+    "cukrzycy typu 2", "hipercholesterolemii pierwotnej", "mieszanej dyslipidemii", "niedoczynności tarczycy",
+    "astmy oskrzelowej", "przewlekłej obturacyjnej choroby płuc", "alergicznego nieżytu nosa", "pokrzywki przewlekłej",
+    "choroby wrzodowej żołądka i dwunastnicy", "choroby refluksowej przełyku", "zakażenia Helicobacter pylori",
+    "bólu o nasileniu łagodnym do umiarkowanego", "gorączki", "bólu głowy", "bólu zębów", "bolesnego miesiączkowania",
+    "choroby zwyrodnieniowej stawów", "reumatoidalnego zapalenia stawów", "dny moczanowej", "łuszczycy",
+    "epizodów dużej depresji", "zaburzenia lękowego uogólnionego", "schizofrenii", "choroby afektywnej dwubiegunowej",
+    "padaczki z napadami częściowymi", "bólu neuropatycznego", "zaburzeń snu", "łagodnego rozrostu gruczołu krokowego",
+    "zaburzeń erekcji", "zakażeń dolnych dróg oddechowych", "pozaszpitalnego zapalenia płuc", "zapalenia zatok",
+    "zakażeń układu moczowego", "zakażeń skóry i tkanek miękkich", "kandydozy błon śluzowych", "opryszczki wargowej",
+    "półpaśca", "niedokrwistości z niedoboru żelaza", "osteoporozy pomenopauzalnej",
+]
+
+PATIENT_GROUPS = ["u dorosłych", "u dorosłych i młodzieży w wieku od 12 lat", "u dzieci w wieku powyżej 6 lat",
+                  "u pacjentów w podeszłym wieku", "u dorosłych pacjentów z prawidłową czynnością nerek"]
+
+FORMS = [
+    ("tabletki powlekane", "tabletka powlekana", "Biała, okrągła, obustronnie wypukła tabletka powlekana"),
+    ("tabletki", "tabletka", "Biała, podłużna tabletka z linią podziału po jednej stronie"),
+    ("kapsułki twarde", "kapsułka", "Kapsułka żelatynowa twarda z nieprzezroczystym wieczkiem"),
+    ("tabletki o przedłużonym uwalnianiu", "tabletka", "Żółta, okrągła tabletka o przedłużonym uwalnianiu"),
+    ("zawiesina doustna", "ml zawiesiny", "Biała lub prawie biała zawiesina o owocowym zapachu"),
+    ("aerozol inhalacyjny", "dawka odmierzona", "Zawiesina pod ciśnieniem w pojemniku aluminiowym"),
+]
+
+EXCIPIENTS = ["laktoza jednowodna", "skrobia kukurydziana", "celuloza mikrokrystaliczna", "magnezu stearynian",
+              "powidon", "krzemionka koloidalna bezwodna", "hypromeloza", "tytanu dwutlenek", "makrogol", "sacharoza",
+              "sorbitol", "sodu laurylosiarczan", "kroskarmeloza sodowa", "talk", "żelaza tlenek żółty"]
+
+BRAND_PARTS = ["Ami", "Bio", "Cardi", "Dero", "Ely", "Fla", "Gli", "Hexa", "Ivo", "Jura", "Kalo", "Lomi", "Medo",
+               "Noro", "Oxa", "Pola", "Quiro", "Ramo", "Sano", "Tevi", "Ulmo", "Vero", "Wero", "Zena"]
+BRAND_SUFFIXES = ["pin", "tex", "lek", "med", "san", "vit", "pharm", "lan", "zol", "dex", "mil", "sol"]
+
+DOSES = ["5", "10", "20", "25", "40", "50", "80", "100", "150", "200", "250", "400", "500", "850", "1000"]
+
+FILLER_SENTENCES = [
+    "Dawkę należy ustalać indywidualnie w zależności od odpowiedzi pacjenta na leczenie.",
+    "U pacjentów z zaburzeniami czynności wątroby należy zachować ostrożność.",
+    "Nie należy przekraczać zalecanej dawki dobowej.",
+    "Produkt leczniczy można przyjmować niezależnie od posiłków, popijając wodą.",
+    "W przypadku pominięcia dawki nie należy stosować dawki podwójnej w celu uzupełnienia pominiętej dawki.",
+    "Nadwrażliwość na substancję czynną lub na którąkolwiek substancję pomocniczą.",
+    "Ciężkie zaburzenia czynności nerek oraz ciąża i okres karmienia piersią.",
+    "Podczas leczenia należy regularnie kontrolować ciśnienie tętnicze oraz stężenie potasu w surowicy.",
+    "Jednoczesne stosowanie z inhibitorami CYP3A4 może zwiększać stężenie substancji czynnej w osoczu.",
+    "Produkt zawiera laktozę i nie powinien być stosowany u pacjentów z rzadkimi dziedzicznymi zaburzeniami.",
+    "Najczęściej zgłaszanymi działaniami niepożądanymi były ból głowy, zawroty głowy i nudności.",
+    "Produkt leczniczy nie wpływa lub wywiera nieistotny wpływ na zdolność prowadzenia pojazdów.",
+]
+
+# Characters outside WinAnsiEncoding are given the codes 128-143 through /Differences, so the base
+# Helvetica font renders Polish text without embedding a font file
+POLISH_GLYPHS = ["Aogonek", "aogonek", "Cacute", "cacute", "Eogonek", "eogonek", "Lslash", "lslash",
+                 "Nacute", "nacute", "Sacute", "sacute", "Zacute", "zacute", "Zdotaccent", "zdotaccent"]
+# Maps every character to the latin-1 character whose code it has in the font, escaping the PDF string delimiters
+PDF_STRING_TABLE = str.maketrans({**{char: chr(128 + code) for code, char in enumerate("ĄąĆćĘęŁłŃńŚśŹźŻż")},
+                                  "(": "\\(", ")": "\\)", "\\": "\\\\"})
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+LINES_PER_PAGE = 56
+LINE_WIDTH = 95
+
+
+def parse_scale(text):
+    """
+    Parse a corpus size given as a number of documents or as one of SCALES ("1k", "10k", "100k").
+    """
+    return SCALES[text] if text in SCALES else int(text)
+
+
+def synthetic_smpc(position, seed=0):
+    """
+    Generate the text of a synthetic Polish Summary of Product Characteristics (SmPC).
+
+    Args:
+    - position (int): The number of the document in the corpus.
+    - seed (int): The seed of the corpus. The same position and seed always give the same document.
+
+    Returns:
+    - dict: "filename", "nazwa" (the product name), "substance", "indications" and "text", the full text with
+      the sections 1 (name), 2 (composition), 3 (pharmaceutical form), 4.1 (indications), 4.2 (posology)
+      and further clinical sections of filler text.
+    """
+    rng = random.Random(seed * 1000003 + position)
+    substance, latin_name = rng.choice(SUBSTANCES)
+    form_plural, unit, description = rng.choice(FORMS)
+    brand = rng.choice(BRAND_PARTS) + rng.choice(BRAND_SUFFIXES)
+    dose = rng.choice(DOSES)
+    indications = rng.sample(INDICATIONS, rng.randint(1, 3))
+    excipients = rng.sample(EXCIPIENTS, rng.randint(3, 7))
+    nazwa = f"{brand} {dose} mg, {form_plural}"
+
+    paragraphs = [
+        "CHARAKTERYSTYKA PRODUKTU LECZNICZEGO",
+        "1. NAZWA PRODUKTU LECZNICZEGO",
+        nazwa,
+        "2. SKŁAD JAKOŚCIOWY I ILOŚCIOWY",
+        f"Każda {unit} zawiera {dose} mg {substance} ({latin_name}). "
+        f"Substancje pomocnicze o znanym działaniu: {excipients[0]}. "
+        f"Pozostałe substancje pomocnicze: {', '.join(excipients[1:])}. "
+        "Pełny wykaz substancji pomocniczych, patrz punkt 6.1.",
+        "3. POSTAĆ FARMACEUTYCZNA",
+        f"{description}.",
+        "4. SZCZEGÓŁOWE DANE KLINICZNE",
+        "4.1 Wskazania do stosowania",
+        f"Produkt leczniczy {brand} jest wskazany w leczeniu "
+        + ", ".join(f"{indication} {rng.choice(PATIENT_GROUPS)}" for indication in indications) + ".",
+        "4.2 Dawkowanie i sposób podawania",
+        " ".join(rng.sample(FILLER_SENTENCES, 4)),
+        "4.3 Przeciwwskazania",
+        " ".join(rng.sample(FILLER_SENTENCES, 3)),
+        "4.4 Specjalne ostrzeżenia i środki ostrożności dotyczące stosowania",
+        " ".join(rng.choice(FILLER_SENTENCES) for _ in range(rng.randint(8, 30))),
+    ]
+    return {
+        "filename": f"Charakterystyka-{position:06d}.pdf",
+        "nazwa": nazwa,
+        "substance": substance,
+        "indications": indications,
+        "text": "\n".join(paragraphs),
+    }
+
+
+def synthetic_queries(n_queries, seed=0):
+    """
+    Sample indication queries matching the vocabulary of the synthetic corpus.
+
+    Args:
+    - n_queries (int): The number of queries.
+    - seed (int): The seed of the sample.
+
+    Returns:
+    - list of str: Queries of one to three words of an indication, as typed by a user (e.g. "astmy oskrzelowej").
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n_queries):
+        words = rng.choice(INDICATIONS).split()
+        queries.append(" ".join(words[:rng.randint(1, min(3, len(words)))]))
+    return queries
+
+
+def _pdf_string(text):
+    """
+    Encode a line of text as a PDF string literal in the encoding of the generated font.
+    """
+    return b"(" + text.translate(PDF_STRING_TABLE).encode("latin-1", errors="replace") + b")"
+
+
+def text_to_pdf(text):
+    """
+    Render plain text as a minimal PDF document, wrapping lines and adding pages as needed.
+
+    Args:
+    - text (str): The text, paragraphs separated by newlines.
+
+    Returns:
+    - bytes: The PDF file content.
+
+    The document uses the standard Helvetica font, so writing it is a matter of string formatting and
+    large corpora can be generated quickly.
+    """
+    lines = [line for paragraph in text.split("\n") for line in (textwrap.wrap(paragraph, LINE_WIDTH) or [""])]
+    pages = [lines[start:start + LINES_PER_PAGE] for start in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+
+    # Objects: 1 catalog, 2 page tree, 3 font, then one page and one content stream per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % (4 + 2 * page) for page in range(len(pages)))
+        + b"] /Count %d >>" % len(pages),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding << /Type /Encoding /BaseEncoding "
+        b"/WinAnsiEncoding /Differences [128 /" + " /".join(POLISH_GLYPHS).encode("ascii") + b"] >> >>",
+    ]
+    for page, page_lines in enumerate(pages):
+        stream = b"BT /F1 10 Tf 12 TL 50 790 Td " + b" ".join(_pdf_string(line) + b" Tj T*" for line in page_lines) + b" ET"
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %d 0 R >>" % (PAGE_WIDTH, PAGE_HEIGHT, 5 + 2 * page))
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    content = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(content)
+    content += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    content += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    content += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(content)
+
+
+def _write_documents(output_dir, positions, seed):
+    for position in positions:
+        document = synthetic_smpc(position, seed)
+        with open(os.path.join(output_dir, document["filename"]), "wb") as f:
+            f.write(text_to_pdf(document["text"]))
+    return len(positions)
+
+
+def generate_corpus(output_dir, n_documents, seed=0, start=0, workers=None, chunksize=500):
+    """
+    Write a corpus of synthetic SmPC PDF files, reusing it if it was already generated with the same parameters.
+
+    Args:
+    - output_dir (str): The folder the PDF files are written to.
+    - n_documents (int): The number of documents.
+    - seed (int): The seed of the corpus.
+    - start (int): The position of the first document, e.g. to generate new documents not in a corpus.
+    - workers (int, optional): The number of processes writing files. Defaults to the number of CPUs.
+    - chunksize (int): The number of files written by a process at once.
+
+    Returns:
+    - bool: True if the files were written, False if the existing corpus was reused.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    info = {"n_documents": n_documents, "seed": seed, "start": start, "generator_version": GENERATOR_VERSION}
+    info_path = os.path.join(output_dir, SYNTHETIC_CORPUS_FILE)
+    if os.path.isfile(info_path):
+        with open(info_path, encoding="utf-8") as f:
+            if json.load(f) == info:
+                return False
+    for name in os.listdir(output_dir):
+        if name.endswith(".pdf"):
+            os.remove(os.path.join(output_dir, name))
+
+    chunks = [range(position, min(position + chunksize, start + n_documents))
+              for position in range(start, start + n_documents, chunksize)]
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            _write_documents(output_dir, chunk, seed)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_write_documents, [output_dir] * len(chunks), chunks, [seed] * len(chunks)))
+    # Written last, so an interrupted generation is not reused
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    return True
@@ -0,0 +1,48 @@
+import zlib
+from utils_sqlite_cache import SQLiteCache
+
+TEXT_CACHE_FILE = "text_cache.sqlite"
+
+
+def text_cache_key(sha256, max_pages, footer):
+    """
+    Return the cache key of the text extracted from a PDF file with the given parameters.
+
+    Args:
+    - sha256 (str): The SHA-256 hash of the file content.
+    - max_pages (int): The number of pages read from the start of the document.
+    - footer (int): The height of the footer cut from every page, in points.
+
+    Returns:
+    - str: The key, so that the same file read with other parameters is cached separately.
+    """
+    return f"{sha256}:{max_pages}:{footer}"
+
+
+class TextCache(SQLiteCache):
+    """
+    Persistent cache of the raw text extracted from PDF files, keyed with text_cache_key.
+
+    Texts are stored zlib-compressed in an SQLite file that is read through memory-mapped I/O, so
+    re-indexing an unchanged corpus (e.g. after changing the cleaning rules) reads the cache instead of
+    rendering every PDF again. The file remembers the identifier of the PDF library it was filled with
+    and is emptied when another library version is used. Texts are not kept in memory.
+
+    Args:
+    - path (str): The path to the SQLite file.
+    - extractor_id (str, optional): Identifier of the PDF library and version producing the texts.
+    - mmap_size (int): The number of bytes of the file SQLite may memory-map.
+    - disk_maxsize (int): The maximum number of entries kept in the file; the oldest are removed first.
+    """
+
+    VERSION_NAME = "extractor_id"
+    VALUE_TYPE = "BLOB"
+
+    def __init__(self, path, extractor_id=None, mmap_size=1 << 30, disk_maxsize=200000):
+        super().__init__(0, path, extractor_id, disk_maxsize, mmap_size)
+
+    def _encode(self, text):
+        return zlib.compress(text.encode("utf-8"))
+
+    def _decode(self, stored):
+        return zlib.decompress(stored).decode("utf-8")
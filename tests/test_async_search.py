@@ -0,0 +1,198 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils_async_search import AsyncSearchService, MicroBatcher
+
+
+class Recorder:
+    """Batch function that returns the items doubled and records every batch it is called with."""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        return [item * 2 for item in items]
+
+
+class FakeService:
+    """Stands in for a SearchService, answering every search with its query."""
+
+    def __init__(self):
+        self.search_batches = []
+        self.similar_batches = []
+
+    def search_batch(self, requests):
+        self.search_batches.append(list(requests))
+        return [[{"query": query, "top_k": top_k}] for query, top_k, _ in requests]
+
+    def similar_batch(self, requests):
+        self.similar_batches.append(list(requests))
+        return [[{"filename": doc["filename"]} for doc in new_docs] for new_docs, _, _ in requests]
+
+    def read_pdf(self, content):
+        return [{"filename": content.decode("utf-8")}]
+
+    def info(self):
+        return {"index_version": "test"}
+
+
+def test_concurrent_items_are_answered_in_one_batch():
+    function = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(function, max_batch_size=64, max_wait=0.05)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        await batcher.close()
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [i * 2 for i in range(10)]
+    assert function.batches == [list(range(10))]
+    assert stats == {"batches": 1, "items": 10, "mean_batch_size": 10.0}
+
+
+def test_batches_never_exceed_max_batch_size():
+    function = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(function, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        await batcher.close()
+        return results
+
+    assert asyncio.run(run()) == [i * 2 for i in range(10)]
+    assert [len(batch) for batch in function.batches] == [4, 4, 2]
+    assert sum(function.batches, []) == list(range(10))
+
+
+def test_single_item_is_flushed_after_max_wait():
+    async def run():
+        batcher = MicroBatcher(Recorder(), max_wait=0.1)
+        start = time.monotonic()
+        result = await batcher.submit(1)
+        elapsed = time.monotonic() - start
+        await batcher.close()
+        return result, elapsed
+
+    result, elapsed = asyncio.run(run())
+    assert result == 2
+    assert 0.1 <= elapsed < 2.0
+
+
+def test_full_batch_does_not_wait_for_max_wait():
+    function = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(function, max_batch_size=3, max_wait=30.0)
+        results = await asyncio.wait_for(asyncio.gather(*(batcher.submit(i) for i in range(3))), timeout=5.0)
+        await batcher.close()
+        return results
+
+    assert asyncio.run(run()) == [0, 2, 4]
+    assert function.batches == [[0, 1, 2]]
+
+
+def test_errors_reach_every_request_of_the_failed_batch_only():
+    def function(items):
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    async def run():
+        batcher = MicroBatcher(function, max_batch_size=2, max_wait=0.01)
+        failed = await asyncio.gather(batcher.submit("bad"), batcher.submit("good"), return_exceptions=True)
+        # The batcher keeps answering once a batch failed
+        recovered = await asyncio.gather(batcher.submit("a"), batcher.submit("b"))
+        await batcher.close()
+        return failed, recovered
+
+    failed, recovered = asyncio.run(run())
+    assert [type(error) for error in failed] == [ValueError, ValueError]
+    assert str(failed[0]) == "bad item"
+    assert recovered == ["A", "B"]
+
+
+def test_cancelled_request_is_not_processed():
+    function = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(function, max_wait=0.05)
+        cancelled = asyncio.ensure_future(batcher.submit(1))
+        kept = asyncio.ensure_future(batcher.submit(2))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        result = await kept
+        await batcher.close()
+        return result
+
+    assert asyncio.run(run()) == 4
+    assert function.batches == [[2]]
+
+
+def test_close_cancels_running_and_queued_requests():
+    started, release = threading.Event(), threading.Event()
+
+    def function(items):
+        started.set()
+        release.wait(5.0)
+        return items
+
+    async def run():
+        batcher = MicroBatcher(function, max_batch_size=1, max_wait=0)
+        running = asyncio.ensure_future(batcher.submit("running"))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5.0)
+        queued = asyncio.ensure_future(batcher.submit("queued"))
+        await asyncio.sleep(0)
+        await batcher.close()
+        outcomes = await asyncio.wait_for(asyncio.gather(running, queued, return_exceptions=True), timeout=5.0)
+        release.set()
+        # A closed batcher starts again on the next submit
+        restarted = await asyncio.wait_for(batcher.submit("again"), timeout=5.0)
+        await batcher.close()
+        batcher.executor.shutdown()
+        return outcomes, restarted
+
+    outcomes, restarted = asyncio.run(run())
+    assert all(isinstance(outcome, asyncio.CancelledError) for outcome in outcomes)
+    assert restarted == "again"
+
+
+def test_async_service_batches_concurrent_searches():
+    service = FakeService()
+
+    async def run():
+        api = AsyncSearchService(service, max_batch_size=64, max_wait=0.05)
+        results = await asyncio.gather(*(api.search(f"query {i}", top_k=i + 1) for i in range(5)))
+        stats = api.stats()
+        await api.close()
+        return results, stats
+
+    results, stats = asyncio.run(run())
+    assert [result[0]["query"] for result in results] == [f"query {i}" for i in range(5)]
+    assert [result[0]["top_k"] for result in results] == [1, 2, 3, 4, 5]
+    assert len(service.search_batches) == 1
+    assert stats["search"]["batches"] == 1 and stats["similar"]["batches"] == 0
+
+
+def test_async_service_reads_uploads_before_batching_them():
+    service = FakeService()
+
+    async def run():
+        api = AsyncSearchService(service, max_batch_size=64, max_wait=0.05)
+        results = await asyncio.gather(api.similar_to_pdf(b"a.pdf"), api.similar_to_pdf(b"b.pdf"))
+        await api.close()
+        return results, api.read_executor
+
+    results, read_executor = asyncio.run(run())
+    assert results == [[{"filename": "a.pdf"}], [{"filename": "b.pdf"}]]
+    assert sum(len(batch) for batch in service.similar_batches) == 2
+    with pytest.raises(RuntimeError):
+        read_executor.submit(print)
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import utils_data_cleaning
+from utils_data_cleaning import configure_lemma_cache, pipe_with_cache
+
+
+class FakeNlp:
+    """Stands in for the spaCy pipeline: its "docs" are the texts themselves."""
+
+    pipe_names = []
+
+    def __init__(self):
+        self.parsed = []
+
+    def pipe(self, texts, batch_size=256, n_process=1, disable=()):
+        for text in texts:
+            self.parsed.append(text)
+            yield text
+
+
+def counted(texts, consumed):
+    for text in texts:
+        consumed.append(text)
+        yield text
+
+
+@pytest.fixture
+def lemma_cache():
+    cache = configure_lemma_cache()
+    yield cache
+    configure_lemma_cache()
+
+
+def test_cached_stream_is_consumed_in_step_with_its_output(lemma_cache, monkeypatch):
+    def no_spacy():
+        raise AssertionError("spaCy is not needed when every text is cached")
+
+    monkeypatch.setattr(utils_data_cleaning, "get_nlp", no_spacy)
+    texts = [f"text {i}" for i in range(1000)]
+    for text in texts:
+        lemma_cache.set("key\x1f" + text, text.upper())
+    consumed = []
+    results = []
+    for result in pipe_with_cache(counted(texts, consumed), "key\x1f", str.upper, batch_size=16):
+        results.append(result)
+        assert len(consumed) - len(results) < 16
+    assert results == [text.upper() for text in texts]
+
+
+def test_misses_are_parsed_batch_by_batch_in_input_order(lemma_cache, monkeypatch):
+    nlp = FakeNlp()
+    monkeypatch.setattr(utils_data_cleaning, "get_nlp", lambda: nlp)
+    texts = [f"text {i}" for i in range(100)]
+    for text in texts[::3]:
+        lemma_cache.set("key\x1f" + text, text.upper())
+    consumed = []
+    results = []
+    for result in pipe_with_cache(counted(texts, consumed), "key\x1f", str.upper, batch_size=8, prepare=lambda text: text + "!"):
+        results.append(result)
+        assert len(consumed) - len(results) < 8
+    assert results == [text.upper() if i % 3 == 0 else text.upper() + "!" for i, text in enumerate(texts)]
+    assert nlp.parsed == [text + "!" for i, text in enumerate(texts) if i % 3]
+    # The results of the misses are cached under the original text
+    assert lemma_cache.get("key\x1f" + texts[1]) == "TEXT 1!"
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils_hybrid_search import fuse_scores
+
+# Two queries, three candidate slots each; the second query has one padding slot
+CANDIDATES = np.array([[4, 7, 9], [2, 5, -1]])
+FIELD_SCORES = {
+    "sklad": np.array([[0.9, 0.2, 0.5], [0.1, 0.8, 0.0]], dtype=np.float32),
+    "wskazania": np.array([[0.3, 0.6, 0.4], [0.7, 0.7, 0.0]], dtype=np.float32),
+}
+
+
+def test_weighted_fusion_is_the_weighted_mean_of_the_field_scores():
+    fused = fuse_scores(FIELD_SCORES, {"sklad": 1.0, "wskazania": 3.0}, CANDIDATES, "weighted")
+    expected = (1.0 * FIELD_SCORES["sklad"] + 3.0 * FIELD_SCORES["wskazania"]) / 4.0
+    np.testing.assert_allclose(fused[0], expected[0])
+    np.testing.assert_allclose(fused[1, :2], expected[1, :2])
+    assert fused[1, 2] == -np.inf
+
+
+def test_weighted_fusion_ignores_weights_of_absent_fields():
+    fused = fuse_scores({"sklad": FIELD_SCORES["sklad"]}, {"sklad": 2.0, "wskazania": 5.0}, CANDIDATES)
+    np.testing.assert_allclose(fused[0], FIELD_SCORES["sklad"][0])
+
+
+def test_rrf_sums_weighted_reciprocal_ranks():
+    fused = fuse_scores(FIELD_SCORES, {"sklad": 1.0, "wskazania": 2.0}, CANDIDATES, "rrf", rrf_k=10)
+    # Query 0 ranks: sklad 1, 3, 2 and wskazania 3, 1, 2
+    expected = [1 / 11 + 2 / 13, 1 / 13 + 2 / 11, 1 / 12 + 2 / 12]
+    np.testing.assert_allclose(fused[0], expected)
+    # Query 1: the tie in wskazania goes to the first candidate, padding ranks last and is excluded
+    np.testing.assert_allclose(fused[1, :2], [1 / 12 + 2 / 11, 1 / 11 + 2 / 12])
+    assert fused[1, 2] == -np.inf
+
+
+def test_rrf_only_depends_on_the_order_of_the_scores():
+    scaled = {field: scores * 100 - 3 for field, scores in FIELD_SCORES.items()}
+    weights = {"sklad": 1.0, "wskazania": 1.0}
+    np.testing.assert_array_equal(fuse_scores(FIELD_SCORES, weights, CANDIDATES, "rrf"),
+                                  fuse_scores(scaled, weights, CANDIDATES, "rrf"))
+
+
+def test_unknown_fusion_is_rejected():
+    with pytest.raises(ValueError, match="Unknown fusion"):
+        fuse_scores(FIELD_SCORES, {"sklad": 1.0, "wskazania": 1.0}, CANDIDATES, "max")
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import scipy.sparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import utils_inverted_index
+import utils_search_engine
+from utils_inverted_index import build_inverted_index, search_inverted_index, search_product_by_indication_inverted
+from utils_search_engine import prepare_tfidf_representation, rank_scores, search_product_by_indication, term_major
+
+
+def exhaustive(term_postings, term_ids, query_weights, top_k, min_score=0.0):
+    query = scipy.sparse.csr_matrix((query_weights, (np.zeros(len(term_ids), dtype=int), term_ids)),
+                                    shape=(1, term_postings.shape[0]))
+    scores = (query @ term_postings).tocsr()
+    return rank_scores(scores.indices, scores.data, top_k, min_score)
+
+
+def test_pruning_keeps_documents_rounding_to_the_threshold():
+    # Both documents round to 0.1: the tie goes to document 0, which MaxScore must not prune
+    term_postings = scipy.sparse.csr_matrix(np.array([[0.0, 0.1004], [0.09986, 0.0]]))
+    term_ids, query_weights = np.array([0, 1]), np.array([1.0, 1.0])
+    expected = exhaustive(term_postings, term_ids, query_weights, 1)
+    assert expected == [(0, 0.1)]
+    assert search_inverted_index(build_inverted_index(term_postings), term_ids, query_weights, 1) == expected
+
+
+def test_random_weights_match_exhaustive_search():
+    rng = np.random.default_rng(0)
+    for _ in range(400):
+        n_terms, n_docs = int(rng.integers(2, 8)), int(rng.integers(2, 30))
+        # Weights within a few rounding steps of each other, so many scores round to the same value
+        dense = np.round(rng.uniform(0.098, 0.102, size=(n_terms, n_docs)), 5) * (rng.random((n_terms, n_docs)) < 0.2)
+        term_postings = scipy.sparse.csr_matrix(dense)
+        index = build_inverted_index(term_postings)
+        term_ids = rng.choice(n_terms, size=int(rng.integers(1, n_terms + 1)), replace=False)
+        query_weights = np.ones(len(term_ids))
+        for top_k in [1, 2, 5, None]:
+            min_score = float(rng.choice([0.0, 0.05]))
+            assert (search_inverted_index(index, term_ids, query_weights, top_k, min_score)
+                    == exhaustive(term_postings, term_ids, query_weights, top_k, min_score))
+
+
+def test_random_corpus_matches_search_product_by_indication(monkeypatch):
+    # Queries are already lemmatized, so the comparison does not need the spaCy model
+    monkeypatch.setattr(utils_search_engine, "lemmatize_text", lambda text: text)
+    monkeypatch.setattr(utils_inverted_index, "lemmatize_text", lambda text: text)
+    rng = np.random.default_rng(1)
+    words = [f"term{i}" for i in range(25)]
+    products = [{"title": f"product {i}", "filename": f"{i}.pdf",
+                 "text": " ".join(rng.choice(words, size=int(rng.integers(1, 15))))} for i in range(150)]
+    vectorizer, tfidf_matrix = prepare_tfidf_representation(products)
+    tfidf_postings = term_major(tfidf_matrix)
+    index = build_inverted_index(tfidf_postings)
+    for _ in range(300):
+        query = " ".join(rng.choice(words, size=int(rng.integers(1, 5))))
+        for top_k in [1, 3, 10]:
+            assert (search_product_by_indication_inverted(query, products, vectorizer, index, top_k=top_k)
+                    == search_product_by_indication(query, products, vectorizer, tfidf_matrix, top_k, tfidf_postings=tfidf_postings))
@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import utils_result_cache
+from utils_result_cache import ResultCache, normalize_query
+
+
+class FakeClock:
+    """Stands in for the time module, with a monotonic clock moved by the test."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils_result_cache, "time", clock)
+    return clock
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(maxsize=2)
+    cache.set("a", [1], "v1")
+    cache.set("b", [2], "v1")
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a", "v1") == [1]
+    cache.set("c", [3], "v1")
+
+    assert cache.get("b", "v1") is None
+    assert cache.get("a", "v1") == [1]
+    assert cache.get("c", "v1") == [3]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size"] == 2
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResultCache(maxsize=10, ttl=60)
+    cache.set("a", [1], "v1")
+    clock.now += 59
+    assert cache.get("a", "v1") == [1]
+    clock.now += 1
+    assert cache.get("a", "v1") is None
+
+    stats = cache.stats()
+    assert stats["expirations"] == 1
+    assert stats["size"] == 0
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_entries_without_ttl_do_not_expire(clock):
+    cache = ResultCache(maxsize=10)
+    cache.set("a", [1], "v1")
+    clock.now += 10 ** 9
+    assert cache.get("a", "v1") == [1]
+
+
+def test_new_index_version_invalidates_all_entries():
+    cache = ResultCache(maxsize=10)
+    cache.set("a", [1], "v1")
+    cache.set("b", [2], "v1")
+
+    assert cache.get("a", "v2") is None
+    assert cache.stats()["size"] == 0
+    assert cache.stats()["invalidations"] == 1
+    # Results stored for the new version are served for it only
+    cache.set("a", [10], "v2")
+    assert cache.get("a", "v2") == [10]
+    assert cache.get("a", "v1") is None
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_set_with_new_version_drops_older_entries():
+    cache = ResultCache(maxsize=10)
+    cache.set("a", [1], "v1")
+    cache.set("b", [2], "v2")
+    assert cache.get("a", "v2") is None
+    assert cache.get("b", "v2") == [2]
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResultCache(maxsize=0)
+    cache.set("a", [1], "v1")
+    assert cache.get("a", "v1") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_second_lookup_of_a_miss_is_not_counted():
+    cache = ResultCache(maxsize=10)
+    assert cache.get("query", "v1") is None
+    assert cache.get("lemma", "v1", count_miss=False) is None
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hit_rate"] == 0.0
+
+
+def test_normalize_query_ignores_case_and_whitespace():
+    assert normalize_query("  Cukrzyca \t TYPU\n2 ") == "cukrzyca typu 2"
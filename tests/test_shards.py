@@ -0,0 +1,107 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import utils_shards
+from utils_index import load_index, save_index
+from utils_inverted_index import build_inverted_index, query_terms, search_inverted_index
+from utils_search_engine import rank_scores
+from utils_shards import (GLOBAL_DIR, load_shard_registry, load_sharded_index, save_shard_registry, search_shards,
+                          shard_dir, sharded_tfidf_postings)
+
+WORDS = ["nadciśnienie", "tętnicze", "cukrzyca", "typu", "zakażenia", "bakteryjne", "ból", "głowy", "astma",
+         "oskrzelowa", "migrena", "padaczka", "depresja", "alergia", "kaszel", "gorączka", "zapalenie", "stawów"]
+QUERIES = ["nadciśnienie tętnicze", "cukrzyca typu", "ból głowy migrena", "zapalenie stawów gorączka", "kaszel"]
+SHARD_SIZES = [7, 12, 5]
+
+
+def make_documents(n_documents, seed=0):
+    rng = np.random.default_rng(seed)
+
+    def text(low, high):
+        return " ".join(rng.choice(WORDS, size=rng.integers(low, high)))
+
+    return [{"filename": f"doc-{i:03d}.pdf", "nazwa": f"Produkt {i}", "sklad": text(1, 6), "wskazania": text(2, 15)}
+            for i in range(n_documents)]
+
+
+@pytest.fixture
+def indexes(tmp_path):
+    # The same documents as one index and as shards of uneven size
+    documents = make_documents(sum(SHARD_SIZES))
+    save_index(str(tmp_path / "single"), documents)
+    sharded_dir = str(tmp_path / "sharded")
+    entries, start = [], 0
+    for i, size in enumerate(SHARD_SIZES):
+        name = f"part-{i}"
+        meta = save_index(shard_dir(sharded_dir, name), documents[start:start + size])
+        entries.append({"name": name, "input_path": None, "range": None,
+                        "index_version": meta["index_version"], "n_documents": meta["n_documents"]})
+        start += size
+    save_shard_registry(sharded_dir, {"shards": entries})
+    yield load_index(str(tmp_path / "single")), sharded_dir
+
+
+def close(index):
+    index["executor"].shutdown()
+
+
+def test_sharded_tfidf_weights_equal_unsharded(indexes):
+    single, sharded_dir = indexes
+    sharded = load_sharded_index(sharded_dir)
+    assert sharded["vectorizer"].vocabulary == single["vectorizer"].vocabulary_
+    np.testing.assert_allclose(sharded["vectorizer"].idf_, single["vectorizer"].idf_)
+    np.testing.assert_allclose(sharded_tfidf_postings(sharded).toarray(), single["tfidf_postings"].toarray(), atol=1e-12)
+    close(sharded)
+
+
+@pytest.mark.parametrize("top_k", [3, None])
+def test_sharded_tfidf_search_equals_unsharded(indexes, top_k):
+    single, sharded_dir = indexes
+    sharded = load_sharded_index(sharded_dir)
+    scores = (single["vectorizer"].transform(QUERIES) @ single["tfidf_postings"]).tocsr()
+    expected = [rank_scores(scores.indices[scores.indptr[row]:scores.indptr[row + 1]],
+                            scores.data[scores.indptr[row]:scores.indptr[row + 1]], top_k)
+                for row in range(len(QUERIES))]
+    assert search_shards(QUERIES, sharded, top_k) == expected
+    close(sharded)
+
+
+def test_sharded_bm25_search_equals_unsharded(indexes):
+    single, sharded_dir = indexes
+    sharded = load_sharded_index(sharded_dir, "bm25")
+    inverted_index = build_inverted_index(single["bm25_postings"])
+    expected = [search_inverted_index(inverted_index, *query_terms(query, single["vectorizer"], "bm25"), 5)
+                for query in QUERIES]
+    assert search_shards(QUERIES, sharded, 5) == expected
+    close(sharded)
+
+
+def test_global_weights_are_stored_per_registry_version(indexes, monkeypatch):
+    _, sharded_dir = indexes
+    first = load_sharded_index(sharded_dir)
+    version = load_shard_registry(sharded_dir)["index_version"]
+    assert os.listdir(os.path.join(sharded_dir, GLOBAL_DIR)) == [f"{version}-tfidf"]
+
+    # A second load reads the stored weights instead of reweighting the shards
+    def no_reweighting(*args, **kwargs):
+        raise AssertionError("the global weights were computed again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(utils_shards, "compute_global_weights", no_reweighting)
+        second = load_sharded_index(sharded_dir, executor=first["executor"])
+    assert second["executor"] is first["executor"]
+    for shard, stored in zip(first["shards"], second["shards"]):
+        np.testing.assert_array_equal(shard["columns"], stored["columns"])
+        assert (shard["postings"] != stored["postings"]).nnz == 0
+
+    # A new registry version computes them again and removes the previous ones
+    registry = save_shard_registry(sharded_dir, load_shard_registry(sharded_dir))
+    third = load_sharded_index(sharded_dir, executor=first["executor"])
+    assert os.listdir(os.path.join(sharded_dir, GLOBAL_DIR)) == [f"{registry['index_version']}-tfidf"]
+    assert third["meta"]["index_version"] == registry["index_version"]
+    close(first)